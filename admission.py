@@ -0,0 +1,254 @@
+"""
+Admission control for /submit-data before any decryption work.
+
+A flooding or replaying device used to cost a full RSA unwrap per request
+before it could be rejected, starving dashboards served by the same workers.
+The envelope carries the device's sensor_id in plaintext, so requests are
+admitted or shed up front:
+
+- a token bucket per device_id (ADMISSION_DEVICE_RATE/s, burst ADMISSION_DEVICE_BURST)
+- a token bucket per owning user_id (ADMISSION_USER_RATE/s, burst ADMISSION_USER_BURST),
+  resolved from the in-memory sensor registry; a device_id registered by
+  several users is charged to each of them
+- unknown or missing sensor_ids share one bucket (ADMISSION_UNKNOWN_RATE/s),
+  so garbage traffic cannot buy RSA work either
+- /submit-data/batch has no plaintext sensor_id: the caller's remote address
+  is charged to a gateway bucket (ADMISSION_GATEWAY_RATE/s, burst
+  ADMISSION_GATEWAY_BURST) before the envelope is unwrapped, and every item
+  is charged to its device and owner buckets before its signature is
+  verified (charge_device)
+- a global cap on requests inside the ingest pipeline (ADMISSION_MAX_CONCURRENT)
+
+Rejected requests get 429 with Retry-After, and every decision is counted
+(/api/test/stats). A rate or cap of 0 disables that check. Limits are per
+worker process (gunicorn --workers 2 admits up to twice the configured rates).
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sensor_registry import get_sensor_registry, normalize_device_id
+
+
+ADMISSION_CONTROL = (os.environ.get('ADMISSION_CONTROL', 'true') or 'true').strip().lower() in ('1', 'true', 'yes')
+ADMISSION_DEVICE_RATE = float(os.environ.get('ADMISSION_DEVICE_RATE', '5'))
+ADMISSION_DEVICE_BURST = float(os.environ.get('ADMISSION_DEVICE_BURST', '20'))
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', '50'))
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', '200'))
+ADMISSION_UNKNOWN_RATE = float(os.environ.get('ADMISSION_UNKNOWN_RATE', '5'))
+ADMISSION_GATEWAY_RATE = float(os.environ.get('ADMISSION_GATEWAY_RATE', '2'))
+ADMISSION_GATEWAY_BURST = float(os.environ.get('ADMISSION_GATEWAY_BURST', '10'))
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '16'))
+# Buckets kept per kind before the least recently used ones are dropped
+ADMISSION_MAX_BUCKETS = int(os.environ.get('ADMISSION_MAX_BUCKETS', '10000'))
+
+_UNKNOWN_KEY = '__unknown__'
+
+
+class TokenBuckets:
+    """Thread-safe token buckets (one per key) sharing a rate and burst."""
+
+    def __init__(self, rate: float, burst: float, max_buckets: int = ADMISSION_MAX_BUCKETS):
+        self.rate = max(0.0, float(rate))
+        self.burst = max(1.0, float(burst))
+        self._max_buckets = max(1, int(max_buckets))
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> [tokens, last refill (monotonic)]
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def take(self, key, now: Optional[float] = None) -> float:
+        """Take one token for key.
+
+        Returns:
+            0.0 if admitted, otherwise seconds until a token is available
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                while len(self._buckets) > self._max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return 0.0
+            return (1.0 - bucket[0]) / self.rate
+
+    def refund(self, key):
+        """Return a token taken by a request that was shed later."""
+        if not self.enabled:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1.0)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._buckets)
+
+
+class AdmissionController:
+    """Per-device / per-user rate limits plus a global concurrency cap."""
+
+    def __init__(self, enabled: bool = ADMISSION_CONTROL,
+                 device_rate: float = ADMISSION_DEVICE_RATE, device_burst: float = ADMISSION_DEVICE_BURST,
+                 user_rate: float = ADMISSION_USER_RATE, user_burst: float = ADMISSION_USER_BURST,
+                 unknown_rate: float = ADMISSION_UNKNOWN_RATE,
+                 gateway_rate: float = ADMISSION_GATEWAY_RATE, gateway_burst: float = ADMISSION_GATEWAY_BURST,
+                 max_concurrent: int = ADMISSION_MAX_CONCURRENT):
+        self.enabled = enabled
+        self._devices = TokenBuckets(device_rate, device_burst)
+        self._users = TokenBuckets(user_rate, user_burst)
+        self._unknown = TokenBuckets(unknown_rate, max(1.0, unknown_rate))
+        self._gateways = TokenBuckets(gateway_rate, gateway_burst)
+        self._max_concurrent = max(0, int(max_concurrent))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {'admitted': 0, 'rejected_device': 0, 'rejected_user': 0,
+                       'rejected_unknown': 0, 'rejected_gateway': 0, 'rejected_concurrency': 0,
+                       'max_in_flight': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def admit(self, sensor_id=None, gateway=None):
+        """Decide whether a request may enter the ingest pipeline.
+
+        Args:
+            sensor_id: Plaintext sensor_id from the envelope (None if absent)
+            gateway: Remote address of a gateway batch; charged to the
+                gateway bucket instead of a device's
+
+        Returns:
+            Tuple of (admitted, reason, retry_after_seconds). When admitted,
+            the caller must call release() once the request is done.
+        """
+        if not self.enabled:
+            return True, None, 0
+        charged = []
+        if gateway is not None:
+            wait = self._gateways.take(gateway)
+            if wait:
+                self._count('rejected_gateway')
+                return False, 'rate limit exceeded for gateway', wait
+            charged.append((self._gateways, gateway))
+        else:
+            reason, wait = self._charge_sensor(sensor_id, charged)
+            if reason:
+                return False, reason, wait
+
+        with self._lock:
+            if self._max_concurrent and self._in_flight >= self._max_concurrent:
+                self._stats['rejected_concurrency'] += 1
+                rejected = True
+            else:
+                self._in_flight += 1
+                self._stats['admitted'] += 1
+                self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._in_flight)
+                rejected = False
+        if rejected:
+            for buckets, key in charged:
+                buckets.refund(key)
+            return False, 'server busy', 1
+        return True, None, 0
+
+    def charge_device(self, sensor_id):
+        """Charge one gateway batch item to its device and owner buckets.
+
+        Takes no concurrency slot (the batch already holds one).
+
+        Returns:
+            Tuple of (admitted, reason, retry_after_seconds)
+        """
+        if not self.enabled:
+            return True, None, 0
+        reason, wait = self._charge_sensor(sensor_id, [])
+        return (False, reason, wait) if reason else (True, None, 0)
+
+    def _charge_sensor(self, sensor_id, charged: list):
+        """Take the device/owner (or unknown) tokens for sensor_id.
+
+        Returns:
+            (None, 0) when charged (the taken buckets are appended to
+            charged), otherwise (reason, retry_after_seconds) with nothing taken
+        """
+        device_key = normalize_device_id(sensor_id)
+        owners = get_sensor_registry().get_sensors(device_key) if device_key else []
+        if not owners:
+            wait = self._unknown.take(_UNKNOWN_KEY)
+            if wait:
+                self._count('rejected_unknown')
+                return 'unknown sensor_id rate limit exceeded', wait
+            charged.append((self._unknown, _UNKNOWN_KEY))
+            return None, 0
+        taken = []
+        wait = self._devices.take(device_key)
+        if wait:
+            self._count('rejected_device')
+            return f"rate limit exceeded for device '{sensor_id}'", wait
+        taken.append((self._devices, device_key))
+        for user_id in {row.get('user_id') for row in owners}:
+            wait = self._users.take(user_id)
+            if wait:
+                for buckets, key in taken:
+                    buckets.refund(key)
+                self._count('rejected_user')
+                return 'rate limit exceeded for sensor owner', wait
+            taken.append((self._users, user_id))
+        charged.extend(taken)
+        return None, 0
+
+    def release(self):
+        """Free the concurrency slot taken by an admitted request."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+    @staticmethod
+    def retry_after_header(retry_after: float) -> str:
+        """Whole seconds for the Retry-After header (at least 1)."""
+        return str(max(1, int(math.ceil(retry_after))))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, in_flight=self._in_flight,
+                        max_concurrent=self._max_concurrent,
+                        device_buckets=self._devices.size(), user_buckets=self._users.size(),
+                        gateway_buckets=self._gateways.size())
+
+
+# Global instance for use across the application
+_admission_controller: Optional[AdmissionController] = None
+_admission_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """
+    Get or create the global admission controller.
+
+    Returns:
+        AdmissionController: Singleton instance
+    """
+    global _admission_controller
+    if _admission_controller is None:
+        with _admission_controller_lock:
+            if _admission_controller is None:
+                _admission_controller = AdmissionController()
+    return _admission_controller
@@ -1,9 +1,10 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for, session, flash, Response
+from flask import Flask, request, render_template, jsonify, redirect, url_for, session, flash, Response, g
 from werkzeug.security import generate_password_hash, check_password_hash
-from encryption_utils import decrypt_data, encrypt_data
+from encryption_utils import encrypt_data, key_algorithm, verify_signature
 import base64
 import hashlib
 import json
+import multiprocessing
 import os
 import secrets
 import sys
@@ -13,8 +14,6 @@ from datetime import datetime, timedelta
 import threading
 import re
 from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
 from validation import (
     validate_email, validate_username, validate_password, validate_name,
     validate_device_id, validate_location, validate_public_key, validate_threshold,
@@ -24,10 +23,22 @@ from functools import wraps
 from typing import Optional
 from utils.auth import login_required
 from utils.session_utils import _issue_device_challenge, _validate_device_session
-from utils.mqtt_utils import _get_mqtt_publish_kwargs
+from utils.session_store import remember_device_session
+from utils.mqtt_utils import MQTT_SHARED_GROUP, _get_mqtt_publish_kwargs, get_mqtt_publisher
+from sensor_registry import get_sensor_registry
+from public_key_cache import get_public_key_cache, invalidate_public_key, compute_public_key_fingerprint
+from threshold_cache import get_threshold_cache
+from admission import get_admission_controller
+from crypto_executor import get_crypto_executor
+from ingest_pipeline import IngestError, IngestMessage, IngestPipeline
+from ingest_dedup import ingest_key, reading_sequence
+from heartbeat import get_heartbeat_tracker
+from session_keys import SESSION_KEY_ALG, get_session_key_store
+from app_logging import configure_logging, get_logger
 
 from db import (
     insert_sensor_data,
+    insert_sensor_data_batch,
     create_user,
     get_user_by_username,
     get_user_by_email,
@@ -44,12 +55,16 @@ from db import (
     count_active_sensors_by_location,
     list_recent_sensor_data,
     list_recent_sensor_data_by_location,
+    list_latest_sensor_data,
     get_locations_with_status,
     create_device_session,
     get_device_session,
     update_device_session,
     delete_device_session,
     cleanup_expired_sessions,
+    begin_connection_scope,
+    end_connection_scope,
+    read_snapshot,
     _get_connection,
     _return_connection,
     _get_cursor,
@@ -87,16 +102,12 @@ sys.stderr.flush()
 import logging
 
 # Set up logging for Apache/mod_wsgi
+# File and stderr writes happen on a background thread (see app_logging.py)
 log_file = os.path.join(os.path.dirname(__file__), 'flask_error.log')
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()  # Also log to stderr (goes to Apache error log)
-    ]
-)
+configure_logging(log_file)
 app_logger = logging.getLogger(__name__)
+request_log = get_logger('request')
+ingest_log = get_logger('ingest')
 
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -148,33 +159,34 @@ def handle_exception(e):
         return f"Internal Server Error: {str(e)}\n\n{full_traceback}", 500
     return f"Internal Server Error: {str(e)}\n\nCheck Apache error log or flask_error.log file for details.", 500
 
-# Request logging for debugging
+# Request logging for debugging (LOG_LEVEL=DEBUG)
 @app.before_request
 def log_request():
-    """Log all incoming requests for debugging."""
-    if '/provision/' in request.path:
-        app.logger.error("=" * 80)
-        app.logger.error(f"[BEFORE_REQUEST] {request.method} {request.path}")
-        app.logger.error(f"[BEFORE_REQUEST] Remote: {request.remote_addr}")
-        app.logger.error(f"[BEFORE_REQUEST] User-Agent: {request.headers.get('User-Agent', 'N/A')}")
-        app.logger.error(f"[BEFORE_REQUEST] Content-Type: {request.headers.get('Content-Type', 'N/A')}")
-        print("=" * 80, file=sys.stderr)
-        print(f"[BEFORE_REQUEST] {request.method} {request.path}", file=sys.stderr)
-        print(f"[BEFORE_REQUEST] Remote: {request.remote_addr}", file=sys.stderr)
-        print(f"[BEFORE_REQUEST] User-Agent: {request.headers.get('User-Agent', 'N/A')}", file=sys.stderr)
-        print(f"[BEFORE_REQUEST] Content-Type: {request.headers.get('Content-Type', 'N/A')}", file=sys.stderr)
+    """Log incoming provisioning requests for debugging."""
+    if '/provision/' in request.path and request_log.isEnabledFor(logging.DEBUG):
+        request_log.debug("[BEFORE_REQUEST] %s %s remote=%s user_agent=%s content_type=%s",
+                          request.method, request.path, request.remote_addr,
+                          request.headers.get('User-Agent', 'N/A'),
+                          request.headers.get('Content-Type', 'N/A'))
         if request.is_json:
             try:
                 body = request.get_json(silent=True)
-                app.logger.error(f"[BEFORE_REQUEST] JSON body: {body}")
-                print(f"[BEFORE_REQUEST] JSON body: {body}", file=sys.stderr)
+                request_log.debug("[BEFORE_REQUEST] JSON body: %s", body)
             except Exception as e:
-                app.logger.error(f"[BEFORE_REQUEST] Error parsing JSON: {e}")
-                print(f"[BEFORE_REQUEST] Error parsing JSON: {e}", file=sys.stderr)
+                request_log.debug("[BEFORE_REQUEST] Error parsing JSON: %s", e)
         else:
-            app.logger.error(f"[BEFORE_REQUEST] Raw data: {request.get_data(as_text=True)[:200]}")
-            print(f"[BEFORE_REQUEST] Raw data: {request.get_data(as_text=True)[:200]}", file=sys.stderr)
-        sys.stderr.flush()
+            request_log.debug("[BEFORE_REQUEST] Raw data: %s", request.get_data(as_text=True)[:200])
+
+# One pooled connection per request: every db.* call made while handling the
+# request shares it (checked out on the first query, returned at teardown)
+@app.before_request
+def open_db_scope():
+    g.db_scope = begin_connection_scope()
+
+
+@app.teardown_request
+def close_db_scope(exc=None):
+    end_connection_scope(g.pop('db_scope', None))
 
 # User-specific data storage: user_id -> {latest_data, latest_by_metric, latest_by_sensor}
 user_latest_data = {}  # user_id -> latest_data dict
@@ -300,6 +312,7 @@ def add_user_key(user_id, device_id, public_key):
     if user_id not in user_pending_keys:
         user_pending_keys[user_id] = {}
     user_pending_keys[user_id][device_id] = public_key
+    invalidate_public_key(user_id, device_id)
     return True
 
 def get_user_key(user_id, device_id):
@@ -342,7 +355,7 @@ def notify_raspbian_key_cleanup(device_id: str, user_id: int) -> bool:
         return False
     
     try:
-        import paho.mqtt.publish as publish
+        import paho.mqtt.client  # noqa: F401
     except ImportError:
         print(f"MQTT: paho-mqtt not available, skipping cleanup notification for '{device_id}'")
         return False
@@ -394,9 +407,8 @@ def notify_raspbian_key_cleanup(device_id: str, user_id: int) -> bool:
         print(f"[Delete Notification] Sending MQTT message:")
         print(f"  Topic: {delete_topic}")
         
-        # Use the same MQTT configuration as provision requests
-        publish_kwargs = _get_mqtt_publish_kwargs()
-        publish.single(delete_topic, payload, qos=1, **publish_kwargs)
+        # Same broker connection pool as provision requests
+        get_mqtt_publisher().publish(delete_topic, payload, qos=1)
         
         print(f"MQTT: ✅ Sent key cleanup notification for device '{device_id}' (user: {user_id})")
         return True
@@ -741,21 +753,7 @@ def start_mqtt_sensor_subscriber():
         return
     mqtt_sensor_thread_ref = [mqtt_sensor_thread_started]
     from utils.mqtt_utils import start_mqtt_sensor_subscriber as _start_mqtt_sensor_subscriber
-    _start_mqtt_sensor_subscriber(
-        list_sensors,
-        insert_sensor_data,
-        _validate_device_session,
-        build_effective_thresholds_for_sensor,
-        _build_type_defaults_map,
-        compute_safety,
-        latest_by_metric,
-        latest_by_sensor,
-        user_latest_by_metric,
-        user_latest_by_sensor,
-        user_latest_data,
-        mqtt_sensor_thread_ref,
-        REQUIRE_DEVICE_SESSION
-    )
+    _start_mqtt_sensor_subscriber(ingest_pipeline, mqtt_sensor_thread_ref)
     mqtt_sensor_thread_started = mqtt_sensor_thread_ref[0]
     return
 
@@ -827,12 +825,98 @@ DEVICE_CHALLENGE_TTL_SECONDS = int(os.environ.get('DEVICE_CHALLENGE_TTL_SECONDS'
 # login_required, _issue_device_challenge, and _validate_device_session are now imported from utils
 
 
+def _resolve_sensor_public_key_pem(sensor_row, device_id):
+    """Return (public key PEM, key_source) for a sensor, or (None, None).
+
+    Uses the database key when present, otherwise the filesystem fallbacks
+    (user_keys/{user_id}/{device_id}_public.pem, sensor_keys/{user_id}/{device_id}/sensor_public.pem,
+    sensor_keys/{device_id}/sensor_public.pem). Resolved PEM files are cached.
+    """
+    key_cache = get_public_key_cache()
+    db_pub_key = sensor_row.get('public_key')
+    sensor_user_id = sensor_row.get('user_id')
+    key_source = "database"
+    
+    # If not in database, try multiple fallback locations
+    if not db_pub_key:
+        cached = key_cache.get_pem(sensor_user_id, device_id)
+        if cached:
+            db_pub_key, key_source = cached
+        else:
+            # Try user-specific locations first
+            if sensor_user_id:
+                # Check user_keys/{user_id}/{device_id}_public.pem
+                user_key_path = get_user_key_file(sensor_user_id, device_id)
+                if os.path.exists(user_key_path):
+                    db_pub_key = open(user_key_path, "rb").read().decode('utf-8')
+                    key_source = f"user_keys/{sensor_user_id}/{device_id}_public.pem"
+                
+                # Also check sensor_keys/{user_id}/{device_id}/sensor_public.pem
+                if not db_pub_key:
+                    sensor_pub_path_user = os.path.join(os.path.dirname(__file__), "sensor_keys", str(sensor_user_id), device_id, "sensor_public.pem")
+                    if os.path.exists(sensor_pub_path_user):
+                        db_pub_key = open(sensor_pub_path_user, "rb").read().decode('utf-8')
+                        key_source = f"sensor_keys/{sensor_user_id}/{device_id}/sensor_public.pem"
+            
+            # Fallback to global location (legacy)
+            if not db_pub_key:
+                sensor_pub_path = os.path.join(os.path.dirname(__file__), "sensor_keys", device_id, "sensor_public.pem")
+                if os.path.exists(sensor_pub_path):
+                    db_pub_key = open(sensor_pub_path, "rb").read().decode('utf-8')
+                    key_source = f"sensor_keys/{device_id}/sensor_public.pem"
+            
+            if db_pub_key:
+                key_cache.set_pem(sensor_user_id, device_id, db_pub_key, key_source)
+    
+    if not db_pub_key:
+        return None, None
+    return db_pub_key, key_source
+
+
+def _load_sensor_public_key(sensor_row, device_id):
+    """Return (parsed public key, key_source) for a sensor, or (None, None).
+
+    Same lookup as _resolve_sensor_public_key_pem; parsed keys are cached.
+    """
+    public_key_pem, key_source = _resolve_sensor_public_key_pem(sensor_row, device_id)
+    if not public_key_pem:
+        return None, None
+    return get_public_key_cache().get_key(sensor_row.get('user_id'), device_id, public_key_pem), key_source
+
+
+def _negotiate_session_key(session_token, device_id, sensor_rows):
+    """Issue an AES-GCM key for a new session, wrapped with the device public key.
+
+    Returns the extra response fields, or {} when no key could be issued (the
+    device then keeps using the RSA hybrid envelope).
+    """
+    for sensor_row in sensor_rows:
+        try:
+            public_key, _key_source = _load_sensor_public_key(sensor_row, device_id)
+            # Ed25519 keys only sign; the key can only be wrapped for RSA devices
+            if public_key is None or key_algorithm(public_key) != 'rsa':
+                continue
+            wrapped = get_session_key_store().issue(session_token, device_id, public_key, DEVICE_SESSION_TTL_SECONDS)
+        except Exception as e:
+            print(f"WARNING: Session key negotiation failed for {device_id}: {e}", file=sys.stderr)
+            return {}
+        if not wrapped:
+            return {}
+        return {
+            "session_key": wrapped,
+            "session_key_alg": SESSION_KEY_ALG,
+            "session_key_expires_in_seconds": DEVICE_SESSION_TTL_SECONDS,
+        }
+    return {}
+
+
 @app.route('/api/device/session/request', methods=['GET'])
 def api_device_session_request():
     """Request a device session. Returns challenge for secure flow, or direct token if skip_challenge=true."""
     try:
         device_id = sanitize_input(request.args.get('device_id') or '')
         skip_challenge = request.args.get('skip_challenge', 'false').lower() in ('true', '1', 'yes')
+        negotiate_key = request.args.get('negotiate_key', 'false').lower() in ('true', '1', 'yes')
         
         device_id_valid, device_id_error = validate_device_id(device_id)
         if not device_id_valid:
@@ -840,9 +924,7 @@ def api_device_session_request():
         
         # Multiple users can have the same device_id, so check all active sensors
         try:
-            all_sensors = list_sensors()
-            print(f"DEBUG: session/request for device_id='{device_id}' - Found {len(all_sensors or [])} total sensors in database", file=sys.stderr)
-            sys.stderr.flush()
+            all_matching = get_sensor_registry().get_sensors(device_id)
         except Exception as db_err:
             print(f"ERROR: Database error in session request: {db_err}", file=sys.stderr)
             import traceback
@@ -851,8 +933,6 @@ def api_device_session_request():
             return jsonify({"error": "Database error occurred"}), 500
         
         # Debug: show all sensors with matching device_id (case-insensitive)
-        device_id_lower = device_id.lower()
-        all_matching = [s for s in (all_sensors or []) if s.get('device_id', '').lower() == device_id_lower]
         print(f"DEBUG: session/request - Found {len(all_matching)} sensors with device_id='{device_id}' (case-insensitive)", file=sys.stderr)
         for s in all_matching:
             print(f"DEBUG:   - device_id='{s.get('device_id')}', status='{s.get('status')}', user_id={s.get('user_id')}", file=sys.stderr)
@@ -887,16 +967,20 @@ def api_device_session_request():
                 # Try to create session in database (pass TTL seconds, not datetime)
                 if create_device_session(candidate, device_id, expires_at_ttl):
                     session_token = candidate
+                    remember_device_session(session_token, device_id, expires_at_ttl)
                     break
             
             if not session_token:
                 return jsonify({"error": "failed to generate unique session token"}), 500
             
-            return jsonify({
+            response = {
                 "session_token": session_token,
                 "device_id": device_id,
                 "expires_in_seconds": DEVICE_SESSION_TTL_SECONDS,
-            })
+            }
+            if negotiate_key:
+                response.update(_negotiate_session_key(session_token, device_id, matching_sensors))
+            return jsonify(response)
         
         # Default: Issue challenge - signature verification in establish will identify which sensor
         try:
@@ -928,6 +1012,7 @@ def api_device_session_establish():
     device_id = sanitize_input(data.get('device_id') or '')
     challenge_id = sanitize_input(data.get('challenge_id') or '')
     signature_b64 = (data.get('signature') or '').strip()
+    negotiate_key = str(data.get('negotiate_key', 'false')).lower() in ('true', '1', 'yes')
     
     # Validate device_id
     device_id_valid, device_id_error = validate_device_id(device_id)
@@ -941,27 +1026,20 @@ def api_device_session_establish():
         return jsonify({"error": "Invalid signature."}), 400
     # Multiple users can have the same device_id, match by signature
     try:
-        all_sensors = list_sensors()
-        if all_sensors is None:
-            all_sensors = []
-        print(f"DEBUG: session/establish - list_sensors() returned {len(all_sensors)} total sensors", file=sys.stderr)
+        all_matching = get_sensor_registry().get_sensors(device_id)
     except Exception as db_err:
-        print(f"ERROR: Database error in session/establish list_sensors(): {db_err}", file=sys.stderr)
+        print(f"ERROR: Database error in session/establish sensor lookup: {db_err}", file=sys.stderr)
         import traceback
         traceback.print_exc(file=sys.stderr)
         sys.stderr.flush()
         return jsonify({"error": "Database error occurred"}), 500
     
-    device_id_lower = device_id.lower()
-    matching_sensors = [s for s in all_sensors if s.get('device_id', '').lower() == device_id_lower and s.get('status') == 'active']
+    matching_sensors = [s for s in all_matching if s.get('status') == 'active']
     
     if not matching_sensors:
         # Debug: show what was found
-        all_matching = [s for s in all_sensors if s.get('device_id', '').lower() == device_id_lower]
         print(f"DEBUG: session/establish for device_id='{device_id}' - Found {len(all_matching)} sensors, {len(matching_sensors)} active", file=sys.stderr)
-        print(f"DEBUG: session/establish - Total sensors in database: {len(all_sensors)}", file=sys.stderr)
-        if len(all_sensors) > 0:
-            print(f"DEBUG: session/establish - Sample sensor device_ids: {[s.get('device_id') for s in all_sensors[:5]]}", file=sys.stderr)
+        print(f"DEBUG: session/establish - Total sensors in registry: {get_sensor_registry().size()}", file=sys.stderr)
         for s in all_matching:
             print(f"DEBUG:   - device_id='{s.get('device_id')}', status='{s.get('status')}', user_id={s.get('user_id')}", file=sys.stderr)
         sys.stderr.flush()
@@ -993,41 +1071,15 @@ def api_device_session_establish():
     verification_errors = []
     for candidate_sensor in matching_sensors:
         try:
-            db_pub_key = candidate_sensor.get('public_key')
             sensor_user_id = candidate_sensor.get('user_id')
-            key_source = "database"
+            public_key, key_source = _load_sensor_public_key(candidate_sensor, device_id)
             
-            # If not in database, try multiple fallback locations
-            if not db_pub_key:
-                # Try user-specific locations first
-                if sensor_user_id:
-                    # Check user_keys/{user_id}/{device_id}_public.pem
-                    user_key_path = get_user_key_file(sensor_user_id, device_id)
-                    if os.path.exists(user_key_path):
-                        db_pub_key = open(user_key_path, "rb").read().decode('utf-8')
-                        key_source = f"user_keys/{sensor_user_id}/{device_id}_public.pem"
-                    
-                    # Also check sensor_keys/{user_id}/{device_id}/sensor_public.pem
-                    if not db_pub_key:
-                        sensor_pub_path_user = os.path.join(os.path.dirname(__file__), "sensor_keys", str(sensor_user_id), device_id, "sensor_public.pem")
-                        if os.path.exists(sensor_pub_path_user):
-                            db_pub_key = open(sensor_pub_path_user, "rb").read().decode('utf-8')
-                            key_source = f"sensor_keys/{sensor_user_id}/{device_id}/sensor_public.pem"
-                
-                # Fallback to global location (legacy)
-                if not db_pub_key:
-                    sensor_pub_path = os.path.join(os.path.dirname(__file__), "sensor_keys", device_id, "sensor_public.pem")
-                    if os.path.exists(sensor_pub_path):
-                        db_pub_key = open(sensor_pub_path, "rb").read().decode('utf-8')
-                        key_source = f"sensor_keys/{device_id}/sensor_public.pem"
-            
-            if not db_pub_key:
+            if public_key is None:
                 verification_errors.append(f"user_id={sensor_user_id}: No public key found in database or filesystem")
                 continue
             
-            public_key = RSA.import_key(db_pub_key.encode('utf-8'))
-            h = SHA256.new((challenge or '').encode('utf-8'))
-            pkcs1_15.new(public_key).verify(h, base64.b64decode(signature_b64))
+            # RSA (PKCS#1 v1.5 over SHA-256) or Ed25519, by the sensor's key type
+            verify_signature(public_key, (challenge or '').encode('utf-8'), base64.b64decode(signature_b64))
             # Signature verified! This is the correct sensor
             print(f"Session establish: Signature verified for {device_id} (user_id={sensor_user_id}, key_source={key_source})")
             srow = candidate_sensor
@@ -1062,15 +1114,19 @@ def api_device_session_establish():
             # Try to create session in database (pass TTL seconds, not datetime)
             if create_device_session(candidate, device_id, expires_at_ttl):
                 session_token = candidate
+                remember_device_session(session_token, device_id, expires_at_ttl)
                 break
     
     if not session_token:
         return jsonify({"error": "failed to generate unique session token"}), 500
-    return jsonify({
+    response = {
         "session_token": session_token,
         "device_id": device_id,
         "expires_in_seconds": DEVICE_SESSION_TTL_SECONDS,
-    })
+    }
+    if negotiate_key:
+        response.update(_negotiate_session_key(session_token, device_id, [srow]))
+    return jsonify(response)
 
 
 @app.route('/api/provision/request', methods=['POST'])
@@ -1459,10 +1515,10 @@ def _send_provision_message(action: str):
     publish_kwargs = None
     
     try:
-        print(f"[Provision {action_title}] Attempting to import paho.mqtt.publish...", file=sys.stderr)
+        print(f"[Provision {action_title}] Attempting to import paho.mqtt.client...", file=sys.stderr)
         sys.stderr.flush()
-        import paho.mqtt.publish as publish
-        print(f"[Provision {action_title}] ✅ paho.mqtt.publish imported successfully", file=sys.stderr)
+        import paho.mqtt.client  # noqa: F401
+        print(f"[Provision {action_title}] ✅ paho.mqtt.client imported successfully", file=sys.stderr)
         sys.stderr.flush()
         
         app.logger.error("=" * 80)
@@ -1598,35 +1654,28 @@ def _send_provision_message(action: str):
             return jsonify({"error": error_msg, "details": str(validation_err)}), 500
         
         try:
-            # Add keepalive and client_id to kwargs if not present
-            if 'keepalive' not in publish_kwargs:
-                publish_kwargs['keepalive'] = 60
-            if 'client_id' not in publish_kwargs:
-                publish_kwargs['client_id'] = f"flask_provision_{action}_{device_id}_{int(time.time())}"
-            
-            app.logger.error(f"[Provision {action_title}] ====== ABOUT TO CALL publish.single() ======")
+            app.logger.error(f"[Provision {action_title}] ====== ABOUT TO PUBLISH (pooled MQTT client) ======")
             app.logger.error(f"[Provision {action_title}] Publishing to topic: {topic}")
             app.logger.error(f"[Provision {action_title}] Payload: {payload}")
             app.logger.error(f"[Provision {action_title}] MQTT Host: {publish_kwargs.get('hostname')}:{publish_kwargs.get('port')}")
             app.logger.error(f"[Provision {action_title}] MQTT User: {publish_kwargs.get('auth', {}).get('username', 'NONE')}")
-            print(f"[Provision {action_title}] ====== ABOUT TO CALL publish.single() ======", file=sys.stderr)
+            print(f"[Provision {action_title}] ====== ABOUT TO PUBLISH (pooled MQTT client) ======", file=sys.stderr)
             print(f"[Provision {action_title}] Publishing to topic: {topic}", file=sys.stderr)
             print(f"[Provision {action_title}] Payload: {payload}", file=sys.stderr)
             print(f"[Provision {action_title}] MQTT Host: {publish_kwargs.get('hostname')}:{publish_kwargs.get('port')}", file=sys.stderr)
             print(f"[Provision {action_title}] MQTT User: {publish_kwargs.get('auth', {}).get('username', 'NONE')}", file=sys.stderr)
             sys.stderr.flush()
             
-            # Call publish.single() directly
-            # Note: publish.single() doesn't return a value - it raises an exception on failure
-            publish.single(topic, payload, qos=1, **publish_kwargs)
+            # Reuses a connected client from the pool; raises if the broker does not ack
+            get_mqtt_publisher().publish(topic, payload, qos=1)
             
-            app.logger.error(f"[Provision {action_title}] ====== publish.single() COMPLETED SUCCESSFULLY ======")
+            app.logger.error(f"[Provision {action_title}] ====== MQTT publish COMPLETED SUCCESSFULLY ======")
             app.logger.error(f"[Provision {action_title}] ✅ Message published to MQTT broker")
             app.logger.error(f"[Provision {action_title}] 💡 If provision agent doesn't receive it, check:")
             app.logger.error(f"[Provision {action_title}]    1. Provision agent is running and connected")
             app.logger.error(f"[Provision {action_title}]    2. Provision agent subscribed to: {topic_base}/+/{action}")
             app.logger.error(f"[Provision {action_title}]    3. MQTT broker ACL allows user to publish to this topic")
-            print(f"[Provision {action_title}] ====== publish.single() COMPLETED SUCCESSFULLY ======", file=sys.stderr)
+            print(f"[Provision {action_title}] ====== MQTT publish COMPLETED SUCCESSFULLY ======", file=sys.stderr)
             print(f"[Provision {action_title}] ✅ Message published to MQTT broker", file=sys.stderr)
             print(f"[Provision {action_title}] 💡 If provision agent doesn't receive it, check:", file=sys.stderr)
             print(f"[Provision {action_title}]    1. Provision agent is running and connected", file=sys.stderr)
@@ -1812,16 +1861,9 @@ def compute_safety(values: dict, thresholds: dict):
     return len(reasons) == 0, reasons
 
 def _build_type_defaults_map():
-    """Return {'ph': {'min': x, 'max': y}, ...} from sensor_type table."""
+    """Return {'ph': {'min': x, 'max': y}, ...} from sensor_type table (cached, read-only)."""
     try:
-        result = {}
-        for t in list_sensor_types() or []:
-            type_name = (t.get('type_name') or '').lower()
-            result[type_name] = {
-                'min': t.get('default_min'),
-                'max': t.get('default_max'),
-            }
-        return result
+        return get_threshold_cache().type_defaults()
     except Exception:
         return {}
 
@@ -1830,368 +1872,298 @@ def build_effective_thresholds_for_sensor(sensor_id: Optional[str]):
 
     Returns a mapping suitable for compute_safety. If sensor is known and has
     device_type 'ph', returns {'ph': {'min': ..., 'max': ...}}. If sensor is
-    unknown, falls back to all type defaults.
+    unknown, falls back to all type defaults. Served from the precomputed
+    table in threshold_cache (read-only).
     """
-    type_defaults = _build_type_defaults_map()
-    if not sensor_id:
-        return type_defaults
     try:
-        sensor = get_sensor_by_device_id(sensor_id)
+        return get_threshold_cache().for_device(sensor_id)
     except Exception:
-        sensor = None
-    if not sensor:
-        return type_defaults
-    device_type = sensor.get('device_type')
-    if not device_type:
-        return type_defaults
-    device_type_key = (device_type or '').lower()
-    default_for_type = (type_defaults.get(device_type_key) or {})
-    min_eff = sensor.get('min_threshold')
-    max_eff = sensor.get('max_threshold')
-    if min_eff is None:
-        min_eff = default_for_type.get('min')
-    if max_eff is None:
-        max_eff = default_for_type.get('max')
-    # Return thresholds keyed by normalized metric name to match values keys
-    return {device_type_key: {'min': min_eff, 'max': max_eff}}
+        return _build_type_defaults_map()
+
+
+def _verify_device_signature(device_id, signature_b64, signed_bytes):
+    """Return the active sensor row whose public key verifies the signature, or None."""
+    candidates = get_sensor_registry().get_sensors(device_id, active_only=True)
+    crypto = get_crypto_executor()
+    if crypto.enabled and candidates:
+        # One batched submit checks every candidate key in the crypto pool
+        keyed = [(row, _resolve_sensor_public_key_pem(row, device_id)[0]) for row in candidates]
+        keyed = [(row, pem) for row, pem in keyed if pem]
+        try:
+            signature = base64.b64decode(signature_b64)
+        except Exception:
+            return None
+        index = crypto.verify_any([pem for _, pem in keyed], signed_bytes, signature)
+        return keyed[index][0] if index is not None else None
+    for candidate_sensor in candidates:
+        try:
+            public_key, _key_source = _load_sensor_public_key(candidate_sensor, device_id)
+            if public_key is None:
+                continue
+            verify_signature(public_key, signed_bytes, base64.b64decode(signature_b64))
+            return candidate_sensor
+        except Exception:
+            # Signature doesn't match this sensor's key, try next one
+            continue
+    return None
+
+
+def _set_latest_data(sensor_user_id, data: dict):
+    """Publish the aggregate latest view (user-specific and legacy global)."""
+    global latest_data
+    if sensor_user_id:
+        user_latest_data[sensor_user_id] = data
+    # Also update global for backward compatibility
+    latest_data = data
+
+
+# Shared by /submit-data, /submit-data/batch and the MQTT sensor subscriber
+ingest_pipeline = IngestPipeline(
+    latest_by_metric=latest_by_metric,
+    latest_by_sensor=latest_by_sensor,
+    user_latest_by_metric=user_latest_by_metric,
+    user_latest_by_sensor=user_latest_by_sensor,
+    user_latest_data=user_latest_data,
+    set_latest_data=_set_latest_data,
+    validate_session=_validate_device_session,
+    build_thresholds=build_effective_thresholds_for_sensor,
+    type_defaults=_build_type_defaults_map,
+    compute_safety=compute_safety,
+    insert_sensor_data=insert_sensor_data,
+    verify_signature=_verify_device_signature,
+    private_key_path=PRIVATE_KEY_PATH,
+    require_session=REQUIRE_DEVICE_SESSION,
+)
+
+
+def _too_many_requests(reason, retry_after):
+    """429 response for requests shed by admission control."""
+    return (
+        jsonify({"status": "error", "message": f"Too many requests: {reason}"}),
+        429,
+        {"Retry-After": get_admission_controller().retry_after_header(retry_after)},
+    )
 
 
 @app.route('/submit-data', methods=['POST'])
 def submit_data():
-    global latest_data, latest_by_metric, latest_by_sensor, user_latest_data, user_latest_by_metric, user_latest_by_sensor
     # Safely parse JSON body; return 400 if missing or not an object to avoid 500s
     encrypted_payload = request.get_json(force=False, silent=True) or {}
     if not isinstance(encrypted_payload, dict):
         return jsonify({"status": "error", "message": "Invalid JSON payload."}), 400
+    # Shed floods on the plaintext sensor_id before any decryption work
+    admission = get_admission_controller()
+    admitted, reason, retry_after = admission.admit(encrypted_payload.get("sensor_id"))
+    if not admitted:
+        return _too_many_requests(reason, retry_after)
     try:
-        # Extract and remove SHA-256 hash from payload
-        sha256_hash = encrypted_payload.pop("sha256", None)
-        decrypted_data = decrypt_data(encrypted_payload, PRIVATE_KEY_PATH)
-        # Compute SHA-256 hash of decrypted data and compare
-        if decrypted_data:
-            data_json = json.dumps(decrypted_data, sort_keys=True).encode()
-            print("Server JSON string:", data_json)
-            computed_hash = hashlib.sha256(data_json).hexdigest()
-            print("Computed SHA-256 hash:", computed_hash)
-            if sha256_hash and computed_hash != sha256_hash:
-                return jsonify({"status": "error", "message": "SHA-256 hash mismatch! Data integrity compromised."}), 400
-
-            # Enforce: only registered ACTIVE sensors may submit, with valid signature
-            sensor_id = encrypted_payload.get("sensor_id")
-            signature_b64 = encrypted_payload.get("signature")
-            if not sensor_id or not signature_b64:
-                return jsonify({"status": "error", "message": "sensor_id and signature are required."}), 400
-
-            # Look up sensor(s) in DB - multiple users can have the same device_id
-            # We'll match by device_id + public_key signature
-            all_sensors_with_id = list_sensors()
-            matching_sensors = [s for s in all_sensors_with_id if s.get('device_id', '').lower() == sensor_id.lower()]
-            
-            if not matching_sensors:
-                return jsonify({"status": "error", "message": f"Unregistered sensor_id '{sensor_id}'."}), 403
-            
-            # Cross-check payload identity
-            payload_device_id = decrypted_data.get("device_id")
-            if payload_device_id and payload_device_id.lower() != sensor_id.lower():
-                return jsonify({"status": "error", "message": "device_id in payload does not match sensor_id."}), 400
-
-            # Try to verify signature against each matching sensor's public key
-            # This identifies which user's sensor this data belongs to
-            sensor_row = None
-            signature_verified = False
-            
-            for candidate_sensor in matching_sensors:
-                if candidate_sensor.get('status') != 'active':
-                    continue
-                
-                # Verify signature using this sensor's public key
-                try:
-                    db_pub_key = candidate_sensor.get('public_key')
-                    sensor_user_id = candidate_sensor.get('user_id')
-                    
-                    # If not in database, try multiple fallback locations
-                    if not db_pub_key:
-                        # Try user-specific locations first
-                        if sensor_user_id:
-                            # Check user_keys/{user_id}/{device_id}_public.pem
-                            user_key_path = get_user_key_file(sensor_user_id, sensor_id)
-                            if os.path.exists(user_key_path):
-                                db_pub_key = open(user_key_path, "rb").read().decode('utf-8')
-                            
-                            # Also check sensor_keys/{user_id}/{device_id}/sensor_public.pem
-                            if not db_pub_key:
-                                sensor_pub_path_user = os.path.join(os.path.dirname(__file__), "sensor_keys", str(sensor_user_id), sensor_id, "sensor_public.pem")
-                                if os.path.exists(sensor_pub_path_user):
-                                    db_pub_key = open(sensor_pub_path_user, "rb").read().decode('utf-8')
-                        
-                        # Fallback to global location (legacy)
-                        if not db_pub_key:
-                            sensor_pub_path = os.path.join(os.path.dirname(__file__), "sensor_keys", sensor_id, "sensor_public.pem")
-                            if os.path.exists(sensor_pub_path):
-                                db_pub_key = open(sensor_pub_path, "rb").read().decode('utf-8')
-                    
-                    if db_pub_key:
-                        public_key = RSA.import_key(db_pub_key.encode('utf-8'))
-                        h = SHA256.new(data_json)
-                        pkcs1_15.new(public_key).verify(h, base64.b64decode(signature_b64))
-                        # Signature verified! This is the correct sensor
-                        sensor_row = candidate_sensor
-                        signature_verified = True
-                        break
-                except Exception:
-                    # Signature doesn't match this sensor's key, try next one
-                    continue
-            
-            if not signature_verified or not sensor_row:
-                return jsonify({"status": "error", "message": "Invalid sensor signature or no matching active sensor found."}), 400
-            
-            # Cross-check device_type (case-insensitive, and allow None/empty to pass)
-            payload_device_type = decrypted_data.get("device_type")
-            sensor_device_type = sensor_row.get('device_type', '').strip()
-            if payload_device_type and sensor_device_type:
-                # Normalize both to lowercase for comparison
-                payload_type_lower = str(payload_device_type).lower().strip()
-                sensor_type_lower = str(sensor_device_type).lower().strip()
-                if payload_type_lower != sensor_type_lower:
-                    # sys is imported at top of file, safe to use here
-                    import sys
-                    print(f"WARNING: device_type mismatch for {sensor_id}: payload='{payload_device_type}' vs db='{sensor_device_type}'", file=sys.stderr)
-                    sys.stderr.flush()
-                    return jsonify({
-                        "status": "error", 
-                        "message": f"device_type mismatch for sensor. Expected '{sensor_device_type}', got '{payload_device_type}'"
-                    }), 400
-
-            # Device session validation - validate and update session every time before storing
-            session_token = decrypted_data.get('session_token')
-            session_counter = decrypted_data.get('counter')
-            if REQUIRE_DEVICE_SESSION:
-                # Sessions are required - reject if invalid
-                ok, reason = _validate_device_session(session_token, sensor_id, session_counter)
-                if not ok:
-                    return jsonify({"status": "error", "message": f"Device session error: {reason}"}), 401
-            elif session_token:
-                # Sessions are optional but provided - validate and update it
-                ok, reason = _validate_device_session(session_token, sensor_id, session_counter)
-                if not ok:
-                    # Log warning but don't reject (sessions optional)
-                    import sys
-                    print(f"HTTP Sensor: Device session warning for {sensor_id}: {reason} (continuing anyway)", file=sys.stderr)
-
-        # Get user_id from sensor_row to store data per user
-        sensor_user_id = sensor_row.get('user_id')
-        
-        # Initialize user-specific dictionaries if needed
-        if sensor_user_id:
-            if sensor_user_id not in user_latest_by_metric:
-                user_latest_by_metric[sensor_user_id] = {}
-            if sensor_user_id not in user_latest_by_sensor:
-                user_latest_by_sensor[sensor_user_id] = {}
-            if sensor_user_id not in user_latest_data:
-                user_latest_data[sensor_user_id] = {}
-        
-        # Update per-metric latest cache using this sensor's reading(s)
-        updated_values = {}
-        # Include all supported sensor types
-        supported_metrics = [
-            "tds", "ph", "turbidity", "temperature", "dissolved_oxygen", "conductivity",
-            "ammonia", "pressure", "nitrate", "nitrite", "orp", "chlorine", "salinity", "flow"
-        ]
-        for k in supported_metrics:
-            if k in decrypted_data and decrypted_data[k] not in (None, ""):
-                try:
-                    val = float(decrypted_data[k])
-                    updated_values[k] = val
-                    # Update user-specific cache
-                    if sensor_user_id:
-                        user_latest_by_metric[sensor_user_id][k] = {
-                            "value": val,
-                            "sensor_id": sensor_id,
-                        }
-                    # Also update global for backward compatibility
-                    latest_by_metric[k] = {
-                        "value": val,
-                        "sensor_id": sensor_id,
-                    }
-                except Exception:
-                    pass
+        msg = ingest_pipeline.process(IngestMessage('http', encrypted_payload))
+    except IngestError as e:
+        return jsonify({"status": "error", "message": e.message}), e.http_status
+    finally:
+        admission.release()
+    if msg.duplicate:
+        # Already stored (device retry or redelivery): acknowledge without reprocessing
+        return jsonify({"status": "duplicate", "message": "Reading already received."})
+    return jsonify({
+        "status": "success",
+        "safe_to_drink": msg.safe,
+        **({"reasons": msg.reasons} if not msg.safe else {"note": "Water meets safety standards."})
+    })
 
-        # Build aggregate values across metrics we have (snapshot to avoid concurrent mutation)
-        # Use user-specific data if available, otherwise fall back to global
-        if sensor_user_id and sensor_user_id in user_latest_by_metric:
-            _lbm_snapshot = list(user_latest_by_metric[sensor_user_id].items())
-        else:
-            _lbm_snapshot = list(latest_by_metric.items())
-        agg_values = {k: v.get("value") for k, v in _lbm_snapshot if v and v.get("value") is not None}
+# Upper bound on readings accepted in one /submit-data/batch request
+BATCH_MAX_READINGS = int(os.environ.get('BATCH_MAX_READINGS', '500'))
 
-        # Build aggregate thresholds using the sensor id associated with each metric (snapshot)
-        agg_thresholds = {}
-        for metric, entry in _lbm_snapshot:
-            sid = (entry or {}).get("sensor_id")
-            tmap = build_effective_thresholds_for_sensor(sid)
-            if tmap and metric in tmap:
-                agg_thresholds[metric] = tmap[metric]
-        # Fallback to defaults for any metric without sensor context
-        for metric in agg_values.keys():
-            if metric not in agg_thresholds:
-                defaults = _build_type_defaults_map()
-                if metric in defaults:
-                    agg_thresholds[metric] = defaults[metric]
 
-        # Evaluate safety across the available metrics
-        safe, reasons = compute_safety(agg_values, agg_thresholds)
+@app.route('/submit-data/batch', methods=['POST'])
+def submit_data_batch():
+    """Ingest many readings from a gateway under one hybrid envelope.
+
+    Request body: the same envelope as /submit-data (session_key, nonce,
+    ciphertext, tag, optional sha256). The decrypted JSON is
+    {"devices": [{"sensor_id", "signature", "payload"}]} where payload is
+    {"device_id", "device_type", "session_token", "counter", "readings": [{metric: value, "seq"?}, ...]}
+    and signature is the device signature (RSA or Ed25519) over json.dumps(payload, sort_keys=True).
+    Items whose counter (or readings whose seq) were already stored are
+    reported as "duplicate" and not stored again.
+
+    The envelope is unwrapped once, each device signature is verified once,
+    compute_safety runs per reading, and all rows are stored with one
+    multi-row INSERT. The response reports a status per reading.
+    """
+    encrypted_payload = request.get_json(force=False, silent=True) or {}
+    if not isinstance(encrypted_payload, dict):
+        return jsonify({"status": "error", "message": "Invalid JSON payload."}), 400
+    # Gateway batches carry no plaintext sensor_id: charge the caller before the
+    # unwrap, and each item's device and owner before its signature check
+    admission = get_admission_controller()
+    admitted, reason, retry_after = admission.admit(gateway=request.remote_addr or 'unknown')
+    if not admitted:
+        return _too_many_requests(reason, retry_after)
+    try:
+        return _submit_data_batch(encrypted_payload)
+    finally:
+        admission.release()
 
-        # Persist the latest reading to MySQL
-        # Note: Using sensor_data table only (water_readings table removed)
-        # Aggregated readings are stored via individual sensor_data entries
-        # try:
-        #     tds_v = agg_values.get("tds")
-        #     ph_v = agg_values.get("ph")
-        #     turbidity_v = agg_values.get("turbidity")
-        #     insert_reading(tds_v, ph_v, turbidity_v, safe, reasons)
-        # except Exception as db_err:
-        #     print(f"MySQL write error: {db_err}")
-
-        # Update per-sensor latest map (stores the value for the sensor's type)
+
+def _submit_data_batch(encrypted_payload):
+    try:
+        with ingest_pipeline.timed('decode'):
+            sha256_hash = encrypted_payload.pop("sha256", None)
+            batch = get_crypto_executor().decrypt_envelope(encrypted_payload, PRIVATE_KEY_PATH)
+    except Exception as e:
+        ingest_log.error("submit_data_batch: Decryption error: %s", e)
+        return jsonify({"status": "error", "message": f"Decryption error: {str(e)}"}), 400
+    if not isinstance(batch, dict) or not isinstance(batch.get("devices"), list):
+        return jsonify({"status": "error", "message": "Batch payload must contain a 'devices' list."}), 400
+    if sha256_hash:
+        computed_hash = hashlib.sha256(json.dumps(batch, sort_keys=True).encode()).hexdigest()
+        if computed_hash != sha256_hash:
+            return jsonify({"status": "error", "message": "SHA-256 hash mismatch! Data integrity compromised."}), 400
+    total_readings = sum(len((d.get("payload") or {}).get("readings") or []) for d in batch["devices"] if isinstance(d, dict))
+    if total_readings > BATCH_MAX_READINGS:
+        return jsonify({"status": "error", "message": f"Batch too large: {total_readings} readings (max {BATCH_MAX_READINGS})."}), 413
+
+    results = []
+    pending_rows = []  # (result index, row) for the multi-row INSERT
+    stored_sequences = []  # (sensor_db_id, sequence) to mark once the INSERT succeeds
+    for device_index, item in enumerate(batch["devices"]):
+        item = item if isinstance(item, dict) else {}
+        sensor_id = item.get("sensor_id")
+        signature_b64 = item.get("signature")
+        device_payload = item.get("payload")
+        readings = (device_payload or {}).get("readings") if isinstance(device_payload, dict) else None
+
+        def _fail(message):
+            count = len(readings) if isinstance(readings, list) and readings else 1
+            for reading_index in range(count):
+                results.append({"device": device_index, "reading": reading_index, "sensor_id": sensor_id,
+                                "status": "error", "message": message})
+
+        if not sensor_id or not signature_b64 or not isinstance(device_payload, dict):
+            _fail("sensor_id, signature and payload are required.")
+            continue
+        if not isinstance(readings, list) or not readings:
+            _fail("payload.readings must be a non-empty list.")
+            continue
+        payload_device_id = device_payload.get("device_id")
+        if payload_device_id and str(payload_device_id).lower() != str(sensor_id).lower():
+            _fail("device_id in payload does not match sensor_id.")
+            continue
+
+        admitted, reason, _ = get_admission_controller().charge_device(sensor_id)
+        if not admitted:
+            _fail(f"Too many requests: {reason}")
+            continue
+
+        msg = IngestMessage('http', None)
+        msg.sensor_id = sensor_id
         try:
-            device_type = sensor_row.get('device_type')
-            value_for_type = None
-
-            # Determine value corresponding to device_type (case-insensitive)
-            if device_type:
-                device_type_lower = str(device_type).lower().strip()
-                # Try case-insensitive match first (handles both "Chlorine" and "chlorine")
-                for key, val in updated_values.items():
-                    if key and str(key).lower().strip() == device_type_lower:
-                        value_for_type = val
-                        break
-                # If no match found, try exact match as fallback
-                if value_for_type is None and device_type in updated_values:
-                    value_for_type = updated_values.get(device_type)
-
-            # Fallback: take the first available metric if still None
-            if value_for_type is None and len(updated_values) > 0:
-                value_for_type = next(iter(updated_values.values()))
-                import sys
-                msg = f"INFO: Using fallback value for device_id: {sensor_id}, device_type: {device_type}, available_keys: {list(updated_values.keys())}\n"
-                print(msg, file=sys.stderr)
-                sys.stderr.flush()
+            with ingest_pipeline.timed('authenticate'):
+                msg.sensor_row = _verify_device_signature(sensor_id, signature_b64, json.dumps(device_payload, sort_keys=True).encode())
+                if not msg.sensor_row:
+                    raise IngestError("Invalid sensor signature or no matching active sensor found.")
+                ingest_pipeline.check_device_type(msg.sensor_row, device_payload.get("device_type"))
+        except IngestError as e:
+            _fail(e.message)
+            continue
 
-            # Map computed safety into table status enum
-            status_label = 'normal'
-            if not safe:
-                status_label = 'warning' if reasons else 'warning'
+        # A retried batch item (same session counter or seq) is acknowledged, not re-ingested;
+        # the signature picked the owner, so the window is that sensor's
+        sensor_db_id = msg.sensor_row.get('id')
+        item_sequence = reading_sequence(device_payload)
+        reading_sequences = [reading_sequence({'seq': r.get('seq')}) if isinstance(r, dict) else None for r in readings]
+        with ingest_pipeline.timed('dedup'):
+            item_duplicate = ingest_pipeline.sequences.is_duplicate(sensor_db_id, item_sequence)
+            duplicates = [item_duplicate or ingest_pipeline.sequences.is_duplicate(sensor_db_id, seq) for seq in reading_sequences]
+        if all(duplicates):
+            for reading_index in range(len(readings)):
+                results.append({"device": device_index, "reading": reading_index, "sensor_id": sensor_id,
+                                "status": "duplicate"})
+            continue
 
-            # Write one row to sensor_data for this sensor
-            try:
-                import sys
-                sensor_db_id = sensor_row.get('id')
-                if sensor_db_id is None:
-                    msg = f"ERROR: sensor_row.get('id') is None for device_id: {sensor_id}. Cannot insert sensor data.\n"
-                    print(msg, file=sys.stderr)
-                    sys.stderr.flush()
-                    app_logger.error(msg)
-                elif value_for_type is None:
-                    msg = f"ERROR: value_for_type is None for device_id: {sensor_id}, device_type: {device_type}, updated_values: {updated_values}\n"
-                    print(msg, file=sys.stderr)
-                    sys.stderr.flush()
-                    app_logger.error(msg)
-                else:
-                    msg = f"DEBUG: Attempting insert_sensor_data - device_id: {sensor_id}, sensor_db_id: {sensor_db_id}, value: {value_for_type}, device_type: {device_type}\n"
-                    print(msg, file=sys.stderr)
-                    sys.stderr.flush()
-                    app_logger.error(msg)  # Using error level so it appears in log file
-                    
-                    result = insert_sensor_data(
-                        sensor_db_id=sensor_db_id, 
-                        value=value_for_type, 
-                        status=status_label,
-                        user_id=sensor_user_id,
-                        device_id=sensor_id
-                    )
-                    if not result:
-                        msg = f"ERROR: insert_sensor_data returned False for device_id: {sensor_id}, sensor_db_id: {sensor_db_id}\n"
-                        print(msg, file=sys.stderr)
-                        sys.stderr.flush()
-                        app_logger.error(msg)
-                    else:
-                        msg = f"SUCCESS: insert_sensor_data completed for device_id: {sensor_id}, sensor_db_id: {sensor_db_id}, value: {value_for_type}\n"
-                        print(msg, file=sys.stderr)
-                        sys.stderr.flush()
-                        app_logger.error(msg)  # Using error level so it appears in log file
-            except Exception as e:
-                import sys
-                import traceback
-                msg = f"ERROR: Failed to insert sensor_data for device_id: {sensor_id}, sensor_db_id: {sensor_row.get('id')}\n"
-                msg += f"ERROR: Exception: {e}\n"
-                msg += traceback.format_exc()
-                print(msg, file=sys.stderr)
-                sys.stderr.flush()
-                app_logger.error(msg)
-            
-            # Update user-specific cache
-            if sensor_user_id:
-                if sensor_user_id not in user_latest_by_sensor:
-                    user_latest_by_sensor[sensor_user_id] = {}
-                user_latest_by_sensor[sensor_user_id][sensor_id] = {
-                    'device_id': sensor_id,
-                    'device_type': device_type,
-                    'location': sensor_row.get('location'),
-                    'value': value_for_type,
-                }
-            # Also update global for backward compatibility
-            latest_by_sensor[sensor_id] = {
-                'device_id': sensor_id,
-                'device_type': device_type,
-                'location': sensor_row.get('location'),
-                'value': value_for_type,
+        try:
+            with ingest_pipeline.timed('session'):
+                ingest_pipeline.check_session(msg, device_payload)
+        except IngestError as e:
+            _fail(e.message)
+            continue
+
+        sensor_user_id = msg.sensor_row.get('user_id')
+        device_type = msg.sensor_row.get('device_type')
+        item_rows_before = len(pending_rows)
+        for reading_index, reading in enumerate(readings):
+            entry = {"device": device_index, "reading": reading_index, "sensor_id": sensor_id}
+            if duplicates[reading_index]:
+                entry["status"] = "duplicate"
+                results.append(entry)
+                continue
+            # Readings without their own seq are keyed by the item's counter and position
+            sequence = reading_sequences[reading_index]
+            row_key = ingest_key(sequence) if sequence else ingest_key(item_sequence, str(reading_index))
+            with ingest_pipeline.timed('aggregate'):
+                updated_values = ingest_pipeline.apply_reading(sensor_user_id, sensor_id, reading if isinstance(reading, dict) else {})
+                value_for_type = ingest_pipeline.value_for_device_type(device_type, updated_values)
+            if value_for_type is None:
+                entry.update({"status": "error", "message": "No supported metric values in reading."})
+                results.append(entry)
+                continue
+            with ingest_pipeline.timed('evaluate'):
+                safe, reasons, agg_values = ingest_pipeline.evaluate_safety(sensor_user_id)
+            entry.update({"status": "accepted", "safe_to_drink": safe})
+            if not safe:
+                entry["reasons"] = reasons
+            results.append(entry)
+            row = {
+                "sensor_db_id": msg.sensor_row.get('id'),
+                "value": value_for_type,
+                "status": 'normal' if safe else 'warning',
+                "user_id": sensor_user_id,
+                "device_id": sensor_id,
+                "ingest_key": row_key,
             }
-        except Exception as e:
-            import sys
-            import traceback
-            msg = f"ERROR: Exception in sensor data processing for device_id: {sensor_id}\n"
-            msg += f"ERROR: {e}\n"
-            msg += traceback.format_exc()
-            print(msg, file=sys.stderr)
-            sys.stderr.flush()
+            pending_rows.append((len(results) - 1, row))
+            for metric, metric_value in ingest_pipeline.extra_metric_values(device_type, updated_values).items():
+                pending_rows.append((None, dict(row, value=metric_value, metric=metric,
+                                                ingest_key=f"{row_key}/{metric}" if row_key else None)))
+            stored_sequences.append((sensor_db_id, sequence))
+
+            msg.value_for_type = value_for_type
+            msg.agg_values = agg_values
+            ingest_pipeline.update_caches(msg)
+        # An item none of whose readings were stored must stay retryable
+        if len(pending_rows) > item_rows_before:
+            stored_sequences.append((sensor_db_id, item_sequence))
+
+    with ingest_pipeline.timed('persist'):
+        inserted = insert_sensor_data_batch([row for _, row in pending_rows]) if pending_rows else 0
+    if inserted:
+        for sensor_db_id, sequence in stored_sequences:
+            ingest_pipeline.sequences.mark(sensor_db_id, sequence)
+        heartbeats = get_heartbeat_tracker()
+        for device_id, user_id in {(row["device_id"], row["user_id"]) for _, row in pending_rows}:
+            heartbeats.touch(device_id, user_id)
+    for result_index, _row in pending_rows:
+        if result_index is None:
+            continue
+        if inserted:
+            results[result_index]["status"] = "stored"
+        else:
+            results[result_index]["status"] = "error"
+            results[result_index]["message"] = "Database write failed."
+
+    stored = sum(1 for r in results if r.get("status") == "stored")
+    duplicate = sum(1 for r in results if r.get("status") == "duplicate")
+    overall = "success" if stored + duplicate == len(results) else ("partial" if stored + duplicate else "error")
+    return jsonify({
+        "status": overall,
+        "stored": stored,
+        "duplicate": duplicate,
+        "total": len(results),
+        "results": results,
+    }), (200 if stored + duplicate else 400)
 
-        # Update live latest_data only after successful verification and processing (aggregate view)
-        # Include all supported metrics
-        latest_data_dict = {
-            "tds": agg_values.get("tds"),
-            "ph": agg_values.get("ph"),
-            "turbidity": agg_values.get("turbidity"),
-            "temperature": agg_values.get("temperature"),
-            "dissolved_oxygen": agg_values.get("dissolved_oxygen"),
-            "conductivity": agg_values.get("conductivity"),
-            "ammonia": agg_values.get("ammonia"),
-            "pressure": agg_values.get("pressure"),
-            "nitrate": agg_values.get("nitrate"),
-            "nitrite": agg_values.get("nitrite"),
-            "orp": agg_values.get("orp"),
-            "chlorine": agg_values.get("chlorine"),
-            "salinity": agg_values.get("salinity"),
-            "flow": agg_values.get("flow"),
-        }
-        # Update user-specific data
-        if sensor_user_id:
-            user_latest_data[sensor_user_id] = latest_data_dict
-        # Also update global for backward compatibility
-        latest_data = latest_data_dict
 
-        return jsonify({
-            "status": "success",
-            "safe_to_drink": safe,
-            **({"reasons": reasons} if not safe else {"note": "Water meets safety standards."})
-        })
-    except Exception as e:
-        import traceback
-        error_msg = f"Decryption error: {str(e)}"
-        # Log full traceback for debugging
-        print(f"ERROR in submit_data: {error_msg}", file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
-        sys.stderr.flush()
-        return jsonify({"status": "error", "message": error_msg}), 400
 @app.route('/favicon.ico')
 def favicon():
     """Handle favicon requests to prevent 500 errors."""
@@ -2208,6 +2180,7 @@ register_dashboard_routes(app, user_latest_by_metric)
 
 @app.route('/api/dashboard/location/<location>')
 @login_required
+@read_snapshot()
 def api_dashboard_location(location):
     """API endpoint to get sensor data for a specific location with date range filtering."""
     import sys
@@ -2722,14 +2695,14 @@ def api_active_sensors():
                         sensors_with_cache_data.add(device_id)
         
         # Always query database to get the latest readings (real-time data)
-        # Use the same function that history page uses (list_recent_sensor_data)
-        # This ensures consistency and reliability
+        # sensor_latest holds one row per sensor (and extra metric), so a
+        # quiet sensor is never hidden behind other sensors' recent readings
         print(f"DEBUG: api_active_sensors - Querying database for latest readings...", file=sys.stderr)
         sys.stderr.flush()
         
         try:
-            # Get recent sensor data from database (same as history page uses)
-            db_readings = list_recent_sensor_data(limit=100, user_id=user_id)
+            # Latest reading of each of the user's sensors
+            db_readings = list_latest_sensor_data(user_id=user_id)
             
             print(f"DEBUG: api_active_sensors - Retrieved {len(db_readings)} readings from database", file=sys.stderr)
             sys.stderr.flush()
@@ -2741,6 +2714,9 @@ def api_active_sensors():
                 device_id = reading.get('device_id')
                 if not device_id:
                     continue
+                # Extra metrics of multi-parameter payloads aren't the sensor's own value
+                if reading.get('metric'):
+                    continue
                 
                 # Get the most recent reading for each device
                 recorded_at = reading.get('recorded_at')
@@ -2756,7 +2732,7 @@ def api_active_sensors():
             # Clear cache-based sensors and rebuild from database
             active_sensors = []
             for device_id, reading in latest_by_device.items():
-                value = reading.get('value')  # Already decrypted by list_recent_sensor_data
+                value = reading.get('value')  # Already decrypted by list_latest_sensor_data
                 device_type = reading.get('device_type')
                 location = reading.get('location') or 'Unassigned'
                 
@@ -2823,6 +2799,11 @@ def api_active_sensors():
             app_logger.error(msg)
         sys.stderr.flush()
         
+        # Online status from the heartbeat map, else sensors.last_seen (heartbeat.py)
+        statuses = get_heartbeat_tracker().statuses(user_id, [s.get('device_id') for s in active_sensors])
+        for s in active_sensors:
+            s.update(statuses.get(s.get('device_id')) or {'online': False, 'last_seen': None})
+
         result = {
             'active_sensors': active_sensors
         }
@@ -2867,12 +2848,12 @@ def api_latest():
             print(f"DEBUG: api_latest - Cache empty, querying database for user {user_id}...", file=sys.stderr)
             sys.stderr.flush()
             
-            # Get latest readings from database (filter by location if specified)
+            # Get latest readings from database (filter by location if specified),
+            # newest first: one row per sensor and metric
             if location_filter:
-                from db import list_recent_sensor_data_by_location
-                db_readings = list_recent_sensor_data_by_location(location_filter, limit=100, user_id=user_id)
+                db_readings = list_latest_sensor_data(user_id=user_id, location=location_filter)
             else:
-                db_readings = list_recent_sensor_data(limit=100, user_id=user_id)
+                db_readings = list_latest_sensor_data(user_id=user_id)
             
             # Build metric data from database readings
             user_metric_data = {}
@@ -2892,7 +2873,7 @@ def api_latest():
                                 'value': float_value,
                                 'sensor_id': device_id
                             }
-                        latest_dict[device_type] = float_value
+                        latest_dict.setdefault(device_type, float_value)
                     except (ValueError, TypeError):
                         pass
             
@@ -2980,37 +2961,36 @@ def api_reading_request():
         failed_requests = []
         
         try:
-            import paho.mqtt.publish as publish
-            publish_kwargs = _get_mqtt_publish_kwargs()
+            import paho.mqtt.client  # noqa: F401
             
+            messages = []
+            device_ids = []
             for sensor in user_sensors:
                 device_id = sensor.get('device_id')
                 if not device_id:
                     continue
-                
-                try:
-                    # Create topic: reading_request/{device_id}/request
-                    topic = f"{topic_base}/{device_id}/request"
-                    
-                    # Create payload with location and device info
-                    payload = json.dumps({
-                        "device_id": device_id,
-                        "location": location,
-                        "action": "request",
-                        "user_id": str(user_id),
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                    
-                    # Publish MQTT message
-                    publish.single(topic, payload, qos=1, **publish_kwargs)
+                # Create topic: reading_request/{device_id}/request
+                topic = f"{topic_base}/{device_id}/request"
+                # Create payload with location and device info
+                payload = json.dumps({
+                    "device_id": device_id,
+                    "location": location,
+                    "action": "request",
+                    "user_id": str(user_id),
+                    "timestamp": datetime.utcnow().isoformat()
+                })
+                messages.append((topic, payload))
+                device_ids.append(device_id)
+            
+            # One pooled connection, all requests pipelined before waiting for the PUBACKs
+            errors = get_mqtt_publisher().publish_many(messages, qos=1)
+            for device_id, (topic, _), error in zip(device_ids, messages, errors):
+                if error:
+                    failed_requests.append({"device_id": device_id, "error": error})
+                    print(f"[Reading Request] ❌ Failed to send request for {device_id}: {error}")
+                else:
                     successful_requests += 1
-                    
                     print(f"[Reading Request] ✅ Sent MQTT message to {topic} for device {device_id} at location {location}")
-                    
-                except Exception as e:
-                    error_msg = f"Failed to send request for {device_id}: {str(e)}"
-                    failed_requests.append({"device_id": device_id, "error": str(e)})
-                    print(f"[Reading Request] ❌ {error_msg}")
             
             if successful_requests == 0:
                 return jsonify({
@@ -3044,6 +3024,7 @@ def api_reading_request():
 
 @app.route('/history')
 @login_required
+@read_snapshot()
 def history():
     """Display historical sensor readings."""
     user_id = session.get('user_id')
@@ -3193,18 +3174,7 @@ def history():
                              statuses=[],
                              sensor_rows=[])
 
-def compute_public_key_fingerprint(public_key_pem: str | None) -> str | None:
-    """Compute a short fingerprint from a public key PEM string."""
-    if not public_key_pem:
-        return None
-    try:
-        # Compute SHA-256 hash of the key
-        key_bytes = public_key_pem.encode('utf-8') if isinstance(public_key_pem, str) else public_key_pem
-        key_hash = hashlib.sha256(key_bytes).hexdigest()
-        # Return first 16 characters as fingerprint
-        return key_hash[:16].upper()
-    except Exception:
-        return None
+# compute_public_key_fingerprint is now in public_key_cache.py
 
 # Sensor routes are now in routes/sensors.py
 from routes.sensors import register_sensor_routes
@@ -3416,7 +3386,17 @@ def test_db_connection():
         }), 500
 
 
+# With a shared subscription group every server process (gunicorn/mod_wsgi
+# workers, other nodes) joins the group instead of only `python app.py`;
+# crypto executor children (spawned, so they re-import this module) do not
+if MQTT_SHARED_GROUP and __name__ != '__main__' and multiprocessing.parent_process() is None:
+    start_mqtt_key_subscriber()
+    start_mqtt_sensor_subscriber()
+
+
 if __name__ == '__main__':
+    # Warm the sensor registry so the first readings don't pay for the load
+    get_sensor_registry().refresh(force=True)
     # Start MQTT key subscriber if configured
     # Use wrapper function that calls extracted utility with app dependencies
     start_mqtt_key_subscriber()
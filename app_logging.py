@@ -0,0 +1,176 @@
+"""
+Non-blocking logging for the request and ingest hot paths.
+
+Handlers that write to flask_error.log and stderr flush on every record, which
+under load makes ingest latency depend on disk and pipe latency. configure_logging()
+installs a single QueueHandler on the root logger; a QueueListener thread owns
+the file and stderr handlers and does formatting and I/O off the request thread.
+
+Hot-path code logs through get_logger('<category>') (ingest, db, mqtt, request)
+with lazy %-style arguments, so disabled levels cost one isEnabledFor() check.
+
+Configuration:
+- LOG_LEVEL: root level (default INFO); DEBUG restores the old per-reading output
+- LOG_SAMPLE: per-category sampling of DEBUG/INFO records, e.g.
+  "ingest=0.01,mqtt=0.1" keeps 1 in 100 ingest and 1 in 10 mqtt records;
+  WARNING and above are never sampled
+- LOG_QUEUE_SIZE: bounded queue (default 10000); when full, DEBUG/INFO records
+  are dropped (and counted) instead of blocking the caller
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from typing import Optional
+
+
+LOG_LEVEL = (os.environ.get('LOG_LEVEL', 'INFO') or 'INFO').strip().upper()
+LOG_SAMPLE = os.environ.get('LOG_SAMPLE', '')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Hot-path loggers live under this prefix: iot.ingest, iot.db, iot.mqtt, ...
+LOGGER_PREFIX = 'iot'
+
+
+def _parse_sample_rates(spec: str) -> dict:
+    """Parse "ingest=0.01,mqtt=0.1" into {'ingest': 0.01, 'mqtt': 0.1}."""
+    rates = {}
+    for part in (spec or '').split(','):
+        if '=' not in part:
+            continue
+        name, _, rate = part.partition('=')
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            print(f"Logging: ignoring invalid LOG_SAMPLE entry '{part}'", file=sys.stderr)
+    return rates
+
+
+def _category(logger_name: str) -> str:
+    if logger_name.startswith(LOGGER_PREFIX + '.'):
+        return logger_name[len(LOGGER_PREFIX) + 1:].split('.', 1)[0]
+    return logger_name
+
+
+class SamplingFilter(logging.Filter):
+    """Keep every Nth DEBUG/INFO record per category (N = 1 / rate)."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._every = {name: (0 if rate <= 0 else max(1, round(1 / rate))) for name, rate in rates.items()}
+        self._seen = {}
+        self.sampled_out = {}
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING or not self._every:
+            return True
+        category = _category(record.name)
+        every = self._every.get(category)
+        if every is None or every == 1:
+            return True
+        with self._lock:
+            seen = self._seen.get(category, 0)
+            self._seen[category] = seen + 1
+            if every and seen % every == 0:
+                return True
+            self.sampled_out[category] = self.sampled_out.get(category, 0) + 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller for DEBUG/INFO records."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the listener thread; the queue is in-process,
+        # so the record can be handed over as-is
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            # Warnings and errors wait briefly rather than disappear
+            try:
+                self.queue.put(record, timeout=1.0)
+            except queue.Full:
+                self.dropped += 1
+                return
+        self.enqueued += 1
+
+
+_configure_lock = threading.Lock()
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_sampling_filter: Optional[SamplingFilter] = None
+
+
+def configure_logging(log_file: Optional[str] = None, level: Optional[str] = None):
+    """Route the root logger through a queue to file/stderr handlers.
+
+    Safe to call more than once; only the first call installs handlers.
+
+    Args:
+        log_file: File to append records to (stderr only if None)
+        level: Root level name; defaults to LOG_LEVEL
+    """
+    global _queue_handler, _listener, _sampling_filter
+    with _configure_lock:
+        if _listener is not None:
+            return
+        formatter = logging.Formatter(LOG_FORMAT)
+        handlers = []
+        if log_file:
+            try:
+                handlers.append(logging.FileHandler(log_file))
+            except OSError as e:
+                print(f"Logging: cannot open {log_file}: {e}", file=sys.stderr)
+        handlers.append(logging.StreamHandler())  # stderr (goes to Apache/gunicorn error log)
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        _sampling_filter = SamplingFilter(_parse_sample_rates(LOG_SAMPLE))
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE)))
+        _queue_handler.addFilter(_sampling_filter)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_queue_handler)
+        root.setLevel(getattr(logging, (level or LOG_LEVEL).upper(), logging.INFO))
+
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(category: str) -> logging.Logger:
+    """Return the hot-path logger for a category (ingest, db, mqtt, request, ...)."""
+    return logging.getLogger(f"{LOGGER_PREFIX}.{category}")
+
+
+def stats() -> dict:
+    """Counters for /api/test/stats."""
+    if _queue_handler is None:
+        return {'configured': False}
+    return {
+        'configured': True,
+        'level': logging.getLevelName(logging.getLogger().level),
+        'enqueued': _queue_handler.enqueued,
+        'dropped': _queue_handler.dropped,
+        'queue_depth': _queue_handler.queue.qsize(),
+        'sampled_out': dict(_sampling_filter.sampled_out) if _sampling_filter else {},
+    }
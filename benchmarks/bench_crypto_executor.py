@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark: ingest crypto inline vs. the CryptoExecutor process pool.
+
+Each simulated reading does the crypto of one /submit-data request: RSA-2048
+OAEP unwrap + AES-EAX decrypt of the envelope, an RSA PKCS#1 v1.5 signature
+check against the device key, and Fernet encryption of the stored value.
+Request threads (like gunicorn --threads 4) push readings through the same
+CryptoExecutor calls the ingest path uses: inline, then a process pool of 1,
+2 and 4 workers. Throughput only scales with workers up to the number of
+cores the host actually has.
+
+Usage:
+    python benchmarks/bench_crypto_executor.py [readings] [threads]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+# Workers inherit the environment, so set the storage key before any spawn
+os.environ.setdefault('DB_ENCRYPTION_KEY', Fernet.generate_key().decode())
+
+from crypto_executor import CryptoExecutor  # noqa: E402
+from encryption_utils import encrypt_data, export_key_pair, generate_device_key, import_key, sign_message  # noqa: E402
+
+
+def _run(executor, envelopes, private_path, public_pem, threads):
+    def ingest(item):
+        envelope, signed, signature = item
+        data = executor.decrypt_envelope(dict(envelope), private_path)
+        if executor.verify_any([public_pem], signed, signature) is None:
+            raise ValueError("signature check failed")
+        executor.encrypt_values([data['ph']])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(ingest, envelopes))
+    return len(envelopes) / (time.perf_counter() - start)
+
+
+def main():
+    readings = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server_private, server_public = export_key_pair(generate_device_key('rsa'))
+        private_path = os.path.join(tmp, 'private.pem')
+        public_path = os.path.join(tmp, 'public.pem')
+        with open(private_path, 'wb') as f:
+            f.write(server_private)
+        with open(public_path, 'wb') as f:
+            f.write(server_public)
+        device_private, device_public = export_key_pair(generate_device_key('rsa'))
+        device_key = import_key(device_private)
+
+        envelopes = []
+        for i in range(readings):
+            payload = {"device_id": "bench01", "device_type": "ph", "ph": 7.0 + (i % 10) / 10, "counter": i}
+            signed = json.dumps(payload, sort_keys=True).encode()
+            envelopes.append((encrypt_data(payload, public_path), signed, sign_message(device_key, signed)))
+        public_pem = device_public.decode()
+
+        print(f"{readings} readings, {threads} request threads, {os.cpu_count()} cores available")
+        print(f"{'mode':<12} {'readings/s':>11} {'vs inline':>10}")
+        inline_rate = _run(CryptoExecutor(mode='inline'), envelopes, private_path, public_pem, threads)
+        print(f"{'inline':<12} {inline_rate:11.0f} {1.0:9.2f}x")
+        for workers in (1, 2, 4):
+            executor = CryptoExecutor(mode='process', workers=workers)
+            try:
+                # Warm-up starts the workers and loads keys in each of them
+                _run(executor, envelopes[:workers * 4], private_path, public_pem, threads)
+                rate = _run(executor, envelopes, private_path, public_pem, threads)
+            finally:
+                executor.shutdown()
+            stats = executor.stats()
+            print(f"{f'process x{workers}':<12} {rate:11.0f} {rate / inline_rate:9.2f}x"
+                  f"  (fallbacks={stats['fallbacks']}, errors={stats['errors']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-request private key loading vs. KeyMaterialManager.
+
+Compares the old decrypt_data behaviour (read keys/private.pem, RSA.import_key
+and PKCS1_OAEP.new on every call) with the cached cipher that submit_data now
+passes in. Uses a throwaway 2048-bit key so it can run anywhere.
+
+Usage:
+    python benchmarks/bench_key_material.py [iterations]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Crypto.PublicKey import RSA  # noqa: E402
+from encryption_utils import encrypt_data, decrypt_data, KeyMaterialManager  # noqa: E402
+
+
+def _time(label, fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    per_call_ms = elapsed / iterations * 1000
+    print(f"{label:<40} {per_call_ms:8.3f} ms/call")
+    return per_call_ms
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    payload = {"device_id": "bench01", "ph": 7.1, "tds": 120.0, "counter": 1}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        key = RSA.generate(2048)
+        private_path = os.path.join(tmp, 'private.pem')
+        public_path = os.path.join(tmp, 'public.pem')
+        with open(private_path, 'wb') as f:
+            f.write(key.export_key())
+        with open(public_path, 'wb') as f:
+            f.write(key.publickey().export_key())
+
+        envelope = encrypt_data(payload, public_path)
+
+        uncached = KeyMaterialManager()
+
+        def per_request_load():
+            # Equivalent of the old code path: nothing survives between calls
+            uncached.invalidate()
+            decrypt_data(envelope, private_path, cipher_rsa=uncached.get_cipher(private_path))
+
+        cached = KeyMaterialManager()
+        cipher = cached.get_cipher(private_path)
+
+        def cached_cipher():
+            decrypt_data(envelope, cipher_rsa=cipher)
+
+        def cached_lookup():
+            decrypt_data(envelope, cipher_rsa=cached.get_cipher(private_path))
+
+        print(f"decrypt_data x {iterations} (RSA-2048 OAEP + AES-EAX)")
+        before = _time("load key per call (old)", per_request_load, iterations)
+        _time("manager lookup per call (mtime watch)", cached_lookup, iterations)
+        after = _time("pre-loaded cipher (submit_data)", cached_cipher, iterations)
+        print(f"saving: {before - after:.3f} ms/call ({(1 - after / before) * 100:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
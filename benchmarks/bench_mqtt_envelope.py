@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Size and decode cost: legacy JSON secure/sensor payload vs. the binary frame.
+
+Builds the payloads the simulator publishes for the same readings (legacy:
+AES-CBC JSON inside JSON with hash and sha256; binary: the version 2 AES-GCM
+frame from mqtt_envelope.py) and runs them through the ingest pipeline's MQTT
+decode stage, which is what the subscriber does on its network thread.
+
+Usage:
+    python benchmarks/bench_mqtt_envelope.py [readings]
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from encryption_utils import aes_encrypt, hash_data  # noqa: E402
+from ingest_pipeline import MQTT_AES_KEY, IngestMessage, IngestPipeline  # noqa: E402
+from mqtt_envelope import pack_reading  # noqa: E402
+
+
+def _legacy_payload(data):
+    payload = {
+        "data": aes_encrypt(data, MQTT_AES_KEY),
+        "hash": hash_data(data),
+        "sha256": hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest(),
+        "device_id": data["device_id"],
+        "seq": data["seq"],
+    }
+    return json.dumps(payload).encode()
+
+
+def _decode_rate(pipeline, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        pipeline.decode_mqtt(IngestMessage('mqtt', payload))
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def main():
+    readings = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(1)
+    samples = []
+    for i in range(readings):
+        samples.append({
+            "device_id": f"sensor{i % 50:02d}",
+            "device_type": "ph",
+            "ph": round(rng.uniform(6.0, 9.0), 2),
+            "temperature": round(rng.uniform(18.0, 30.0), 1),
+            "seq": 1700000000000 + i,
+        })
+    pipeline = IngestPipeline(
+        latest_by_metric={}, latest_by_sensor={}, user_latest_by_metric={}, user_latest_by_sensor={},
+        user_latest_data={}, set_latest_data=None, validate_session=None, build_thresholds=None,
+        type_defaults=None, compute_safety=None, insert_sensor_data=None, verify_signature=None,
+        private_key_path='')
+
+    legacy = [_legacy_payload(d) for d in samples]
+    binary = [pack_reading(d, MQTT_AES_KEY) for d in samples]
+    legacy_size = sum(map(len, legacy)) / readings
+    binary_size = sum(map(len, binary)) / readings
+
+    # Warm-up, then measure
+    _decode_rate(pipeline, legacy[:500])
+    _decode_rate(pipeline, binary[:500])
+    legacy_rate = _decode_rate(pipeline, legacy)
+    binary_rate = _decode_rate(pipeline, binary)
+
+    print(f"{readings} readings")
+    print(f"{'format':<8} {'avg bytes':>10} {'decodes/s':>10} {'us/decode':>10}")
+    print(f"{'legacy':<8} {legacy_size:10.1f} {legacy_rate:10.0f} {1e6 / legacy_rate:10.1f}")
+    print(f"{'binary':<8} {binary_size:10.1f} {binary_rate:10.0f} {1e6 / binary_rate:10.1f}")
+    print(f"size -{(1 - binary_size / legacy_size) * 100:.0f}%, decode CPU -{(1 - legacy_rate / binary_rate) * 100:.0f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: device signature sign/verify throughput, RSA-2048 vs Ed25519.
+
+Devices sign every HTTP reading (sensor_simulator.sign_payload) and the
+server verifies each one (_verify_device_signature) plus every session
+establishment. Both algorithms go through the same encryption_utils helpers
+(sign_message / verify_signature) that the app uses, with throwaway keys.
+
+Usage:
+    python benchmarks/bench_signatures.py [iterations]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from encryption_utils import (  # noqa: E402
+    KEY_ALGORITHMS, export_key_pair, generate_device_key, import_key, sign_message, verify_signature,
+)
+
+
+def _rate(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed, elapsed / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    payload = {"device_id": "bench01", "device_type": "ph", "ph": 7.1, "session_token": "x" * 64, "counter": 1}
+    message = json.dumps(payload, sort_keys=True).encode()
+
+    print(f"sign/verify x {iterations} ({len(message)}-byte reading)")
+    print(f"{'algorithm':<10} {'sign/s':>10} {'ms/sign':>9} {'verify/s':>10} {'ms/verify':>10} {'pubkey PEM':>11}")
+    results = {}
+    for algorithm in KEY_ALGORITHMS:
+        private_pem, public_pem = export_key_pair(generate_device_key(algorithm))
+        private_key = import_key(private_pem)
+        public_key = import_key(public_pem)
+        signature = sign_message(private_key, message)
+
+        sign_rate, sign_ms = _rate(lambda: sign_message(private_key, message), iterations)
+        verify_rate, verify_ms = _rate(lambda: verify_signature(public_key, message, signature), iterations)
+        results[algorithm] = (sign_rate, verify_rate)
+        print(f"{algorithm:<10} {sign_rate:10.0f} {sign_ms:9.3f} {verify_rate:10.0f} {verify_ms:10.3f} {len(public_pem):10d}B")
+
+    rsa_sign, rsa_verify = results['rsa']
+    ed_sign, ed_verify = results['ed25519']
+    print(f"ed25519 vs rsa: sign x{ed_sign / rsa_sign:.1f}, verify x{ed_verify / rsa_verify:.2f}")
+
+
+if __name__ == '__main__':
+    main()
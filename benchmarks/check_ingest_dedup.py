@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Check the ingest dedup window (ingest_dedup.SequenceWindow).
+
+Marks and checks sequences the way the pipeline does, including a device
+whose seq jumps from a small counter to a millisecond timestamp: that mark
+must stay as cheap as any other (the bitmap is reset, not shifted by the
+gap). Exits non-zero on the first wrong answer.
+
+Usage:
+    python benchmarks/check_ingest_dedup.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ingest_dedup import SEQ_STREAM, SequenceWindow  # noqa: E402
+
+
+def _expect(label, actual, expected):
+    print(f"{label:<48} {'ok' if actual == expected else f'FAIL (got {actual!r})'}")
+    if actual != expected:
+        sys.exit(1)
+
+
+def main():
+    window = SequenceWindow(window=256, enabled=True)
+    sensor_db_id = 1
+
+    def seq(number):
+        return SEQ_STREAM, number
+
+    window.mark(sensor_db_id, seq(1))
+    _expect("seq 1 is a duplicate once stored", window.is_duplicate(sensor_db_id, seq(1)), True)
+    _expect("another sensor's seq 1 is not", window.is_duplicate(2, seq(1)), False)
+
+    started = time.perf_counter()
+    window.mark(sensor_db_id, seq(10 ** 12))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    _expect("mark after a jump to seq 10**12 takes < 10 ms", elapsed_ms < 10, True)
+    _expect("seq 10**12 is a duplicate", window.is_duplicate(sensor_db_id, seq(10 ** 12)), True)
+    _expect("seq 1 is now beyond the window", window.is_duplicate(sensor_db_id, seq(1)), False)
+    _expect("seq 10**12 - 1 was never stored", window.is_duplicate(sensor_db_id, seq(10 ** 12 - 1)), False)
+
+    window.mark(sensor_db_id, seq(10 ** 12 + 3))
+    _expect("seq 10**12 still inside the window", window.is_duplicate(sensor_db_id, seq(10 ** 12)), True)
+    _expect("seq 10**12 + 2 was never stored", window.is_duplicate(sensor_db_id, seq(10 ** 12 + 2)), False)
+    window.mark(sensor_db_id, seq(10 ** 12 + 2))
+    _expect("late seq 10**12 + 2 is remembered", window.is_duplicate(sensor_db_id, seq(10 ** 12 + 2)), True)
+    print(window.stats())
+
+
+if __name__ == '__main__':
+    main()
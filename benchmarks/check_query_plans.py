@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+EXPLAIN the hot sensor_data queries and check they use the time-series indexes.
+
+Runs the exact SQL the reading lists build (db._recent_sensor_data_query)
+against the configured database (DB_HOST, DB_NAME, ...) for a real user and
+location, and fails if sensor_data is not read through one of the
+idx_sensor_data_*_time indexes from migration 2, or, where the index alone
+gives the order, if MySQL still filesorts. On a nearly empty table the
+optimizer may prefer a full scan; check against realistic data (run ANALYZE
+TABLE sensor_data first if the statistics are stale).
+
+Usage:
+    python benchmarks/check_query_plans.py [limit]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+def _cases(user_id, location, limit):
+    user_time, sensor_time, time_only = (name for name, _ in migrations.SENSOR_DATA_TIME_INDEXES)
+    # (label, (sql, params), acceptable indexes, filesort allowed)
+    return [
+        ("recent, all users", db._recent_sensor_data_query(limit), {time_only}, False),
+        ("recent, one user", db._recent_sensor_data_query(limit, user_id=user_id), {user_time}, False),
+        # Driven from sensors at the location, rows from several sensors are
+        # merged: a bounded sort of the LIMIT is fine, a table scan is not
+        ("location, one user", db._recent_sensor_data_query(limit, user_id=user_id, by_location=True, location=location),
+         {user_time, sensor_time}, True),
+        ("location, all users", db._recent_sensor_data_query(limit, by_location=True, location=location),
+         {sensor_time, time_only}, True),
+    ]
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    pool = db.get_pool()
+    if not db._can_use_database(pool):
+        sys.exit("No database connection (check DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)")
+    conn = db._get_connection(pool)
+    cur = db._get_cursor(conn, dictionary=True)
+    try:
+        cur.execute("SELECT user_id, location FROM sensors WHERE user_id IS NOT NULL ORDER BY id LIMIT 1")
+        sample = cur.fetchone()
+        if not sample:
+            sys.exit("No sensors to build sample queries from")
+        print(f"schema version {migrations.current_version(conn)}, user_id {sample['user_id']}, "
+              f"location {sample['location']!r}, limit {limit}")
+
+        failures = 0
+        print(f"{'query':<22} {'key':<30} {'rows':>8}  extra")
+        for label, (sql, params), expected, filesort_ok in _cases(sample['user_id'], sample['location'], limit):
+            cur.execute("EXPLAIN " + sql, params)
+            plan = cur.fetchall()
+            row = next((r for r in plan if r.get('table') == 'sd'), {})
+            key = row.get('key') or '-'
+            extra = row.get('Extra') or ''
+            # MySQL reports the filesort on the first table of the join
+            filesort = any('filesort' in (r.get('Extra') or '') for r in plan)
+            ok = key in expected and (filesort_ok or not filesort)
+            failures += not ok
+            print(f"{label:<22} {key:<30} {row.get('rows') or '-':>8}  {extra}{'' if ok else '  <-- FAIL'}")
+    finally:
+        cur.close()
+        db._return_connection(pool, conn)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
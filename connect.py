@@ -7,8 +7,13 @@ It reads configuration from environment variables and provides connection poolin
 """
 
 import os
+import queue
+import threading
+import time
+from collections import deque
 import mysql.connector
-from mysql.connector import pooling, Error, errorcode
+from mysql.connector import Error, errorcode
+from mysql.connector.errors import PoolError
 from typing import Optional
 
 
@@ -23,47 +28,290 @@ DB_PASSWORD = os.getenv('DB_PASSWORD', '')  # Local MySQL password (empty by def
 DB_NAME = os.getenv('DB_NAME', 'ilmuwanutara_e2eewater')
 
 # Connection pool configuration
+# Each process may need a connection at once for every request thread
+# (gunicorn --threads 4), every MQTT ingest worker, plus the key subscriber,
+# the write-behind writer, the heartbeat flusher and the registry refresh.
+# gunicorn --workers 2 opens up to twice this many connections.
 POOL_NAME = 'flask_pool'
-POOL_SIZE = 5
-POOL_RESET_SESSION = True
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '0') or 0) or (
+    int(os.getenv('WEB_THREADS', '4')) + int(os.getenv('MQTT_INGEST_WORKERS', '4')) + 4
+)
+# Seconds a caller waits for a free connection before PoolError
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Connections idle longer than this are pinged when checked out
+POOL_PREPING_IDLE_SECONDS = float(os.getenv('DB_POOL_PREPING_IDLE_SECONDS', '30'))
+# Background liveness ping of idle connections (0 disables)
+POOL_PING_SECONDS = float(os.getenv('DB_POOL_PING_SECONDS', '60'))
+
+_CONNECTION_CONFIG = dict(
+    host=DB_HOST,
+    port=DB_PORT,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    database=DB_NAME,
+    charset='utf8mb4',
+    collation='utf8mb4_unicode_ci',
+    autocommit=False,
+    raise_on_warnings=False,
+    connection_timeout=10,
+)
+
+
+class PooledConnection:
+    """A checked-out connection; close() hands it back to the pool.
+
+    Everything else (cursor, commit, rollback, ...) goes to the MySQL
+    connection. A wrapper dropped without close() (an exception between
+    checkout and return) is recovered by the pool instead of leaking a slot.
+    """
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        cnx = self.__dict__.get('_cnx')
+        if cnx is None:
+            raise AttributeError(name)
+        return getattr(cnx, name)
+
+    def close(self):
+        cnx, self._cnx = self._cnx, None
+        if cnx is not None:
+            self._pool.release(cnx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        cnx = self.__dict__.get('_cnx')
+        if cnx is not None:
+            self._cnx = None
+            self._pool.orphaned(cnx)
+
+
+class ConnectionPool:
+    """Bounded MySQL connection pool with idle-only pre-ping and wait metrics.
+
+    mysql.connector's MySQLConnectionPool pings every connection on checkout
+    (under a module-wide lock), resets the session on every return and fails
+    at once when all connections are in use. Here:
+
+    - connections are opened lazily up to size; when all are busy, callers
+      wait up to timeout seconds for one (wait time and timeouts are counted)
+    - a connection is only pinged on checkout if it sat idle for longer than
+      preping_idle seconds; a background thread pings idle connections every
+      ping_interval seconds so firewalls and wait_timeout don't close them
+    - on return, an open transaction is rolled back (autocommit is off, so a
+      plain SELECT leaves a snapshot open) instead of a full session reset
+    """
+
+    def __init__(self, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 preping_idle: float = POOL_PREPING_IDLE_SECONDS, ping_interval: float = POOL_PING_SECONDS,
+                 **connection_config):
+        self.size = max(1, int(size))
+        self._timeout = timeout
+        self._preping_idle = preping_idle
+        self._ping_interval = ping_interval
+        self._config = connection_config or dict(_CONNECTION_CONFIG)
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = deque()            # (connection, monotonic time it was returned)
+        self._open = 0                  # connections created and not discarded (idle + in use)
+        self._orphans = queue.SimpleQueue()
+        self._pinger = None
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'recovered': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'prepings': 0,
+            'preping_failures': 0,
+            'background_pings': 0,
+            'background_ping_failures': 0,
+            'max_in_use': 0,
+        }
+
+    # ------------------------------------------------------------------ checkout / return
+
+    def get_connection(self, timeout: Optional[float] = None) -> PooledConnection:
+        """Check out a connection, waiting up to timeout seconds for a free one.
+
+        Raises:
+            PoolError: No connection became free in time
+            Error: A new connection could not be opened
+        """
+        self._recover_orphans()
+        timeout = self._timeout if timeout is None else timeout
+        started = time.monotonic()
+        waited = False
+        with self._lock:
+            while not self._idle and self._open >= self.size:
+                remaining = timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolError(f"Failed getting connection; pool exhausted ({self.size} in use for {timeout:g}s)")
+                waited = True
+                self._lock.wait(remaining)
+            if self._idle:
+                cnx, returned_at = self._idle.pop()
+            else:
+                cnx, returned_at = None, None
+                self._open += 1
+            self._note_checkout(started, waited)
+
+        if cnx is None:
+            return PooledConnection(self, self._connect())
+        if time.monotonic() - returned_at > self._preping_idle and not self._ping(cnx, 'prepings', 'preping_failures'):
+            # Dead (server restart, network drop): replace it in the same slot
+            self._close_quietly(cnx)
+            return PooledConnection(self, self._connect())
+        return PooledConnection(self, cnx)
+
+    def _note_checkout(self, started: float, waited: bool):
+        # Caller holds the lock
+        self._stats['checkouts'] += 1
+        self._stats['max_in_use'] = max(self._stats['max_in_use'], self._open - len(self._idle))
+        if waited:
+            wait_ms = (time.monotonic() - started) * 1000
+            self._stats['waits'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+
+    def _connect(self):
+        try:
+            cnx = mysql.connector.connect(**self._config)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        self._start_pinger()
+        return cnx
+
+    def release(self, cnx):
+        """Return a connection (called by PooledConnection.close)."""
+        try:
+            if cnx.in_transaction:
+                cnx.rollback()
+        except Exception:
+            self._discard(cnx)
+            return
+        with self._lock:
+            self._idle.append((cnx, time.monotonic()))
+            self._lock.notify()
+
+    def orphaned(self, cnx):
+        # Called from PooledConnection.__del__, possibly while this thread is
+        # inside the pool: only queue it, the next checkout returns it
+        self._orphans.put(cnx)
+
+    def _recover_orphans(self):
+        while True:
+            try:
+                cnx = self._orphans.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._stats['recovered'] += 1
+            self.release(cnx)
+
+    def _close_quietly(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats['discarded'] += 1
+
+    def _discard(self, cnx):
+        """Close a broken connection and free its slot."""
+        self._close_quietly(cnx)
+        with self._lock:
+            self._open -= 1
+            self._lock.notify()
+
+    def _ping(self, cnx, counter: str, failure_counter: str) -> bool:
+        with self._lock:
+            self._stats[counter] += 1
+        try:
+            cnx.ping(reconnect=False)
+            return True
+        except Exception:
+            with self._lock:
+                self._stats[failure_counter] += 1
+            return False
+
+    # ------------------------------------------------------------------ background pings
+
+    def _start_pinger(self):
+        if not self._ping_interval or self._pinger is not None:
+            return
+        with self._lock:
+            if self._pinger is not None:
+                return
+            self._pinger = threading.Thread(target=self._ping_idle, name='db-pool-ping', daemon=True)
+        self._pinger.start()
+
+    def _ping_idle(self):
+        while True:
+            time.sleep(self._ping_interval)
+            self._recover_orphans()
+            now = time.monotonic()
+            with self._lock:
+                # Only connections nobody used for a whole interval; they keep
+                # their slot (counted as in use) while being pinged
+                stale = [entry for entry in self._idle if now - entry[1] >= self._ping_interval]
+                for entry in stale:
+                    self._idle.remove(entry)
+            for cnx, _ in stale:
+                if self._ping(cnx, 'background_pings', 'background_ping_failures'):
+                    with self._lock:
+                        # Least recently used end: checkouts take the warmest connection first
+                        self._idle.appendleft((cnx, time.monotonic()))
+                        self._lock.notify()
+                else:
+                    self._discard(cnx)
+
+    # ------------------------------------------------------------------ stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            idle = len(self._idle)
+            open_connections = self._open
+        waits = stats['waits']
+        stats['avg_wait_ms'] = round(stats.pop('total_wait_ms') / waits, 3) if waits else None
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 3)
+        return dict(stats, size=self.size, open=open_connections, idle=idle,
+                    in_use=open_connections - idle, timeout_seconds=self._timeout)
+
 
 # Global connection pool
-_pool: Optional[mysql.connector.pooling.MySQLConnectionPool] = None
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
 
 
-def get_connection_pool() -> mysql.connector.pooling.MySQLConnectionPool:
+def get_connection_pool() -> ConnectionPool:
     """
     Get or create the MySQL connection pool.
-    
+
     Returns:
-        MySQLConnectionPool: The connection pool instance
-        
-    Raises:
-        Error: If connection pool creation fails
+        ConnectionPool: The connection pool instance (connections open lazily)
     """
     global _pool
-    
     if _pool is None:
-        try:
-            _pool = mysql.connector.pooling.MySQLConnectionPool(
-                pool_name=POOL_NAME,
-                pool_size=POOL_SIZE,
-                pool_reset_session=POOL_RESET_SESSION,
-                host=DB_HOST,
-                port=DB_PORT,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_NAME,
-                charset='utf8mb4',
-                collation='utf8mb4_unicode_ci',
-                autocommit=False,
-                raise_on_warnings=False
-            )
-            # MySQL connection pool created
-        except Error as err:
-            print(f"Error creating connection pool: {err}")
-            raise
-    
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
     return _pool
 
 
@@ -72,15 +320,14 @@ def get_connection():
     Get a connection from the pool.
     
     Returns:
-        MySQLConnection: A database connection from the pool
+        PooledConnection: A database connection from the pool
         
     Raises:
         Error: If connection retrieval fails
     """
     pool = get_connection_pool()
     try:
-        connection = pool.get_connection()
-        return connection
+        return pool.get_connection()
     except Error as err:
         print(f"Error getting connection from pool: {err}")
         raise
@@ -93,10 +340,15 @@ def close_connection(connection):
     Args:
         connection: The MySQL connection to return to the pool
     """
-    if connection and connection.is_connected():
+    if connection:
         connection.close()
 
 
+def pool_stats() -> dict:
+    """Checkout, wait and ping counters of the connection pool."""
+    return get_connection_pool().stats()
+
+
 def test_connection() -> bool:
     """
     Test the database connection.
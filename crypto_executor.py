@@ -0,0 +1,231 @@
+"""
+Optional process pool for ingest crypto (decrypt, verify, encrypt).
+
+Under gunicorn --threads, the RSA unwrap of /submit-data envelopes, device
+signature checks and Fernet encryption of stored values all run on request
+threads and contend for the GIL around the native calls. With
+CRYPTO_EXECUTOR=process these jobs are handed to a process pool sized to the
+cores, so ingest throughput scales with the host (Pi 5 and VM hosts have 4).
+
+Jobs are plain module-level functions (picklable) that rebuild their key
+material inside the worker process: the server private key is loaded once
+per worker by encryption_utils.key_material, device public keys are parsed
+once per PEM, and DB_ENCRYPTION_KEY is inherited from the environment.
+
+submit_batch() sends a list of jobs as one task per worker rather than one
+task per job, which keeps IPC overhead flat for multi-row inserts and for
+verifying a signature against several candidate sensor keys.
+
+Configuration:
+- CRYPTO_EXECUTOR: 'inline' (default, run on the calling thread) or 'process'
+- CRYPTO_EXECUTOR_WORKERS: pool size (default: number of cores)
+- CRYPTO_EXECUTOR_START_METHOD: multiprocessing start method (default spawn;
+  forking a process that already runs MQTT and writer threads is not safe).
+  With spawn, workers re-import the main module once: nothing under gunicorn,
+  app.py (without its __main__ block) under `python app.py`
+- CRYPTO_EXECUTOR_TIMEOUT_SECONDS: per-batch wait before running it inline
+
+If the pool cannot start, breaks, or times out, the job runs inline and the
+fallback is counted; the pool is recreated on the next submit.
+"""
+
+import atexit
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Optional
+
+from encryption_utils import decrypt_data, get_rsa_cipher, import_key, verify_signature
+
+
+CRYPTO_EXECUTOR = (os.environ.get('CRYPTO_EXECUTOR', 'inline') or 'inline').strip().lower()
+CRYPTO_EXECUTOR_WORKERS = int(os.environ.get('CRYPTO_EXECUTOR_WORKERS', '0') or 0) or (os.cpu_count() or 1)
+CRYPTO_EXECUTOR_START_METHOD = (os.environ.get('CRYPTO_EXECUTOR_START_METHOD', 'spawn') or 'spawn').strip().lower()
+CRYPTO_EXECUTOR_TIMEOUT_SECONDS = float(os.environ.get('CRYPTO_EXECUTOR_TIMEOUT_SECONDS', '10'))
+
+
+# ---------------------------------------------------------------------- jobs
+# These run in the worker processes (or inline) and must stay importable
+# without the Flask app.
+
+def decrypt_envelope_job(envelope: dict, private_key_path: str) -> dict:
+    """RSA-OAEP unwrap + AES-EAX decrypt of a /submit-data envelope."""
+    return decrypt_data(envelope, cipher_rsa=get_rsa_cipher(private_key_path))
+
+
+@lru_cache(maxsize=1024)
+def _parse_public_key(public_key_pem: str):
+    return import_key(public_key_pem)
+
+
+def verify_signature_job(public_key_pem: str, message: bytes, signature: bytes) -> bool:
+    """True if signature is valid for message under the PEM key (RSA or Ed25519)."""
+    try:
+        verify_signature(_parse_public_key(public_key_pem), message, signature)
+        return True
+    except Exception:
+        return False
+
+
+def encrypt_values_job(values: list) -> list:
+    """Fernet-encrypt sensor values for storage (DatabaseEncryption.encrypt_values)."""
+    from db_encryption import get_db_encryption
+    return get_db_encryption().encrypt_values(values)
+
+
+def _run_jobs(jobs: list) -> list:
+    """Run (fn, args) jobs in order; failures are returned, not raised."""
+    results = []
+    for fn, args in jobs:
+        try:
+            results.append((True, fn(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+# ---------------------------------------------------------------------- executor
+
+class CryptoExecutor:
+    """Runs crypto jobs in a process pool, or inline when disabled/unavailable."""
+
+    def __init__(self, mode: str = CRYPTO_EXECUTOR, workers: int = CRYPTO_EXECUTOR_WORKERS,
+                 start_method: str = CRYPTO_EXECUTOR_START_METHOD,
+                 timeout: float = CRYPTO_EXECUTOR_TIMEOUT_SECONDS):
+        self.mode = mode if mode in ('inline', 'process') else 'inline'
+        self.workers = max(1, int(workers))
+        self._start_method = start_method
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = None
+        self._stats = {'jobs': 0, 'batches': 0, 'offloaded_jobs': 0, 'inline_jobs': 0,
+                       'fallbacks': 0, 'errors': 0, 'pool_starts': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == 'process'
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context(self._start_method)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._stats['pool_starts'] += 1
+            return self._pool
+
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        try:
+            pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+
+    def submit_batch(self, jobs: list) -> list:
+        """Run many jobs; results are returned in job order.
+
+        Args:
+            jobs: List of (fn, args) tuples; fn must be a module-level function
+
+        Returns:
+            List of (ok, value) tuples; value is the job's exception when ok is False
+        """
+        if not jobs:
+            return []
+        self._count(jobs=len(jobs), batches=1)
+        if not self.enabled:
+            results = _run_jobs(jobs)
+            self._count(inline_jobs=len(jobs), errors=sum(1 for ok, _ in results if not ok))
+            return results
+
+        # One task per worker, each carrying a contiguous slice of the jobs
+        chunk_count = min(len(jobs), self.workers)
+        size = -(-len(jobs) // chunk_count)
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        results = []
+        pool = None
+        try:
+            pool = self._get_pool()
+            futures = [pool.submit(_run_jobs, chunk) for chunk in chunks]
+            for future in futures:
+                results.extend(future.result(timeout=self._timeout))
+            self._count(offloaded_jobs=len(jobs))
+        except (BrokenProcessPool, FutureTimeoutError, OSError, RuntimeError) as e:
+            print(f"Crypto executor: pool unavailable ({type(e).__name__}: {e}); running {len(jobs)} jobs inline",
+                  file=sys.stderr)
+            if pool is not None:
+                self._discard_pool(pool)
+            results = _run_jobs(jobs)
+            self._count(inline_jobs=len(jobs), fallbacks=1)
+        self._count(errors=sum(1 for ok, _ in results if not ok))
+        return results
+
+    def run(self, fn, *args):
+        """Run one job and return its result (re-raising its exception)."""
+        ok, value = self.submit_batch([(fn, args)])[0]
+        if not ok:
+            raise value
+        return value
+
+    # Convenience wrappers used by the ingest path
+
+    def decrypt_envelope(self, envelope: dict, private_key_path: str) -> dict:
+        if not self.enabled:
+            return decrypt_envelope_job(envelope, private_key_path)
+        return self.run(decrypt_envelope_job, envelope, private_key_path)
+
+    def verify_any(self, public_key_pems: list, message: bytes, signature: bytes) -> Optional[int]:
+        """Index of the first PEM whose key verifies the signature, or None."""
+        results = self.submit_batch([(verify_signature_job, (pem, message, signature)) for pem in public_key_pems])
+        for index, (ok, valid) in enumerate(results):
+            if ok and valid:
+                return index
+        return None
+
+    def encrypt_values(self, values: list) -> list:
+        if not self.enabled:
+            return encrypt_values_job(values)
+        return self.run(encrypt_values_job, list(values))
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, mode=self.mode, workers=self.workers if self.enabled else 0,
+                        pool_running=self._pool is not None)
+
+
+# Global instance for use across the application
+_crypto_executor: Optional[CryptoExecutor] = None
+_crypto_executor_lock = threading.Lock()
+
+
+def get_crypto_executor() -> CryptoExecutor:
+    """
+    Get or create the global crypto executor.
+
+    Returns:
+        CryptoExecutor: Singleton instance (inline unless CRYPTO_EXECUTOR=process)
+    """
+    global _crypto_executor
+    if _crypto_executor is None:
+        with _crypto_executor_lock:
+            if _crypto_executor is None:
+                _crypto_executor = CryptoExecutor()
+                if _crypto_executor.enabled:
+                    atexit.register(_crypto_executor.shutdown)
+    return _crypto_executor
@@ -1,8 +1,21 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import re
 import json
 from db_encryption import get_db_encryption
+from sensor_registry import invalidate_sensor
+from public_key_cache import invalidate_public_key
+from encryption_utils import key_algorithm_for_pem
+from crypto_executor import get_crypto_executor
+from sensor_writer import SENSOR_WRITE_BEHIND, get_sensor_writer
+from threshold_cache import get_threshold_cache, invalidate_thresholds
+from app_logging import get_logger
+import migrations
+
+db_log = get_logger('db')
 
 # Import connect.py for MySQL connections
 try:
@@ -28,7 +41,16 @@ DB_USER = os.getenv('DB_USER', 'root')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')  # Empty password for local MySQL root by default
 DB_NAME = os.getenv('DB_NAME', 'ilmuwanutara_e2eewater')
 
+# Size of the fallback pool below (connect.py sizes its own, see connect.POOL_SIZE)
+DB_POOL_SIZE = min(pooling.CNX_POOL_MAXSIZE, int(os.getenv('DB_POOL_SIZE', '12') or 12))
+DB_SCHEMA_RETRY_SECONDS = float(os.getenv('DB_SCHEMA_RETRY_SECONDS', '5'))
+# Let a worker that finds the schema out of date migrate it (under the migration lock)
+DB_AUTO_MIGRATE = (os.getenv('DB_AUTO_MIGRATE', 'false') or 'false').strip().lower() in ('1', 'true', 'yes')
+
 _pool = None
+_schema_ready = False
+_schema_retry_at = 0.0
+_schema_lock = threading.Lock()
 
 
 def _can_use_database(pool):
@@ -41,7 +63,18 @@ def _can_use_database(pool):
 
 
 def _get_connection(pool):
-    """Get a connection from the pool (MySQL only)."""
+    """Get a connection from the pool (MySQL only).
+
+    Inside connection_scope() every call on the thread gets the scope's one
+    connection, and returning it is a no-op until the scope ends.
+    """
+    scope = getattr(_scope_local, 'scope', None)
+    if scope is not None:
+        return scope.connection(pool)
+    return _checkout_connection(pool)
+
+
+def _checkout_connection(pool):
     # For MySQL, use connect.py if available, otherwise use pool directly
     if CONNECT_AVAILABLE and pool is None:
         # If pool is None, it means we're using connect.py's pool
@@ -69,6 +102,179 @@ def _return_connection(pool, conn):
             connect.close_connection(conn)
 
 
+class _ScopedConnection:
+    """The scope's connection as seen by the DB helpers.
+
+    close() is a no-op (the scope returns the connection when it ends). In a
+    read snapshot, commit() and rollback() are no-ops too, so a helper that
+    commits after its SELECT doesn't end the snapshot for the next one.
+    """
+
+    def __init__(self, scope, cnx):
+        self._scope = scope
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        if not self._scope.snapshot:
+            self._cnx.commit()
+
+    def rollback(self):
+        if not self._scope.snapshot:
+            self._cnx.rollback()
+
+
+class ConnectionScope:
+    """One pooled connection shared by every db.* call on a thread.
+
+    Opened per Flask request (lazily: nothing is checked out until the first
+    query) and per MQTT message; see connection_scope().
+    """
+
+    def __init__(self, snapshot: bool = False):
+        self.snapshot = snapshot
+        self.calls = 0                # db.* calls served by the shared connection
+        self._pool = None
+        self._cnx = None
+        self._shared = None
+
+    def connection(self, pool):
+        if self._cnx is None:
+            self._pool = pool
+            self._cnx = _checkout_connection(pool)
+            self._shared = _ScopedConnection(self, self._cnx)
+            if self.snapshot:
+                self._start_snapshot()
+        else:
+            try:
+                # A helper that failed half-way may have left rows unread
+                self._cnx.consume_results()
+                if not self.snapshot and self._cnx.in_transaction:
+                    # Leftover implicit transaction from a read that did not
+                    # commit; end it so this call sees current data
+                    self._cnx.rollback()
+            except Exception:
+                pass
+        self.calls += 1
+        return self._shared
+
+    def _start_snapshot(self):
+        try:
+            if self._cnx.in_transaction:
+                self._cnx.rollback()
+            self._cnx.start_transaction(consistent_snapshot=True, readonly=True)
+            with _scope_stats_lock:
+                _scope_stats['snapshots'] += 1
+        except Exception as e:
+            db_log.warning("Read snapshot unavailable, using plain reads: %s", e)
+            self.snapshot = False
+
+    def set_snapshot(self, snapshot: bool):
+        """Switch a read-only consistent snapshot on or off for the rest of the scope."""
+        if snapshot == self.snapshot:
+            return
+        self.snapshot = snapshot
+        if self._cnx is None:
+            return
+        if snapshot:
+            self._start_snapshot()
+        else:
+            try:
+                self._cnx.rollback()
+            except Exception:
+                pass
+
+    def close(self):
+        cnx, self._cnx, self._shared = self._cnx, None, None
+        with _scope_stats_lock:
+            _scope_stats['scopes'] += 1
+            _scope_stats['calls'] += self.calls
+            if cnx is not None:
+                _scope_stats['checkouts'] += 1
+        if cnx is None:
+            return
+        try:
+            if self.snapshot:
+                cnx.rollback()
+        except Exception:
+            pass
+        _return_connection(self._pool, cnx)
+
+
+_scope_local = threading.local()
+_scope_stats_lock = threading.Lock()
+_scope_stats = {'scopes': 0, 'checkouts': 0, 'calls': 0, 'snapshots': 0}
+
+
+def connection_scope_stats() -> dict:
+    """Scopes closed, connections they checked out and db.* calls they served."""
+    with _scope_stats_lock:
+        stats = dict(_scope_stats)
+    stats['checkouts_saved'] = stats['calls'] - stats['checkouts']
+    return stats
+
+
+def begin_connection_scope(snapshot: bool = False):
+    """Start sharing one connection among this thread's db.* calls.
+
+    Returns:
+        The new ConnectionScope, or None if one is already active (the outer
+        scope keeps ownership; pass the return value to end_connection_scope)
+    """
+    if getattr(_scope_local, 'scope', None) is not None:
+        return None
+    scope = ConnectionScope(snapshot)
+    _scope_local.scope = scope
+    return scope
+
+
+def end_connection_scope(scope):
+    """Return the scope's connection to the pool (None is ignored)."""
+    if scope is None:
+        return
+    if getattr(_scope_local, 'scope', None) is scope:
+        _scope_local.scope = None
+    scope.close()
+
+
+@contextmanager
+def connection_scope(snapshot: bool = False):
+    """Share one pooled connection among all db.* calls in the block.
+
+    Nested use joins the outer scope. With snapshot=True the block reads
+    from one read-only consistent snapshot (START TRANSACTION WITH
+    CONSISTENT SNAPSHOT, READ ONLY); writes in it fail, so use it for views.
+    """
+    scope = begin_connection_scope(snapshot)
+    if scope is None:
+        outer = _scope_local.scope
+        previous = outer.snapshot
+        if snapshot:
+            outer.set_snapshot(True)
+        try:
+            yield outer
+        finally:
+            outer.set_snapshot(previous)
+        return
+    try:
+        yield scope
+    finally:
+        end_connection_scope(scope)
+
+
+def read_snapshot():
+    """connection_scope(snapshot=True), for views that read several tables.
+
+    Also works as a decorator: @read_snapshot() on a view function.
+    """
+    return connection_scope(snapshot=True)
+
+
 def _get_cursor(conn, dictionary=False):
     """Get a MySQL cursor."""
     return conn.cursor(dictionary=dictionary)
@@ -188,6 +394,7 @@ def _ensure_schema(conn) -> None:
                 sensor_type_id INT NULL,
                 location VARCHAR(255) DEFAULT NULL,
                 public_key TEXT NULL,
+                key_algorithm VARCHAR(16) NULL,
                 status ENUM('active', 'inactive') DEFAULT 'active',
                 registered_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
                 updated_at {datetime_type} DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
@@ -235,9 +442,25 @@ def _ensure_schema(conn) -> None:
                 conn.commit()
                 print("Added key_updated_at column to sensors table")
             cur.fetchall()  # Consume any remaining results
+            
+            # Check if key_algorithm exists ('rsa' or 'ed25519', derived from public_key)
+            cur.execute(f"SHOW COLUMNS FROM {quote_char}sensors{quote_char} LIKE 'key_algorithm'")
+            if not cur.fetchone():
+                cur.execute(f"ALTER TABLE {quote_char}sensors{quote_char} ADD COLUMN key_algorithm VARCHAR(16) NULL AFTER public_key")
+                conn.commit()
+                print("Added key_algorithm column to sensors table")
+            cur.fetchall()  # Consume any remaining results
+
+            # Check if last_seen exists (heartbeats; loaded with the sensor registry)
+            cur.execute(f"SHOW COLUMNS FROM {quote_char}sensors{quote_char} LIKE 'last_seen'")
+            if not cur.fetchone():
+                cur.execute(f"ALTER TABLE {quote_char}sensors{quote_char} ADD COLUMN last_seen {datetime_type} DEFAULT NULL AFTER key_updated_at")
+                conn.commit()
+                print("Added last_seen column to sensors table")
+            cur.fetchall()  # Consume any remaining results
         except Exception as e:
             # Column already exists or other error, ignore
-            print(f"Note: updated_at/key_updated_at migration: {e}")
+            print(f"Note: updated_at/key_updated_at/key_algorithm/last_seen migration: {e}")
             try:
                 cur.fetchall()
             except:
@@ -311,7 +534,6 @@ def _ensure_schema(conn) -> None:
                     pass  # Index might already exist
             
             # Recreate foreign keys (only if we found any)
-            if fk_refs:
             for fk in fk_refs:
                 fk_name = fk[0] if isinstance(fk, tuple) else fk.get('CONSTRAINT_NAME')
                 table_name = fk[1] if isinstance(fk, tuple) else fk.get('TABLE_NAME')
@@ -359,6 +581,8 @@ def _ensure_schema(conn) -> None:
                     sensor_id INT NOT NULL,
                     user_id INT NULL,
                     device_id VARCHAR(100) NULL,
+                    metric VARCHAR(50) NULL,
+                    ingest_key VARCHAR(100) NULL,
                     recorded_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
                     value TEXT NOT NULL,
                     status VARCHAR(20) DEFAULT 'normal' CHECK (status IN ('normal', 'warning', 'critical')),
@@ -372,6 +596,7 @@ def _ensure_schema(conn) -> None:
                 cur.execute(f"CREATE INDEX IF NOT EXISTS idx_sensor_data_sensor_id ON {quote_char}sensor_data{quote_char}(sensor_id)")
                 cur.execute(f"CREATE INDEX IF NOT EXISTS idx_sensor_data_user_id ON {quote_char}sensor_data{quote_char}(user_id)")
                 cur.execute(f"CREATE INDEX IF NOT EXISTS idx_sensor_data_device_id ON {quote_char}sensor_data{quote_char}(device_id)")
+                cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_sensor_data_ingest_key ON {quote_char}sensor_data{quote_char}(sensor_id, ingest_key)")
             except Exception:
                 pass
         else:
@@ -382,12 +607,15 @@ def _ensure_schema(conn) -> None:
                     sensor_id INT NOT NULL,
                     user_id INT NULL,
                     device_id VARCHAR(100) NULL,
+                    metric VARCHAR(50) NULL,
+                    ingest_key VARCHAR(100) NULL,
                     recorded_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
                     value TEXT NOT NULL,
                     status ENUM('normal','warning','critical') DEFAULT 'normal',
                     INDEX idx_sensor_data_sensor_id (sensor_id),
                     INDEX idx_sensor_data_user_id (user_id),
                     INDEX idx_sensor_data_device_id (device_id),
+                    UNIQUE KEY uq_sensor_data_ingest_key (sensor_id, ingest_key),
                     CONSTRAINT fk_sensor_data_sensor FOREIGN KEY (sensor_id)
                         REFERENCES {quote_char}sensors{quote_char}(id) ON UPDATE CASCADE ON DELETE CASCADE
                 )
@@ -440,7 +668,7 @@ def _ensure_schema(conn) -> None:
                     cur.fetchall()
                 except:
                     pass
-        
+
             # Backfill user_id and device_id from sensors table for existing records
             try:
                 cur.execute(f"""
@@ -552,7 +780,9 @@ def _ensure_schema(conn) -> None:
                 counter INT DEFAULT 0,
                 expires_at {datetime_type} NOT NULL,
                 created_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
-                last_used_at {datetime_type} DEFAULT CURRENT_TIMESTAMP
+                last_used_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
+                session_key TEXT NULL,
+                key_expires_at {datetime_type} NULL
             )
             """
         )
@@ -594,6 +824,8 @@ def _ensure_schema(conn) -> None:
                 expires_at {datetime_type} NOT NULL,
                 created_at {datetime_type} DEFAULT CURRENT_TIMESTAMP,
                 last_used_at {datetime_type} DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                session_key TEXT NULL,
+                key_expires_at {datetime_type} NULL,
             INDEX idx_device_sessions_token (session_token),
             INDEX idx_device_sessions_device (device_id),
             INDEX idx_device_sessions_expires (expires_at),
@@ -602,110 +834,134 @@ def _ensure_schema(conn) -> None:
         )
         """
     )
+        # Negotiated AES-GCM session key (Fernet-encrypted) for the symmetric
+        # /submit-data envelope; NULL when the device did not negotiate one
+        try:
+            cur.execute(f"SHOW COLUMNS FROM {quote_char}device_sessions{quote_char} WHERE Field = 'session_key'")
+            if not cur.fetchone():
+                cur.execute(
+                    f"ALTER TABLE {quote_char}device_sessions{quote_char} "
+                    f"ADD COLUMN session_key TEXT NULL, ADD COLUMN key_expires_at {datetime_type} NULL"
+                )
+                conn.commit()
+                print("Added session_key columns to device_sessions table")
+            cur.fetchall()  # Consume any remaining results
+        except Exception as e:
+            print(f"Note: device_sessions session_key migration: {e}")
+            try:
+                cur.fetchall()
+            except:
+                pass
     # Per-user thresholds table removed; using sensor_type defaults and per-sensor overrides
     conn.commit()
     cur.close()
 
 
+def _ensure_schema_once(get_connection, return_connection) -> bool:
+    """Check the schema on the first successful connection of this process.
+
+    A database that schema_version records as current for this code costs
+    one SELECT. Otherwise `python migrations.py migrate` has to be run (the
+    Docker image does so before starting gunicorn): the process is not
+    marked ready, and the error is logged again on every retry until the
+    schema is current. Only with DB_AUTO_MIGRATE on does the worker run
+    the baseline and pending migrations itself, under the migration lock
+    (migrations.migrate) and holding up every query of this process.
+    Failures are retried at most every DB_SCHEMA_RETRY_SECONDS, so a database
+    outage doesn't turn every query into a schema probe.
+    """
+    global _schema_ready, _schema_retry_at
+    if _schema_ready:
+        return True
+    with _schema_lock:
+        if _schema_ready or time.monotonic() < _schema_retry_at:
+            return _schema_ready
+        try:
+            conn = get_connection()
+            try:
+                if not migrations.is_current(conn, _ensure_schema):
+                    if DB_AUTO_MIGRATE:
+                        migrations.migrate(conn, baseline=_ensure_schema)
+                    else:
+                        raise RuntimeError("schema is not current for this code; run: python migrations.py migrate")
+            finally:
+                return_connection(conn)
+            _schema_ready = True
+        except Exception as e:
+            _schema_retry_at = time.monotonic() + DB_SCHEMA_RETRY_SECONDS
+            print(f"ERROR: Database schema check failed (retrying in {DB_SCHEMA_RETRY_SECONDS:.0f}s): {e}")
+    return _schema_ready
+
+
 def get_pool():
+    """Pool handle for the DB helpers: None means connect.py's pool.
+
+    No connection is checked out here; liveness is handled by the pool
+    itself (connect.ConnectionPool pings idle connections), and the schema
+    is checked once per process.
+    """
     global _pool
     
     # For MySQL, use connect.py if available
     if DB_TYPE == 'mysql' and CONNECT_AVAILABLE:
-        # Use connect.py's connection pool
-        # Test connection
-        try:
-            if connect.test_connection():
-                # Initialize schema using connect.py connection
-                conn = connect.get_connection()
-                try:
-                    _ensure_schema(conn)
-                finally:
-                    connect.close_connection(conn)
-                # Return None to indicate we're using connect.py (not our own pool)
-                _pool = None
-                return None
-            else:
-                print("ERROR: connect.py connection test failed")
-                return None
-        except Exception as e:
-            print(f"ERROR: Failed to use connect.py: {e}")
-            # Fallback to direct MySQL connection
-            print("WARNING: Falling back to direct MySQL connection")
-            # Continue to direct MySQL connection code below
-    
-    # Existing pool validation
+        _ensure_schema_once(connect.get_connection, connect.close_connection)
+        # Return None to indicate we're using connect.py (not our own pool)
+        return None
+
     if _pool is not None:
-        # Test if pool is still valid
-        try:
-            if DB_TYPE == 'postgresql':
-                test_conn = _pool.getconn()
-                _pool.putconn(test_conn)
-            else:
-                test_conn = _get_connection(_pool)
-                _return_connection(_pool, test_conn)
-                return _pool
-        except Exception as e:
-            print(f"WARNING: Existing pool is invalid, recreating: {e}")
-            _pool = None
+        return _pool
     
     # Initializing MySQL database connection pool
     # MySQL connection (fallback if connect.py not available)
-        try:
-            _pool = pooling.MySQLConnectionPool(
-                pool_name="water_pool",
-                pool_size=5,
-                host=DB_HOST,
-                port=DB_PORT,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_NAME,
-                connection_timeout=10,  # 10 second timeout
-                autocommit=True,
-            )
-            print("DEBUG: MySQL connection pool created successfully (direct connection)")
-            
-            # Test the connection
-            _conn = _get_connection(_pool)
-            _ensure_schema(_conn)
-            _return_connection(_pool, _conn)
-            return _pool
-        except Error as init_err:
-            errno = getattr(init_err, 'errno', None)
-            print(f"ERROR: MySQL connection error (errno: {errno}): {init_err}")
-            import traceback
-            traceback.print_exc()
-            
-            if errno == errorcode.ER_BAD_DB_ERROR:
-                _create_database_if_missing()
-                try:
-                    _pool = pooling.MySQLConnectionPool(
-                        pool_name="water_pool",
-                        pool_size=5,
-                        host=DB_HOST,
-                        port=DB_PORT,
-                        user=DB_USER,
-                        password=DB_PASSWORD,
-                        database=DB_NAME,
-                    )
-                    _conn = _get_connection(_pool)
-                    _ensure_schema(_conn)
-                    _return_connection(_pool, _conn)
-                    return _pool
-                except Exception as retry_err:
-                    _pool = None
-                    print(f"ERROR: MySQL init retry failed: {retry_err}")
-                    import traceback
-                    traceback.print_exc()
-            else:
+    try:
+        _pool = pooling.MySQLConnectionPool(
+            pool_name="water_pool",
+            pool_size=DB_POOL_SIZE,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            connection_timeout=10,  # 10 second timeout
+            autocommit=True,
+        )
+        print("DEBUG: MySQL connection pool created successfully (direct connection)")
+        _ensure_schema_once(_pool.get_connection, lambda conn: conn.close())
+        return _pool
+    except Error as init_err:
+        errno = getattr(init_err, 'errno', None)
+        print(f"ERROR: MySQL connection error (errno: {errno}): {init_err}")
+        import traceback
+        traceback.print_exc()
+        
+        if errno == errorcode.ER_BAD_DB_ERROR:
+            _create_database_if_missing()
+            try:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="water_pool",
+                    pool_size=DB_POOL_SIZE,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    database=DB_NAME,
+                )
+                _ensure_schema_once(_pool.get_connection, lambda conn: conn.close())
+                return _pool
+            except Exception as retry_err:
                 _pool = None
-                print(f"ERROR: MySQL init failed: {init_err}")
-                print(f"ERROR: Check MySQL server is running and credentials are correct")
-        except Exception as e:
+                print(f"ERROR: MySQL init retry failed: {retry_err}")
+                import traceback
+                traceback.print_exc()
+        else:
             _pool = None
-            print(f"ERROR: Unexpected error initializing database pool: {e}")
-            import traceback
-            traceback.print_exc()
+            print(f"ERROR: MySQL init failed: {init_err}")
+            print(f"ERROR: Check MySQL server is running and credentials are correct")
+    except Exception as e:
+        _pool = None
+        print(f"ERROR: Unexpected error initializing database pool: {e}")
+        import traceback
+        traceback.print_exc()
     
     return _pool
 
@@ -976,8 +1232,8 @@ def create_sensor(
         cur.execute(
             """
             INSERT INTO sensors (
-                device_id, device_type, sensor_type_id, location, public_key, status, user_id
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                device_id, device_type, sensor_type_id, location, public_key, key_algorithm, status, user_id
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
             """,
             (
                 device_id,
@@ -985,6 +1241,7 @@ def create_sensor(
                 sensor_type_id,
                 location,
                 public_key,
+                key_algorithm_for_pem(public_key),
                 status,
                 user_id,
             ),
@@ -992,6 +1249,7 @@ def create_sensor(
         conn.commit()
         cur.close()
         _return_connection(pool, conn)
+        invalidate_sensor(device_id)
         return True
     except Error as e:
         if getattr(e, 'errno', None) == errorcode.ER_DUP_ENTRY:
@@ -1169,8 +1427,20 @@ def update_sensor_by_device_id(
                     device_id,
                 ),
             )
-        conn.commit()
         updated = cur.rowcount > 0
+        if key_changed and updated:
+            # Signature algorithm follows the new key's PEM type
+            if user_id is not None:
+                cur.execute(
+                    "UPDATE sensors SET key_algorithm = %s WHERE device_id = %s AND user_id = %s",
+                    (key_algorithm_for_pem(public_key), device_id, int(user_id)),
+                )
+            else:
+                cur.execute(
+                    "UPDATE sensors SET key_algorithm = %s WHERE device_id = %s",
+                    (key_algorithm_for_pem(public_key), device_id),
+                )
+        conn.commit()
         
         if not updated:
             import sys
@@ -1192,6 +1462,10 @@ def update_sensor_by_device_id(
         
         cur.close()
         _return_connection(pool, conn)
+        invalidate_sensor(device_id)
+        invalidate_thresholds(device_id)
+        if key_changed:
+            invalidate_public_key(user_id, device_id)
         
         return updated
     except Exception as e:
@@ -1254,6 +1528,145 @@ def list_sensors(limit: int | None = None, user_id: int | None = None):
         print(f"MySQL list_sensors error: {e}")
         return []
 
+# Columns the ingest path needs; public_key is required for signature checks
+_REGISTRY_SENSOR_COLUMNS = (
+    "id, device_id, device_type, location, status, user_id, public_key, "
+    "min_threshold, max_threshold, last_seen, updated_at"
+)
+
+
+def list_registry_sensors(device_id: str | None = None, updated_since=None):
+    """Load sensor rows for the in-memory sensor registry.
+
+    Returns None (not []) on database errors so callers can keep stale data.
+    """
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return None
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn, dictionary=True)
+        if device_id is not None:
+            cur.execute(
+                f"SELECT {_REGISTRY_SENSOR_COLUMNS} FROM sensors WHERE device_id = %s",
+                (device_id,),
+            )
+        elif updated_since is not None:
+            # >= so rows sharing the last second are not missed
+            cur.execute(
+                f"SELECT {_REGISTRY_SENSOR_COLUMNS} FROM sensors WHERE updated_at >= %s",
+                (updated_since,),
+            )
+        else:
+            cur.execute(f"SELECT {_REGISTRY_SENSOR_COLUMNS} FROM sensors")
+        rows = cur.fetchall()
+        cur.close()
+        _return_connection(pool, conn)
+        return rows or []
+    except Exception as e:
+        print(f"MySQL list_registry_sensors error: {e}")
+        return None
+
+
+def get_sensor_registry_stamp():
+    """Return (row count, MAX(updated_at)) for the sensors table, or None on error."""
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return None
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn)
+        cur.execute("SELECT COUNT(*), MAX(updated_at) FROM sensors")
+        row = cur.fetchone()
+        cur.close()
+        _return_connection(pool, conn)
+        if not row:
+            return None
+        return (int(row[0] or 0), row[1])
+    except Exception as e:
+        print(f"MySQL get_sensor_registry_stamp error: {e}")
+        return None
+
+
+def touch_sensors_last_seen(devices) -> bool:
+    """Set sensors.last_seen = NOW() for many devices in one UPDATE.
+
+    Args:
+        devices: Iterable of (device_id, user_id) pairs; a falsy user_id
+            touches every owner of the device_id
+
+    updated_at is left unchanged so the sensor registry doesn't treat
+    heartbeats as configuration changes.
+    """
+    devices = list(devices)
+    if not devices:
+        return True
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return False
+    owned = [(device_id, user_id) for device_id, user_id in devices if user_id]
+    unowned = [device_id for device_id, user_id in devices if not user_id]
+    conditions = []
+    params = []
+    if owned:
+        conditions.append("(device_id, user_id) IN (" + ", ".join(["(%s, %s)"] * len(owned)) + ")")
+        for device_id, user_id in owned:
+            params.extend((device_id, user_id))
+    if unowned:
+        conditions.append("device_id IN (" + ", ".join(["%s"] * len(unowned)) + ")")
+        params.extend(unowned)
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn)
+        cur.execute(
+            f"UPDATE sensors SET last_seen = NOW(), updated_at = updated_at WHERE {' OR '.join(conditions)}",
+            tuple(params),
+        )
+        conn.commit()
+        cur.close()
+        _return_connection(pool, conn)
+        return True
+    except Exception as e:
+        print(f"MySQL touch_sensors_last_seen error: {e}")
+        return False
+
+
+def get_sensors_last_seen(user_id, device_ids) -> dict:
+    """Read sensors.last_seen for some of a user's devices straight from the table.
+
+    The sensor registry only reloads on configuration changes (updated_at),
+    which heartbeats leave alone, so its last_seen is as old as the process.
+
+    Returns:
+        Dict of device_id (as stored) -> last_seen datetime or None; empty on error
+    """
+    device_ids = [device_id for device_id in dict.fromkeys(device_ids) if device_id]
+    if not device_ids or not user_id:
+        return {}
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return {}
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn)
+        cur.execute(
+            f"SELECT device_id, last_seen FROM sensors WHERE user_id = %s "
+            f"AND device_id IN ({', '.join(['%s'] * len(device_ids))})",
+            (int(user_id), *device_ids),
+        )
+        rows = cur.fetchall()
+        cur.close()
+        _return_connection(pool, conn)
+        return {device_id: last_seen for device_id, last_seen in rows}
+    except Exception as e:
+        print(f"MySQL get_sensors_last_seen error: {e}")
+        return {}
+
+
+def touch_sensor_last_seen(device_id: str, user_id: int | None = None) -> bool:
+    """Set sensors.last_seen = NOW() for a device (optionally one owner)."""
+    return touch_sensors_last_seen([(device_id, user_id)])
+
 def count_active_sensors(exclude_device_id: str | None = None) -> int:
     pool = get_pool()
     if not _can_use_database(pool):
@@ -1359,6 +1772,8 @@ def delete_sensor_by_device_id(device_id: str) -> bool:
         deleted = cur.rowcount > 0
         cur.close()
         _return_connection(pool, conn)
+        invalidate_sensor(device_id)
+        invalidate_thresholds(device_id)
         return deleted
     except Exception as e:
         print(f"MySQL delete_sensor_by_device_id error: {e}")
@@ -1393,6 +1808,7 @@ def seed_sensor_types_if_empty():
             conn.commit()
             cur.close()
             _return_connection(pool, conn)
+            invalidate_thresholds(types=True)
             print("Successfully seeded default sensor types")
             return True
         else:
@@ -1467,27 +1883,173 @@ def list_sensor_types():
         # Return empty list on error
         return []
 
-def insert_sensor_data(sensor_db_id: int, value: float, status: str = 'normal', user_id: int | None = None, device_id: str | None = None) -> bool:
+def _on_duplicate_ingest_key() -> str:
+    """INSERT suffix that skips rows whose (sensor_id, ingest_key) is already stored."""
+    return "ON CONFLICT DO NOTHING" if DB_TYPE == 'postgresql' else "ON DUPLICATE KEY UPDATE id = id"
+
+
+def _count_db_duplicates(count: int):
+    from ingest_dedup import get_sequence_window
+    get_sequence_window().count_db_duplicates(count)
+
+
+_sensor_latest_missing_logged = False
+
+
+def _note_sensor_latest_missing():
+    global _sensor_latest_missing_logged
+    if not _sensor_latest_missing_logged:
+        _sensor_latest_missing_logged = True
+        db_log.error("sensor_latest table missing; run: python migrations.py migrate")
+
+
+def _execute_on_latest(cur, sql: str, params=(), user_id: int | None = None):
+    """Run a latest-value query whose FROM clause is {latest} (aliased sl).
+
+    Reads sensor_latest once the schema is known to be current. Before that
+    (sensor_latest missing, or its backfill not committed yet) the newest
+    sensor_data row per sensor and metric stands in, so dashboards never
+    show an empty fleet just because the migration hasn't run.
+
+    Args:
+        user_id: Restricts the sensor_data fallback scan to this user
+    """
+    if _schema_ready:
+        try:
+            cur.execute(sql.format(latest="sensor_latest sl"), tuple(params))
+            return
+        except Error as e:
+            if getattr(e, 'errno', None) != errorcode.ER_NO_SUCH_TABLE:
+                raise
+            _note_sensor_latest_missing()
+    history_where, history_params = ("WHERE user_id = %s", [int(user_id)]) if user_id is not None else ("", [])
+    history = f"""(
+                SELECT sd.* FROM sensor_data sd
+                JOIN (
+                    SELECT MAX(id) AS id FROM sensor_data {history_where}
+                    GROUP BY sensor_id, COALESCE(metric, '')
+                ) newest ON newest.id = sd.id
+            ) sl"""
+    cur.execute(sql.format(latest=history), tuple(history_params) + tuple(params))
+
+
+def _upsert_sensor_latest(cur, rows: list, encrypted_values: list):
+    """Make rows the newest sensor_latest entries of their (sensor, metric).
+
+    Runs on the cursor of the sensor_data INSERT, before its commit, so the
+    latest value and the history row are stored together. Each row keeps its
+    own recorded_at (None = now), and an entry is only replaced by a row at
+    least as recent: write-behind retries, spool replays and gateway
+    backlogs arrive late and must not overwrite a newer value.
+    """
+    newest = {}
+    for row, encrypted_value in zip(rows, encrypted_values):
+        key = (int(row['sensor_db_id']), row.get('metric') or '')
+        current = newest.get(key)
+        if current is None or (row.get('recorded_at') or datetime.max) >= (current[0].get('recorded_at') or datetime.max):
+            newest[key] = (row, encrypted_value)
+    if not newest:
+        return
+    params = []
+    for (sensor_db_id, metric), (row, encrypted_value) in newest.items():
+        params.extend((sensor_db_id, metric, row.get('user_id'), row.get('device_id'),
+                       encrypted_value, row.get('status') or 'normal', row.get('recorded_at')))
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, COALESCE(%s, NOW()))"] * len(newest))
+    # Assignments run left to right, so recorded_at is updated last
+    newer = "(recorded_at IS NULL OR VALUES(recorded_at) >= recorded_at)"
+    try:
+        cur.execute(
+            f"""
+            INSERT INTO sensor_latest (sensor_id, metric, user_id, device_id, value, status, recorded_at)
+            VALUES {placeholders}
+            ON DUPLICATE KEY UPDATE user_id = IF({newer}, VALUES(user_id), user_id),
+                device_id = IF({newer}, VALUES(device_id), device_id),
+                value = IF({newer}, VALUES(value), value),
+                status = IF({newer}, VALUES(status), status),
+                recorded_at = IF({newer}, VALUES(recorded_at), recorded_at)
+            """,
+            tuple(params),
+        )
+    except Error as e:
+        # Schema not migrated yet: still store the reading itself
+        if getattr(e, 'errno', None) != errorcode.ER_NO_SUCH_TABLE:
+            raise
+        _note_sensor_latest_missing()
+
+
+def _skipped_duplicates(cur, rows: list, first_new_id) -> set:
+    """(sensor_db_id, ingest_key) of keyed rows the INSERT skipped as already stored.
+
+    Auto-increment ids only grow, so a row stored before this INSERT has an
+    id below the first one it generated (cursor.lastrowid; none if every
+    row was a duplicate).
+    """
+    keyed = [(int(row['sensor_db_id']), row['ingest_key']) for row in rows if row.get('ingest_key')]
+    if not keyed:
+        return set()
+    if not first_new_id:
+        return set(keyed)
+    placeholders = ", ".join(["(%s, %s)"] * len(keyed))
+    cur.execute(
+        f"SELECT sensor_id, ingest_key FROM sensor_data WHERE (sensor_id, ingest_key) IN ({placeholders}) AND id < %s",
+        tuple(value for pair in keyed for value in pair) + (int(first_new_id),),
+    )
+    return {(int(sensor_id), ingest_key) for sensor_id, ingest_key in cur.fetchall()}
+
+
+def insert_sensor_data(sensor_db_id: int, value: float, status: str = 'normal', user_id: int | None = None, device_id: str | None = None,
+                       extra_values: dict | None = None, ingest_key: str | None = None) -> bool:
+    """Store one reading for a sensor.
+
+    extra_values ({metric: value}) are the other metrics of a multi-parameter
+    payload; they are stored as additional rows (sensor_data.metric set) in
+    the same multi-row INSERT as the primary value.
+
+    ingest_key identifies the reading for idempotent ingest (ingest_dedup.py);
+    a reading already stored under the same key is skipped and reported as
+    stored.
+    """
     pool = get_pool()
     if not _can_use_database(pool):
-        print("ERROR: insert_sensor_data - Database pool is None")
+        db_log.error("insert_sensor_data - Database pool is None")
         return False
     
     if sensor_db_id is None:
-        print(f"ERROR: insert_sensor_data - sensor_db_id is None")
+        db_log.error("insert_sensor_data - sensor_db_id is None")
         return False
     
     if value is None:
-        print(f"WARNING: insert_sensor_data - value is None for sensor_db_id: {sensor_db_id}")
+        db_log.warning("insert_sensor_data - value is None for sensor_db_id: %s", sensor_db_id)
         return False
     
+    rows = [{
+        'sensor_db_id': int(sensor_db_id),
+        'value': value,
+        'status': status or 'normal',
+        'user_id': user_id,
+        'device_id': device_id,
+        'ingest_key': ingest_key,
+    }]
+    for metric, metric_value in (extra_values or {}).items():
+        if metric_value is not None:
+            rows.append(dict(rows[0], value=metric_value, metric=metric,
+                             ingest_key=f"{ingest_key}/{metric}" if ingest_key else None))
+
+    # Write-behind mode: queue the rows; the writer thread bulk-inserts them
+    if SENSOR_WRITE_BEHIND and user_id is not None and device_id is not None:
+        writer = get_sensor_writer()
+        # All rows of the reading in one queue item: stored together or rejected together
+        return writer.submit(rows)
+
+    if len(rows) > 1:
+        return insert_sensor_data_batch(rows) > 0
+    
     try:
-        # Encrypt sensor value before storing
-        encryption = get_db_encryption()
-        encrypted_value = encryption.encrypt_value(value)
+        # Encrypt sensor value before storing (in the crypto pool when enabled)
+        encrypted_value = get_crypto_executor().encrypt_values([value])[0]
         
         if encrypted_value is None:
-            print(f"ERROR: insert_sensor_data - encryption returned None for value: {value}")
+            db_log.error("insert_sensor_data - encryption returned None for value: %s", value)
             return False
         
         conn = _get_connection(pool)
@@ -1510,39 +2072,105 @@ def insert_sensor_data(sensor_db_id: int, value: float, status: str = 'normal',
         cur = conn.cursor()
         
         cur.execute(
-            """
-            INSERT INTO sensor_data (sensor_id, user_id, device_id, value, status)
-            VALUES (%s, %s, %s, %s, %s)
+            f"""
+            INSERT INTO sensor_data (sensor_id, user_id, device_id, ingest_key, value, status)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            {_on_duplicate_ingest_key() if ingest_key else ''}
             """,
-            (int(sensor_db_id), user_id, device_id, encrypted_value, status or 'normal'),
+            (int(sensor_db_id), user_id, device_id, ingest_key, encrypted_value, status or 'normal'),
         )
-        conn.commit()
         rows_affected = cur.rowcount
+        if rows_affected > 0:
+            # A skipped duplicate is an old reading; it must not become the latest
+            _upsert_sensor_latest(cur, [dict(rows[0], user_id=user_id, device_id=device_id)], [encrypted_value])
+        conn.commit()
         cur.close()
         _return_connection(pool, conn)
         
         if rows_affected > 0:
-            import sys
-            msg = f"DEBUG: insert_sensor_data - Successfully inserted row for sensor_db_id: {sensor_db_id}, value: {value}\n"
-            print(msg, file=sys.stderr)
-            sys.stderr.flush()
+            db_log.debug("insert_sensor_data - Successfully inserted row for sensor_db_id: %s, value: %s", sensor_db_id, value)
+            return True
+        elif ingest_key:
+            db_log.debug("insert_sensor_data - Reading %s already stored for sensor_db_id: %s", ingest_key, sensor_db_id)
+            _count_db_duplicates(1)
             return True
         else:
-            import sys
-            msg = f"WARNING: insert_sensor_data - No rows affected for sensor_db_id: {sensor_db_id}\n"
-            print(msg, file=sys.stderr)
-            sys.stderr.flush()
+            db_log.warning("insert_sensor_data - No rows affected for sensor_db_id: %s", sensor_db_id)
             return False
     except Exception as e:
-        import sys
-        import traceback
-        msg = f"ERROR: MySQL insert_sensor_data error for sensor_db_id {sensor_db_id}: {e}\n"
-        msg += traceback.format_exc()
-        print(msg, file=sys.stderr)
-        sys.stderr.flush()
+        db_log.exception("MySQL insert_sensor_data error for sensor_db_id %s: %s", sensor_db_id, e)
         return False
 
 
+def insert_sensor_data_batch(rows: list) -> int:
+    """Insert many sensor_data rows with one multi-row INSERT and one commit.
+
+    Args:
+        rows: List of dicts with sensor_db_id, value, status, user_id, device_id
+            and optional metric (None = the sensor's device_type), ingest_key
+            and recorded_at (None = now; write-behind rows carry the time
+            they were submitted)
+
+    Returns:
+        Number of rows stored, counting rows skipped because their ingest_key
+        was already stored (0 on error or when rows is empty)
+    """
+    if not rows:
+        return 0
+    pool = get_pool()
+    if not _can_use_database(pool):
+        db_log.error("insert_sensor_data_batch - Database pool is None")
+        return 0
+    try:
+        encrypted_values = get_crypto_executor().encrypt_values([row['value'] for row in rows])
+        params = []
+        for row, encrypted_value in zip(rows, encrypted_values):
+            params.extend((
+                int(row['sensor_db_id']),
+                row.get('user_id'),
+                row.get('device_id'),
+                row.get('metric'),
+                row.get('ingest_key'),
+                encrypted_value,
+                row.get('status') or 'normal',
+                row.get('recorded_at'),
+            ))
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP))"] * len(rows))
+        keyed = any(row.get('ingest_key') for row in rows)
+        conn = _get_connection(pool)
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO sensor_data (sensor_id, user_id, device_id, metric, ingest_key, value, status, recorded_at)
+            VALUES {placeholders}
+            {_on_duplicate_ingest_key() if keyed else ''}
+            """,
+            tuple(params),
+        )
+        rows_affected = cur.rowcount
+        latest_rows, latest_values = rows, encrypted_values
+        if keyed and 0 <= rows_affected < len(rows):
+            # Some readings were already stored: keep them out of sensor_latest
+            skipped = _skipped_duplicates(cur, rows, cur.lastrowid)
+            kept = [(row, value) for row, value in zip(rows, encrypted_values)
+                    if (int(row['sensor_db_id']), row.get('ingest_key')) not in skipped]
+            latest_rows = [row for row, _ in kept]
+            latest_values = [value for _, value in kept]
+        _upsert_sensor_latest(cur, latest_rows, latest_values)
+        conn.commit()
+        cur.close()
+        _return_connection(pool, conn)
+        if keyed:
+            # Skipped duplicates affect no rows; the batch as a whole was stored
+            if 0 <= rows_affected < len(rows):
+                _count_db_duplicates(len(rows) - rows_affected)
+            return len(rows)
+        return rows_affected if rows_affected and rows_affected > 0 else 0
+    except Exception as e:
+        db_log.exception("MySQL insert_sensor_data_batch error (%d rows): %s", len(rows), e)
+        return 0
+
+
 def get_sensor_type_by_type(sensor_type: str):
     pool = get_pool()
     if not _can_use_database(pool):
@@ -1570,6 +2198,69 @@ def get_sensor_type_by_type(sensor_type: str):
     
 # Deprecated threshold functions removed - using sensor_type defaults instead
 
+def _recent_sensor_data_query(limit: int, user_id: int | None = None, by_location: bool = False,
+                              location: str | None = None, date_from=None, date_to=None):
+    """SQL and params for the newest sensor_data rows, newest first.
+
+    The reading lists all go through here, so benchmarks/check_query_plans.py
+    EXPLAINs exactly what they run. Filters on sd.user_id (or sd.sensor_id via
+    the join) plus ORDER BY recorded_at DESC, id DESC are what the
+    idx_sensor_data_*_time indexes (migration 2) are for.
+
+    Args:
+        by_location: Only sensors at location (None = unassigned: NULL or '')
+    """
+    where_clauses = []
+    params = []
+    if by_location:
+        if location:
+            where_clauses.append("s.location = %s")
+            params.append(location)
+        else:
+            where_clauses.append("(s.location IS NULL OR s.location = '')")
+        if user_id is not None:
+            where_clauses.append("s.user_id = %s")
+            params.append(int(user_id))
+    if user_id is not None:
+        where_clauses.append("sd.user_id = %s")
+        params.append(int(user_id))
+
+    if date_from:
+        where_clauses.append("sd.recorded_at >= %s")
+        params.append(date_from)
+    if date_to:
+        # If date_to is just a date (no time), include the entire day
+        if isinstance(date_to, datetime) and date_to.hour == 0 and date_to.minute == 0 and date_to.second == 0:
+            from datetime import timedelta
+            where_clauses.append("sd.recorded_at < %s")
+            params.append(date_to + timedelta(days=1) - timedelta(seconds=1))
+        else:
+            where_clauses.append("sd.recorded_at <= %s")
+            params.append(date_to)
+
+    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+    params.append(int(limit))
+    query = f"""
+        SELECT 
+            sd.id,
+            sd.sensor_id AS sensor_db_id,
+            sd.user_id,
+            sd.device_id,
+            sd.recorded_at,
+            sd.value,
+            sd.status,
+            sd.metric,
+            COALESCE(sd.metric, s.device_type) AS device_type,
+            s.location
+        FROM sensor_data sd
+        {'INNER' if by_location else 'LEFT'} JOIN sensors s ON s.id = sd.sensor_id
+        {where_sql}
+        ORDER BY sd.recorded_at DESC, sd.id DESC
+        LIMIT %s
+    """
+    return query, tuple(params)
+
+
 def list_recent_sensor_data(limit: int = 100, user_id: int | None = None):
     pool = get_pool()
     if not _can_use_database(pool):
@@ -1577,49 +2268,9 @@ def list_recent_sensor_data(limit: int = 100, user_id: int | None = None):
     try:
         conn = _get_connection(pool)
         cur = _get_cursor(conn, dictionary=True)
-        if user_id is not None:
-            # Use user_id directly from sensor_data table (no JOIN needed)
-            cur.execute(
-                """
-                SELECT 
-                    sd.id,
-                    sd.sensor_id AS sensor_db_id,
-                    sd.user_id,
-                    sd.device_id,
-                    sd.recorded_at,
-                    sd.value,
-                    sd.status,
-                    s.device_type,
-                    s.location
-                FROM sensor_data sd
-                LEFT JOIN sensors s ON s.id = sd.sensor_id
-                WHERE sd.user_id = %s
-                ORDER BY sd.recorded_at DESC, sd.id DESC
-                LIMIT %s
-                """,
-                (int(user_id), int(limit)),
-            )
-        else:
-            # No user filter - get all data
-            cur.execute(
-                """
-                SELECT 
-                    sd.id,
-                    sd.sensor_id AS sensor_db_id,
-                    sd.user_id,
-                    sd.device_id,
-                    sd.recorded_at,
-                    sd.value,
-                    sd.status,
-                    s.device_type,
-                    s.location
-                FROM sensor_data sd
-                LEFT JOIN sensors s ON s.id = sd.sensor_id
-                ORDER BY sd.recorded_at DESC, sd.id DESC
-                LIMIT %s
-                """,
-                (int(limit),),
-            )
+        # sd.user_id directly (no JOIN needed to filter); sensors only adds the location
+        query, params = _recent_sensor_data_query(limit, user_id=user_id)
+        cur.execute(query, params)
         rows = cur.fetchall() or []
         cur.close()
         _return_connection(pool, conn)
@@ -1650,6 +2301,74 @@ def list_recent_sensor_data(limit: int = 100, user_id: int | None = None):
         print(f"MySQL list_recent_sensor_data error: {e}")
         return []
 
+_ANY_LOCATION = object()
+
+
+def list_latest_sensor_data(user_id: int | None = None, location=_ANY_LOCATION):
+    """Newest reading of every sensor (and every extra metric), from sensor_latest.
+
+    One row per sensor and metric, newest first, in the shape of
+    list_recent_sensor_data rows (values decrypted). Falls back to
+    sensor_data until sensor_latest is migrated (_execute_on_latest).
+
+    Args:
+        user_id: Only this user's sensors
+        location: Only sensors at this location ('Unassigned' or None = no
+            location); all locations when omitted
+    """
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return []
+    where_clauses = []
+    params = []
+    if location is not _ANY_LOCATION:
+        location_filter = None if location == 'Unassigned' else location
+        if location_filter:
+            where_clauses.append("s.location = %s")
+            params.append(location_filter)
+        else:
+            where_clauses.append("(s.location IS NULL OR s.location = '')")
+    if user_id is not None:
+        where_clauses.append("sl.user_id = %s")
+        params.append(int(user_id))
+    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn, dictionary=True)
+        _execute_on_latest(
+            cur,
+            f"""
+            SELECT
+                sl.sensor_id AS sensor_db_id,
+                sl.user_id,
+                sl.device_id,
+                sl.recorded_at,
+                sl.value,
+                sl.status,
+                NULLIF(sl.metric, '') AS metric,
+                COALESCE(NULLIF(sl.metric, ''), s.device_type) AS device_type,
+                s.location
+            FROM {{latest}}
+            JOIN sensors s ON s.id = sl.sensor_id
+            {where_sql}
+            ORDER BY sl.recorded_at DESC
+            """,
+            params,
+            user_id=user_id,
+        )
+        rows = cur.fetchall() or []
+        cur.close()
+        _return_connection(pool, conn)
+
+        encryption = get_db_encryption()
+        for row in rows:
+            row['value'] = encryption.decrypt_value(row.get('value'))
+        return rows
+    except Exception as e:
+        print(f"MySQL list_latest_sensor_data error: {e}")
+        return []
+
+
 def get_locations_with_status(user_id: int | None = None, realtime_metrics_data: dict | None = None):
     """Get all locations with their latest safety status and sensor count.
     
@@ -1721,16 +2440,8 @@ def get_locations_with_status(user_id: int | None = None, realtime_metrics_data:
         # Get safety status for each location
         result = []
         # Build default thresholds map (fallback)
-        default_thresholds = {}
-        try:
-            for t in list_sensor_types() or []:
-                type_name = (t.get('type_name') or '').lower()
-                default_thresholds[type_name] = {
-                    'min': t.get('default_min'),
-                    'max': t.get('default_max'),
-                }
-        except Exception:
-            pass
+        threshold_cache = get_threshold_cache()
+        default_thresholds = threshold_cache.type_defaults()
         
         # Get sensors by location for filtering real-time data
         sensors_by_location = {}
@@ -1794,52 +2505,49 @@ def get_locations_with_status(user_id: int | None = None, realtime_metrics_data:
             if user_id is not None:
                 conn = _get_connection(pool)
                 cur = _get_cursor(conn, dictionary=True)
-                # IMPORTANT: Filter by BOTH sensor.user_id AND sensor_data.user_id
+                # Latest value per sensor and metric (sensor_latest): one row each.
+                # IMPORTANT: Filter by BOTH sensor.user_id AND the reading's user_id
                 # This ensures only data from sensors owned by this user is shown
                 if location_filter:
-                    cur.execute("""
-                        SELECT sd.value, s.device_type, sd.recorded_at, s.user_id as sensor_user_id, sd.user_id as data_user_id
-                        FROM sensor_data sd
-                        JOIN sensors s ON s.id = sd.sensor_id
+                    _execute_on_latest(cur, """
+                        SELECT sl.value, COALESCE(NULLIF(sl.metric, ''), s.device_type) AS device_type, sl.recorded_at, s.user_id as sensor_user_id, sl.user_id as data_user_id
+                        FROM {latest}
+                        JOIN sensors s ON s.id = sl.sensor_id
                         WHERE s.location = %s 
                         AND s.user_id = %s 
-                        AND sd.user_id = %s
-                        ORDER BY sd.recorded_at DESC
-                        LIMIT 100
-                    """, (location_filter, int(user_id), int(user_id)))
+                        AND sl.user_id = %s
+                        ORDER BY sl.recorded_at DESC
+                    """, (location_filter, int(user_id), int(user_id)), user_id=user_id)
                 else:
                     # Handle "Unassigned" - sensors with NULL/empty location
-                    cur.execute("""
-                        SELECT sd.value, s.device_type, sd.recorded_at, s.user_id as sensor_user_id, sd.user_id as data_user_id
-                        FROM sensor_data sd
-                        JOIN sensors s ON s.id = sd.sensor_id
+                    _execute_on_latest(cur, """
+                        SELECT sl.value, COALESCE(NULLIF(sl.metric, ''), s.device_type) AS device_type, sl.recorded_at, s.user_id as sensor_user_id, sl.user_id as data_user_id
+                        FROM {latest}
+                        JOIN sensors s ON s.id = sl.sensor_id
                         WHERE (s.location IS NULL OR s.location = '')
                         AND s.user_id = %s 
-                        AND sd.user_id = %s
-                        ORDER BY sd.recorded_at DESC
-                        LIMIT 100
-                    """, (int(user_id), int(user_id)))
+                        AND sl.user_id = %s
+                        ORDER BY sl.recorded_at DESC
+                    """, (int(user_id), int(user_id)), user_id=user_id)
             else:
                 conn = _get_connection(pool)
                 cur = _get_cursor(conn, dictionary=True)
                 if location_filter:
-                    cur.execute("""
-                        SELECT sd.value, s.device_type, sd.recorded_at
-                        FROM sensor_data sd
-                        JOIN sensors s ON s.id = sd.sensor_id
+                    _execute_on_latest(cur, """
+                        SELECT sl.value, COALESCE(NULLIF(sl.metric, ''), s.device_type) AS device_type, sl.recorded_at
+                        FROM {latest}
+                        JOIN sensors s ON s.id = sl.sensor_id
                         WHERE s.location = %s
-                        ORDER BY sd.recorded_at DESC
-                        LIMIT 100
+                        ORDER BY sl.recorded_at DESC
                     """, (location_filter,))
                 else:
                     # Handle "Unassigned" - sensors with NULL/empty location
-                    cur.execute("""
-                        SELECT sd.value, s.device_type, sd.recorded_at
-                        FROM sensor_data sd
-                        JOIN sensors s ON s.id = sd.sensor_id
+                    _execute_on_latest(cur, """
+                        SELECT sl.value, COALESCE(NULLIF(sl.metric, ''), s.device_type) AS device_type, sl.recorded_at
+                        FROM {latest}
+                        JOIN sensors s ON s.id = sl.sensor_id
                         WHERE (s.location IS NULL OR s.location = '')
-                        ORDER BY sd.recorded_at DESC
-                        LIMIT 100
+                        ORDER BY sl.recorded_at DESC
                     """)
             
             rows = cur.fetchall()
@@ -1892,9 +2600,7 @@ def get_locations_with_status(user_id: int | None = None, realtime_metrics_data:
                     for loc_sensor in sensors_by_location[location]:
                         if loc_sensor['device_type'] == device_type:
                             try:
-                                # Import here to avoid circular dependency
-                                from app import build_effective_thresholds_for_sensor
-                                sensor_thresholds = build_effective_thresholds_for_sensor(loc_sensor['device_id'])
+                                sensor_thresholds = threshold_cache.for_device(loc_sensor['device_id'])
                                 if sensor_thresholds and device_type in sensor_thresholds:
                                     effective_thresholds[device_type] = sensor_thresholds[device_type]
                                     break
@@ -1984,62 +2690,10 @@ def list_recent_sensor_data_by_location(location: str, limit: int = 200, user_id
         conn = _get_connection(pool)
         cur = _get_cursor(conn, dictionary=True)
         
-        # Build WHERE clause with date filtering
-        where_clauses = []
-        params = []
-        
-        if location_filter:
-            where_clauses.append("s.location = %s")
-            params.append(location_filter)
-        else:
-            where_clauses.append("(s.location IS NULL OR s.location = '')")
-        
-        if user_id is not None:
-            where_clauses.append("s.user_id = %s")
-            params.append(int(user_id))
-            where_clauses.append("sd.user_id = %s")
-            params.append(int(user_id))
-        
-        if date_from:
-            where_clauses.append("sd.recorded_at >= %s")
-            params.append(date_from)
-        if date_to:
-            # Use < instead of <= to avoid timezone issues, or add time to end of day
-            # If date_to is just a date (no time), add end of day time
-            if isinstance(date_to, datetime) and date_to.hour == 0 and date_to.minute == 0 and date_to.second == 0:
-                # It's just a date, so include the entire day
-                from datetime import timedelta
-                date_to_end = date_to + timedelta(days=1) - timedelta(seconds=1)
-                where_clauses.append("sd.recorded_at < %s")
-                params.append(date_to_end)
-            else:
-                where_clauses.append("sd.recorded_at <= %s")
-                params.append(date_to)
-        
-        where_sql = " AND ".join(where_clauses)
-        params.append(int(limit))
-        
-        # Use INNER JOIN to ensure we only get data with valid sensor records
-        # This ensures location filtering works correctly
-        query = f"""
-            SELECT 
-                sd.id,
-                sd.sensor_id AS sensor_db_id,
-                sd.user_id,
-                sd.device_id,
-                sd.recorded_at,
-                sd.value,
-                sd.status,
-                s.device_type,
-                s.location
-            FROM sensor_data sd
-            INNER JOIN sensors s ON s.id = sd.sensor_id
-            WHERE {where_sql}
-            ORDER BY sd.recorded_at DESC, sd.id DESC
-            LIMIT %s
-        """
-        
-        cur.execute(query, tuple(params))
+        # INNER JOIN so only rows with a sensor record (and its location) match
+        query, params = _recent_sensor_data_query(limit, user_id=user_id, by_location=True, location=location_filter,
+                                                  date_from=date_from, date_to=date_to)
+        cur.execute(query, params)
         rows = cur.fetchall() or []
         cur.close()
         _return_connection(pool, conn)
@@ -2223,6 +2877,105 @@ def update_device_session(session_token: str, counter: int, expires_at: datetime
         return False
 
 
+def update_device_sessions_batch(updates: list) -> int:
+    """Persist many session counters/expirations in one transaction.
+
+    Args:
+        updates: List of (session_token, counter, ttl_seconds) tuples; the new
+            expires_at is NOW() + ttl_seconds (MySQL clock, like update_device_session)
+
+    Returns:
+        Number of updates written (0 on error)
+    """
+    if not updates:
+        return 0
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return 0
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn)
+        cur.executemany(
+            """
+            UPDATE device_sessions
+            SET counter = GREATEST(counter, %s), expires_at = DATE_ADD(NOW(), INTERVAL %s SECOND), last_used_at = CURRENT_TIMESTAMP
+            WHERE session_token = %s
+            """,
+            [(int(counter), int(ttl_seconds), token) for token, counter, ttl_seconds in updates],
+        )
+        conn.commit()
+        cur.close()
+        _return_connection(pool, conn)
+        return len(updates)
+    except Exception as e:
+        print(f"MySQL update_device_sessions_batch error: {e}")
+        return 0
+
+
+def set_device_session_key(session_token: str, encrypted_key: str, ttl_seconds: int) -> bool:
+    """Attach a negotiated session key to a device session.
+
+    Args:
+        session_token: Session the key belongs to
+        encrypted_key: Session key, already encrypted for storage (DatabaseEncryption)
+        ttl_seconds: Key lifetime; key_expires_at is NOW() + ttl_seconds (MySQL clock)
+    """
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return False
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn)
+        cur.execute(
+            """
+            UPDATE device_sessions
+            SET session_key = %s, key_expires_at = DATE_ADD(NOW(), INTERVAL %s SECOND)
+            WHERE session_token = %s
+            """,
+            (encrypted_key, int(ttl_seconds), session_token),
+        )
+        conn.commit()
+        updated = cur.rowcount > 0
+        cur.close()
+        _return_connection(pool, conn)
+        return updated
+    except Exception as e:
+        print(f"MySQL set_device_session_key error: {e}")
+        return False
+
+
+def get_device_session_key(session_token: str):
+    """Get the negotiated key of an unexpired device session.
+
+    Returns:
+        dict with device_id, session_key (encrypted for storage) and
+        key_ttl_seconds (remaining key lifetime), or None if the session is
+        unknown, expired or has no key
+    """
+    pool = get_pool()
+    if not _can_use_database(pool):
+        return None
+    try:
+        conn = _get_connection(pool)
+        cur = _get_cursor(conn, dictionary=True)
+        cur.execute(
+            """
+            SELECT device_id, session_key, TIMESTAMPDIFF(SECOND, NOW(), key_expires_at) AS key_ttl_seconds
+            FROM device_sessions
+            WHERE session_token = %s AND expires_at > NOW() AND session_key IS NOT NULL
+            LIMIT 1
+            """,
+            (session_token,),
+        )
+        row = cur.fetchone()
+        cur.close()
+        _return_connection(pool, conn)
+        return row
+    except Exception as e:
+        print(f"MySQL get_device_session_key error: {e}")
+        return None
+
+
 def delete_device_session(session_token: str) -> bool:
     """Delete a device session."""
     pool = get_pool()
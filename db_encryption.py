@@ -13,6 +13,7 @@ Key Management:
 
 import os
 import base64
+import time
 from typing import Optional
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
@@ -88,7 +89,33 @@ class DatabaseEncryption:
             return base64.b64encode(encrypted_bytes).decode('utf-8')
         except Exception as e:
             raise ValueError(f"Encryption failed for value {value}: {e}")
-    
+
+    def encrypt_values(self, values: list) -> list:
+        """
+        Encrypt many sensor values for one multi-row INSERT.
+
+        Same output as encrypt_value per item, but the Fernet timestamp is
+        taken once for the whole batch.
+
+        Args:
+            values: List of sensor readings (float or None)
+
+        Returns:
+            List of base64-encoded encrypted strings (None for None inputs)
+        """
+        now = int(time.time())
+        result = []
+        for value in values:
+            if value is None:
+                result.append(None)
+                continue
+            try:
+                encrypted_bytes = self._fernet.encrypt_at_time(str(value).encode('utf-8'), now)
+                result.append(base64.b64encode(encrypted_bytes).decode('utf-8'))
+            except Exception as e:
+                raise ValueError(f"Encryption failed for value {value}: {e}")
+        return result
+
     def decrypt_value(self, encrypted_str: Optional[str]) -> Optional[float]:
         """
         Decrypt a sensor value from database storage.
@@ -118,6 +145,39 @@ class DatabaseEncryption:
                 print(f"WARNING: Failed to decrypt value (may be legacy data): {e}")
                 return None
     
+    def encrypt_text(self, text: Optional[str]) -> Optional[str]:
+        """
+        Encrypt a secret string (e.g. a negotiated device session key) for storage.
+
+        Args:
+            text: Plaintext string or None
+
+        Returns:
+            Base64-encoded encrypted string, or None if input is None
+        """
+        if text is None:
+            return None
+        encrypted_bytes = self._fernet.encrypt(text.encode('utf-8'))
+        return base64.b64encode(encrypted_bytes).decode('utf-8')
+
+    def decrypt_text(self, encrypted_str: Optional[str]) -> Optional[str]:
+        """
+        Decrypt a string stored with encrypt_text.
+
+        Args:
+            encrypted_str: Base64-encoded encrypted string from database, or None
+
+        Returns:
+            Decrypted string, or None if input is empty or decryption fails
+        """
+        if not encrypted_str:
+            return None
+        try:
+            return self._fernet.decrypt(base64.b64decode(encrypted_str.encode('utf-8'))).decode('utf-8')
+        except Exception as e:
+            print(f"WARNING: Failed to decrypt stored secret: {e}")
+            return None
+
     def encrypt_dict_values(self, data_dict: dict, fields_to_encrypt: list) -> dict:
         """
         Encrypt specific fields in a dictionary.
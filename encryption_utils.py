@@ -1,16 +1,93 @@
 from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
+from Crypto.Signature import pkcs1_15
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
 import json, base64
 import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 
-def encrypt_data(data_dict, public_key_path):
+# How often (seconds) a cached key file is re-stat'ed to pick up rotation
+KEY_RELOAD_CHECK_SECONDS = float(os.environ.get('KEY_RELOAD_CHECK_SECONDS', '1'))
+# Key files kept parsed; least recently used ones beyond this are dropped
+# (provisioning encrypts with a fresh temp PEM per message)
+KEY_MATERIAL_CACHE_SIZE = int(os.environ.get('KEY_MATERIAL_CACHE_SIZE', '64'))
+
+
+class KeyMaterialManager:
+    # Loads RSA keys once per path and hands out ready-to-use OAEP ciphers.
+    # A key file is re-read only when its mtime/size changes, so rotating
+    # keys/private.pem takes effect without a restart. At most max_entries
+    # paths are cached, least recently used first out.
+
+    def __init__(self, check_interval=KEY_RELOAD_CHECK_SECONDS, max_entries=KEY_MATERIAL_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._check_interval = check_interval
+        self._max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()  # path -> {'stamp', 'checked', 'key', 'cipher'}
+        self.loads = 0
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry['checked'] < self._check_interval:
+                self._entries.move_to_end(path)
+                return entry
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['stamp'] == stamp:
+                entry['checked'] = now
+                return entry
+        with open(path) as f:
+            key = RSA.import_key(f.read())
+        entry = {'stamp': stamp, 'checked': now, 'key': key, 'cipher': PKCS1_OAEP.new(key)}
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self.loads += 1
+        return entry
+
+    def get_key(self, path):
+        return self._entry(path)['key']
+
+    def get_cipher(self, path):
+        # PKCS1_OAEP cipher objects keep no per-message state and can be shared
+        return self._entry(path)['cipher']
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+
+key_material = KeyMaterialManager()
+
+
+def get_rsa_cipher(key_path):
+    return key_material.get_cipher(key_path)
+
+
+def encrypt_data(data_dict, public_key_path, cipher_rsa=None):
     session_key = get_random_bytes(16)
     cipher_aes = AES.new(session_key, AES.MODE_EAX)
     ciphertext, tag = cipher_aes.encrypt_and_digest(json.dumps(data_dict).encode())
 
-    recipient_key = RSA.import_key(open(public_key_path).read())
-    cipher_rsa = PKCS1_OAEP.new(recipient_key)
+    if cipher_rsa is None:
+        cipher_rsa = key_material.get_cipher(public_key_path)
     encrypted_session_key = cipher_rsa.encrypt(session_key)
 
     return {
@@ -20,14 +97,14 @@ def encrypt_data(data_dict, public_key_path):
         "tag": base64.b64encode(tag).decode()
     }
 
-def decrypt_data(encrypted_payload, private_key_path):
+def decrypt_data(encrypted_payload, private_key_path=None, cipher_rsa=None):
     encrypted_session_key = base64.b64decode(encrypted_payload['session_key'])
     nonce = base64.b64decode(encrypted_payload['nonce'])
     ciphertext = base64.b64decode(encrypted_payload['ciphertext'])
     tag = base64.b64decode(encrypted_payload['tag'])
 
-    private_key = RSA.import_key(open(private_key_path).read())
-    cipher_rsa = PKCS1_OAEP.new(private_key)
+    if cipher_rsa is None:
+        cipher_rsa = key_material.get_cipher(private_key_path)
     session_key = cipher_rsa.decrypt(encrypted_session_key)
 
     cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
@@ -35,6 +112,93 @@ def decrypt_data(encrypted_payload, private_key_path):
 
     return json.loads(decrypted_data.decode())
 
+def encrypt_session_data(data_dict, session_key, session_token):
+    # Symmetric envelope for devices holding a negotiated session key: AES-GCM
+    # with the session token as associated data, no per-message RSA
+    cipher_aes = AES.new(session_key, AES.MODE_GCM)
+    cipher_aes.update(session_token.encode())
+    ciphertext, tag = cipher_aes.encrypt_and_digest(json.dumps(data_dict).encode())
+    return {
+        "session_token": session_token,
+        "nonce": base64.b64encode(cipher_aes.nonce).decode(),
+        "ciphertext": base64.b64encode(ciphertext).decode(),
+        "tag": base64.b64encode(tag).decode()
+    }
+
+def decrypt_session_data(encrypted_payload, session_key):
+    nonce = base64.b64decode(encrypted_payload['nonce'])
+    ciphertext = base64.b64decode(encrypted_payload['ciphertext'])
+    tag = base64.b64decode(encrypted_payload['tag'])
+
+    cipher_aes = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+    cipher_aes.update(encrypted_payload['session_token'].encode())
+    decrypted_data = cipher_aes.decrypt_and_verify(ciphertext, tag)
+
+    return json.loads(decrypted_data.decode())
+
+# Device signature algorithms, chosen by the type of the sensor's PEM key:
+# RSA keys sign SHA-256 with PKCS#1 v1.5 (pycryptodome), Ed25519 keys sign the
+# message itself (RFC 8032, via the OpenSSL-backed cryptography package)
+KEY_ALGORITHMS = ('rsa', 'ed25519')
+
+def generate_device_key(algorithm='rsa'):
+    if algorithm == 'ed25519':
+        return Ed25519PrivateKey.generate()
+    if algorithm == 'rsa':
+        return RSA.generate(2048)
+    raise ValueError(f"Unsupported key algorithm: {algorithm}")
+
+def export_key_pair(key):
+    # (private PEM bytes, public PEM bytes); Ed25519 uses PKCS#8 / SPKI PEM
+    if isinstance(key, Ed25519PrivateKey):
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        public_pem = key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        return private_pem, public_pem
+    return key.export_key(), key.publickey().export_key()
+
+def import_key(pem):
+    # RSA or Ed25519 key (public or private) from PEM text/bytes
+    try:
+        return RSA.import_key(pem)
+    except ValueError:
+        pass
+    pem_bytes = pem.encode() if isinstance(pem, str) else pem
+    if b'PRIVATE KEY' in pem_bytes:
+        key = serialization.load_pem_private_key(pem_bytes, password=None)
+    else:
+        key = serialization.load_pem_public_key(pem_bytes)
+    if not isinstance(key, (Ed25519PrivateKey, Ed25519PublicKey)):
+        raise ValueError(f"Unsupported key type: {type(key).__name__}")
+    return key
+
+def key_algorithm(key):
+    return 'ed25519' if isinstance(key, (Ed25519PrivateKey, Ed25519PublicKey)) else 'rsa'
+
+def key_algorithm_for_pem(pem):
+    if not pem:
+        return None
+    try:
+        return key_algorithm(import_key(pem))
+    except Exception:
+        return None
+
+def sign_message(private_key, message):
+    if isinstance(private_key, Ed25519PrivateKey):
+        return private_key.sign(message)
+    return pkcs1_15.new(private_key).sign(SHA256.new(message))
+
+def verify_signature(public_key, message, signature):
+    # Raises ValueError if the signature does not match
+    if isinstance(public_key, Ed25519PublicKey):
+        try:
+            public_key.verify(signature, message)
+        except InvalidSignature:
+            raise ValueError("Invalid signature")
+    else:
+        pkcs1_15.new(public_key).verify(SHA256.new(message), signature)
+
 def pad(s):
     return s + (16 - len(s) % 16) * chr(16 - len(s) % 16)
 
@@ -0,0 +1,211 @@
+"""
+Coalesced sensors.last_seen heartbeats and online status.
+
+Every stored MQTT reading used to run its own UPDATE sensors SET last_seen =
+NOW() on a pooled connection with its own commit: one extra write per
+reading on the same rows update_sensor_by_device_id locks. Stored readings
+(both transports) now only record the time in an in-memory map, and a
+background thread writes every device seen since the previous flush with a
+single bulk UPDATE each HEARTBEAT_FLUSH_SECONDS; last_seen is accurate to
+that interval. A failed flush keeps its devices for the next one.
+
+The same map answers "is this sensor online?" (a reading within
+HEARTBEAT_ONLINE_SECONDS) for the dashboard. The map is per process and
+with several workers each one sees only its share of every device's
+readings, so devices this process has not seen within the online window
+are looked up in sensors.last_seen (one query per status request, see
+statuses()); another worker's readings show up there after its next flush.
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from sensor_registry import normalize_device_id
+
+
+HEARTBEAT_FLUSH_SECONDS = float(os.environ.get('HEARTBEAT_FLUSH_SECONDS', '5'))
+HEARTBEAT_ONLINE_SECONDS = float(os.environ.get('HEARTBEAT_ONLINE_SECONDS', '300'))
+# Devices per UPDATE statement
+HEARTBEAT_FLUSH_BATCH = int(os.environ.get('HEARTBEAT_FLUSH_BATCH', '500'))
+
+
+class HeartbeatTracker:
+    """Last-reading times per sensor, flushed to sensors.last_seen in bulk."""
+
+    def __init__(self, flush_seconds: float = HEARTBEAT_FLUSH_SECONDS,
+                 online_seconds: float = HEARTBEAT_ONLINE_SECONDS,
+                 batch_size: int = HEARTBEAT_FLUSH_BATCH):
+        self._flush_seconds = max(0.1, float(flush_seconds))
+        self.online_seconds = float(online_seconds)
+        self._batch_size = max(1, int(batch_size))
+        self._lock = threading.Lock()
+        self._seen = {}        # normalized device_id -> {user_id: epoch seconds of the last reading}
+        self._pending = set()  # (device_id as stored, user_id) seen since the last flush
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'touches': 0, 'flushes': 0, 'flushed_devices': 0, 'failed_flushes': 0,
+                       'last_flush_ms': None, 'max_flush_ms': 0.0}
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='heartbeat-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the flusher and write whatever is still pending."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_seconds):
+            self.flush()
+
+    # ------------------------------------------------------------------ producer side
+
+    def touch(self, device_id, user_id=None, now: Optional[float] = None):
+        """Record a reading from device_id (owned by user_id, if known)."""
+        key = normalize_device_id(device_id)
+        if not key:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            self._seen.setdefault(key, {})[user_id] = now
+            self._pending.add((str(device_id), user_id))
+            self._stats['touches'] += 1
+            started = self._thread is not None and self._thread.is_alive()
+        if not started:
+            self.start()
+
+    # ------------------------------------------------------------------ flush
+
+    def flush(self) -> bool:
+        """Write every device seen since the last flush; failures are kept for the next one."""
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if not pending:
+            return True
+        from db import touch_sensors_last_seen
+        # Same row order in every process, so concurrent flushes cannot deadlock
+        devices = sorted(pending, key=lambda entry: (entry[0], entry[1] or 0))
+        failed = []
+        started = time.perf_counter()
+        for index in range(0, len(devices), self._batch_size):
+            chunk = devices[index:index + self._batch_size]
+            if not touch_sensors_last_seen(chunk):
+                failed.extend(chunk)
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        with self._lock:
+            if failed:
+                self._pending.update(failed)
+                self._stats['failed_flushes'] += 1
+            self._stats['flushes'] += 1
+            self._stats['flushed_devices'] += len(devices) - len(failed)
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+        if failed:
+            print(f"Heartbeat: last_seen update failed for {len(failed)} devices; will retry", file=sys.stderr)
+        return not failed
+
+    # ------------------------------------------------------------------ status
+
+    def last_seen(self, device_id, user_id=None) -> Optional[float]:
+        """Epoch seconds of the last reading this process stored for the sensor, or None."""
+        with self._lock:
+            owners = self._seen.get(normalize_device_id(device_id))
+            if not owners:
+                return None
+            if user_id is None:
+                return max(owners.values())
+            return owners.get(user_id)
+
+    def status(self, device_id, user_id=None, fallback=None) -> dict:
+        """Online status for the dashboard.
+
+        Args:
+            device_id, user_id: Sensor to report on
+            fallback: sensors.last_seen (datetime), used when this process
+                has not seen the device yet
+
+        Returns:
+            Dict with 'online' (bool) and 'last_seen' (ISO timestamp or None)
+        """
+        seen = self.last_seen(device_id, user_id)
+        if seen is None and isinstance(fallback, datetime):
+            seen = fallback.timestamp()
+        return self._status(seen)
+
+    def _status(self, seen: Optional[float]) -> dict:
+        if seen is None:
+            return {'online': False, 'last_seen': None}
+        return {
+            'online': time.time() - seen <= self.online_seconds,
+            'last_seen': datetime.fromtimestamp(seen).isoformat(timespec='seconds'),
+        }
+
+    def statuses(self, user_id, device_ids) -> dict:
+        """Online status of several of a user's sensors.
+
+        Devices not seen by this process within the online window are read
+        fresh from sensors.last_seen (written by every worker's flush).
+
+        Returns:
+            Dict of device_id -> status() dict
+        """
+        device_ids = list(device_ids)
+        now = time.time()
+        local = {device_id: self.last_seen(device_id, user_id) for device_id in device_ids}
+        stale = [device_id for device_id, seen in local.items() if seen is None or now - seen > self.online_seconds]
+        stored = {}
+        if stale and user_id:
+            from db import get_sensors_last_seen
+            stored = {normalize_device_id(device_id): last_seen
+                      for device_id, last_seen in get_sensors_last_seen(user_id, stale).items()}
+        result = {}
+        for device_id, seen in local.items():
+            last_seen = stored.get(normalize_device_id(device_id))
+            if isinstance(last_seen, datetime):
+                seen = max(seen or 0.0, last_seen.timestamp())
+            result[device_id] = self._status(seen)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.time()
+            online = sum(1 for owners in self._seen.values() if now - max(owners.values()) <= self.online_seconds)
+            return dict(self._stats, tracked=len(self._seen), online=online, pending=len(self._pending),
+                        flush_seconds=self._flush_seconds, online_seconds=self.online_seconds,
+                        running=bool(self._thread is not None and self._thread.is_alive()))
+
+
+# Global instance for use across the application
+_heartbeat_tracker: Optional[HeartbeatTracker] = None
+_heartbeat_tracker_lock = threading.Lock()
+
+
+def get_heartbeat_tracker() -> HeartbeatTracker:
+    """
+    Get or create the global heartbeat tracker.
+
+    Returns:
+        HeartbeatTracker: Singleton instance
+    """
+    global _heartbeat_tracker
+    if _heartbeat_tracker is None:
+        with _heartbeat_tracker_lock:
+            if _heartbeat_tracker is None:
+                _heartbeat_tracker = HeartbeatTracker()
+    return _heartbeat_tracker
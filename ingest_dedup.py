@@ -0,0 +1,171 @@
+"""
+Idempotent ingest: recognise redelivered readings by device sequence number.
+
+MQTT QoS 1 redelivers after reconnects and devices on flaky uplinks retry
+HTTP posts, so the same reading can arrive more than once. Every reading
+that carries a sequence number is identified by an ingest key:
+
+- 'seq:<n>' when the payload has a 'seq' field (unique per device for its
+  lifetime, e.g. a persisted counter or a millisecond timestamp)
+- '<session token prefix>:<counter>' otherwise, from the device session
+  counter (counters restart with every session, so the token is part of it)
+
+The same device_id can be registered by several users, so windows belong to
+a sensor (its sensors.id), not to a device_id. The pipeline checks a compact
+per-sensor window (the highest number seen per stream plus a bitmap of the
+INGEST_DEDUP_WINDOW numbers below it) once the reading is authenticated, and
+before decrypting when the envelope repeats 'seq' in plaintext and only one
+sensor is registered under its device_id (not on paho's network thread, see
+IngestPipeline.decode). A hit is acknowledged as a
+duplicate without running session, evaluate or persist. Numbers are only
+marked once a reading has been stored, so a reading that failed can be
+retried.
+
+The window is per process and forgets on restart, so sensor_data also has a
+unique key on (sensor_id, ingest_key): the INSERT skips a row that is already
+stored (db_duplicates). Duplicate counts and rate are in /api/test/stats.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+INGEST_DEDUP = (os.environ.get('INGEST_DEDUP', 'true') or 'true').strip().lower() in ('1', 'true', 'yes')
+INGEST_DEDUP_WINDOW = int(os.environ.get('INGEST_DEDUP_WINDOW', '256'))
+# (sensor, stream) windows kept before the least recently used ones are dropped
+INGEST_DEDUP_MAX_STREAMS = int(os.environ.get('INGEST_DEDUP_MAX_STREAMS', '20000'))
+
+SEQ_STREAM = 'seq'
+_SESSION_PREFIX_LEN = 16
+
+
+def _as_int(value) -> Optional[int]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def reading_sequence(data: dict):
+    """Sequence of a decrypted reading.
+
+    Returns:
+        (stream, number) where stream is 'seq' or the session token prefix,
+        or None when the reading carries neither 'seq' nor a session counter
+    """
+    if not isinstance(data, dict):
+        return None
+    seq = _as_int(data.get('seq'))
+    if seq is not None:
+        return SEQ_STREAM, seq
+    counter = _as_int(data.get('counter'))
+    token = data.get('session_token')
+    if counter is not None and token:
+        return str(token)[:_SESSION_PREFIX_LEN], counter
+    return None
+
+
+def ingest_key(sequence, suffix: Optional[str] = None) -> Optional[str]:
+    """sensor_data.ingest_key for a (stream, number) sequence (None stays None)."""
+    if sequence is None:
+        return None
+    stream, number = sequence
+    key = f"{stream}:{number}"
+    return f"{key}/{suffix}" if suffix else key
+
+
+class SequenceWindow:
+    """Thread-safe sliding windows of stored sequence numbers per (sensor, stream)."""
+
+    def __init__(self, window: int = INGEST_DEDUP_WINDOW, max_streams: int = INGEST_DEDUP_MAX_STREAMS,
+                 enabled: bool = INGEST_DEDUP):
+        self.enabled = enabled
+        self.window = max(1, int(window))
+        self._mask = (1 << self.window) - 1
+        self._max_streams = max(1, int(max_streams))
+        self._lock = threading.Lock()
+        self._streams = OrderedDict()  # (sensor db id, stream) -> [highest number, bitmap; bit i = highest - i]
+        self._stats = {'checked': 0, 'duplicates': 0, 'duplicates_before_decrypt': 0,
+                       'db_duplicates': 0, 'beyond_window': 0}
+
+    def is_duplicate(self, sensor_db_id, sequence, before_decrypt: bool = False) -> bool:
+        """True if this sensor (sensors.id) already had a reading stored under sequence."""
+        if not self.enabled or sequence is None or sensor_db_id is None:
+            return False
+        stream, number = sequence
+        key = (sensor_db_id, stream)
+        with self._lock:
+            self._stats['checked'] += 1
+            entry = self._streams.get(key)
+            if entry is None or number > entry[0]:
+                return False
+            offset = entry[0] - number
+            if offset >= self.window:
+                # Too old to tell from memory; the sensor_data unique key decides
+                self._stats['beyond_window'] += 1
+                return False
+            if not (entry[1] >> offset) & 1:
+                return False
+            self._stats['duplicates'] += 1
+            if before_decrypt:
+                self._stats['duplicates_before_decrypt'] += 1
+            return True
+
+    def mark(self, sensor_db_id, sequence):
+        """Remember that a reading was stored for this sensor (sensors.id) under sequence."""
+        if not self.enabled or sequence is None or sensor_db_id is None:
+            return
+        stream, number = sequence
+        key = (sensor_db_id, stream)
+        with self._lock:
+            entry = self._streams.get(key)
+            if entry is None:
+                self._streams[key] = [number, 1]
+                while len(self._streams) > self._max_streams:
+                    self._streams.popitem(last=False)
+                return
+            self._streams.move_to_end(key)
+            if number > entry[0]:
+                gap = number - entry[0]
+                # A jump past the window forgets everything (never shift by the raw gap)
+                entry[1] = ((entry[1] << gap) | 1) & self._mask if gap < self.window else 1
+                entry[0] = number
+            elif entry[0] - number < self.window:
+                entry[1] |= 1 << (entry[0] - number)
+
+    def count_db_duplicates(self, count: int = 1):
+        """Rows the database skipped because their ingest_key was already stored."""
+        if count > 0:
+            with self._lock:
+                self._stats['db_duplicates'] += count
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            streams = len(self._streams)
+        stats['duplicate_rate'] = round(stats['duplicates'] / stats['checked'], 4) if stats['checked'] else 0.0
+        return dict(stats, enabled=self.enabled, window=self.window, streams=streams)
+
+
+# Global instance for use across the application
+_sequence_window: Optional[SequenceWindow] = None
+_sequence_window_lock = threading.Lock()
+
+
+def get_sequence_window() -> SequenceWindow:
+    """
+    Get or create the global sequence window.
+
+    Returns:
+        SequenceWindow: Singleton instance
+    """
+    global _sequence_window
+    if _sequence_window is None:
+        with _sequence_window_lock:
+            if _sequence_window is None:
+                _sequence_window = SequenceWindow()
+    return _sequence_window
@@ -0,0 +1,620 @@
+"""
+Staged ingest pipeline shared by HTTP /submit-data and MQTT secure/sensor.
+
+Both transports run the same stages on every reading:
+
+- decode: unwrap the transport envelope (RSA/AES hybrid for HTTP, or AES-GCM
+  with a negotiated session key, see session_keys.py; for MQTT either the
+  binary AES-GCM frame of mqtt_envelope.py or legacy AES-CBC JSON) and check
+  the integrity hashes
+- authenticate: resolve the registered active sensor (HTTP also verifies the
+  device signature)
+- dedup: acknowledge readings whose (sensor, seq/counter) was already
+  stored without running the later stages (see ingest_dedup.py)
+- session: validate the device session and counter
+- aggregate: update the per-metric latest caches from the reading
+- evaluate: compute_safety over the owner's aggregate snapshot
+- persist: write the sensor_data row (plus one row per extra metric with
+  STORE_ALL_METRICS=true, in the same INSERT) and record the heartbeat
+  (heartbeat.py)
+- update_caches: refresh the per-sensor and aggregate latest views
+
+Each stage records a latency histogram and an error counter (IngestMetrics,
+exposed by /api/test/stats), so batching, caching or offloading a stage
+applies to both transports at once.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from app_logging import get_logger
+from crypto_executor import get_crypto_executor
+from encryption_utils import aes_decrypt, decrypt_session_data, hash_data
+from heartbeat import get_heartbeat_tracker
+from ingest_dedup import get_sequence_window, ingest_key, reading_sequence
+from mqtt_envelope import (BINARY_ENVELOPE_VERSION, LEGACY_ENVELOPE_VERSION, envelope_version,
+                           read_header, unpack_reading)
+from sensor_registry import get_sensor_registry
+from session_keys import get_session_key_store
+
+
+ingest_log = get_logger('ingest')
+
+STAGES = ('decode', 'authenticate', 'dedup', 'session', 'aggregate', 'evaluate', 'persist', 'update_caches')
+
+# Histogram bucket upper bounds in milliseconds (last bucket is +inf)
+LATENCY_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Metrics accepted in sensor payloads
+SUPPORTED_METRICS = [
+    "tds", "ph", "turbidity", "temperature", "dissolved_oxygen", "conductivity",
+    "ammonia", "pressure", "nitrate", "nitrite", "orp", "chlorine", "salinity", "flow"
+]
+
+# Store every metric of a multi-parameter payload, not only the sensor's own
+# device_type (extra rows carry sensor_data.metric)
+STORE_ALL_METRICS = (os.environ.get('STORE_ALL_METRICS', 'false') or 'false').strip().lower() in ('1', 'true', 'yes')
+
+# AES key for MQTT payloads (must match simulator)
+MQTT_AES_KEY = b'my16bytepassword'
+
+
+class IngestError(Exception):
+    """A reading was rejected; message and http_status are safe to return to the device."""
+
+    def __init__(self, message: str, http_status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.http_status = http_status
+        self.stage = None
+
+
+class IngestMetrics:
+    """Per-stage latency histograms and error counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._messages = {}  # transport -> {'accepted': n, 'rejected': n, 'duplicate': n}
+        self._envelopes = {}  # MQTT payload format -> messages decoded
+
+    def observe(self, stage: str, elapsed_ms: float, error: bool = False):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                }
+            entry['count'] += 1
+            if error:
+                entry['errors'] += 1
+            entry['total_ms'] += elapsed_ms
+            if elapsed_ms > entry['max_ms']:
+                entry['max_ms'] = elapsed_ms
+            entry['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def message(self, transport: str, accepted: bool):
+        with self._lock:
+            entry = self._messages.setdefault(transport, {'accepted': 0, 'rejected': 0, 'duplicate': 0})
+            entry['accepted' if accepted else 'rejected'] += 1
+
+    def duplicate(self, transport: str):
+        with self._lock:
+            entry = self._messages.setdefault(transport, {'accepted': 0, 'rejected': 0, 'duplicate': 0})
+            entry['duplicate'] += 1
+
+    def envelope(self, payload_format: str):
+        with self._lock:
+            self._envelopes[payload_format] = self._envelopes.get(payload_format, 0) + 1
+
+    def stats(self) -> dict:
+        labels = [f"le_{b}" for b in LATENCY_BUCKETS_MS] + ['le_inf']
+        with self._lock:
+            stages = {}
+            for stage in sorted(self._stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                entry = self._stages[stage]
+                stages[stage] = {
+                    'count': entry['count'],
+                    'errors': entry['errors'],
+                    'avg_ms': round(entry['total_ms'] / entry['count'], 3) if entry['count'] else None,
+                    'max_ms': round(entry['max_ms'], 3),
+                    'histogram': dict(zip(labels, entry['buckets'])),
+                }
+            return {'messages': {k: dict(v) for k, v in self._messages.items()},
+                    'mqtt_envelopes': dict(self._envelopes), 'stages': stages}
+
+
+# Global instance for use across the application
+_ingest_metrics: Optional[IngestMetrics] = None
+_ingest_metrics_lock = threading.Lock()
+
+
+def get_ingest_metrics() -> IngestMetrics:
+    """
+    Get or create the global ingest metrics.
+
+    Returns:
+        IngestMetrics: Singleton instance
+    """
+    global _ingest_metrics
+    if _ingest_metrics is None:
+        with _ingest_metrics_lock:
+            if _ingest_metrics is None:
+                _ingest_metrics = IngestMetrics()
+    return _ingest_metrics
+
+
+class IngestMessage:
+    """State carried through the stages for one reading."""
+
+    def __init__(self, transport: str, raw):
+        self.transport = transport      # 'http' or 'mqtt'
+        self.raw = raw                  # HTTP envelope dict or MQTT payload bytes
+        self.data = None                # decrypted reading
+        self.decoded = False            # decode stage already ran (see IngestPipeline.decode)
+        self.envelope_dedup = True      # check a plaintext seq before decrypting (needs the registry)
+        self.signed_bytes = None        # canonical JSON the device signed
+        self.sensor_id = None
+        self.signature = None
+        self.session_keyed = False      # decrypted with a negotiated session key
+        self.sequence = None            # (stream, number) from ingest_dedup.reading_sequence
+        self.duplicate = False          # already stored; later stages are skipped
+        self.sensor_row = None
+        self.updated_values = {}
+        self.safe = True
+        self.reasons = []
+        self.agg_values = {}
+        self.value_for_type = None
+        self.stored = False
+
+    @property
+    def label(self) -> str:
+        return 'HTTP Sensor' if self.transport == 'http' else 'MQTT Sensor'
+
+
+class IngestPipeline:
+    """Runs the ingest stages against the application's caches and database."""
+
+    def __init__(self, *, latest_by_metric: dict, latest_by_sensor: dict, user_latest_by_metric: dict,
+                 user_latest_by_sensor: dict, user_latest_data: dict, set_latest_data,
+                 validate_session, build_thresholds, type_defaults, compute_safety,
+                 insert_sensor_data, verify_signature, private_key_path: str,
+                 require_session: bool = False):
+        """
+        Args:
+            latest_by_metric, latest_by_sensor, user_latest_*: Shared latest-value caches
+            set_latest_data: Callable(user_id, data) publishing the aggregate latest view
+            validate_session: Callable(token, device_id, counter) -> (ok, reason)
+            build_thresholds: Callable(device_id) -> effective thresholds
+            type_defaults: Callable() -> sensor_type default thresholds
+            compute_safety: Callable(values, thresholds) -> (safe, reasons)
+            insert_sensor_data: db.insert_sensor_data
+            verify_signature: Callable(device_id, signature_b64, signed_bytes) -> sensor row or None
+            private_key_path: Server RSA private key for HTTP envelopes
+            require_session: Reject readings without a valid device session
+        """
+        self.latest_by_metric = latest_by_metric
+        self.latest_by_sensor = latest_by_sensor
+        self.user_latest_by_metric = user_latest_by_metric
+        self.user_latest_by_sensor = user_latest_by_sensor
+        self.user_latest_data = user_latest_data
+        self._set_latest_data = set_latest_data
+        self._validate_session = validate_session
+        self._build_thresholds = build_thresholds
+        self._type_defaults = type_defaults
+        self._compute_safety = compute_safety
+        self._insert_sensor_data = insert_sensor_data
+        self._verify_signature = verify_signature
+        self.private_key_path = private_key_path
+        self.require_session = require_session
+        self.metrics = get_ingest_metrics()
+        self.sequences = get_sequence_window()
+
+    # ------------------------------------------------------------------ driver
+
+    def process(self, msg: IngestMessage) -> IngestMessage:
+        """Run every stage for one reading.
+
+        A redelivered reading returns early with msg.duplicate set.
+
+        Raises:
+            IngestError: The reading was rejected (decode, authenticate or session)
+        """
+        http = msg.transport == 'http'
+        try:
+            if not msg.decoded:
+                self._run('decode', self.decode_http if http else self.decode_mqtt, msg)
+            if not msg.duplicate:
+                self._run('authenticate', self.authenticate_http if http else self.authenticate_mqtt, msg)
+                self._run('dedup', self.check_duplicate, msg)
+            if msg.duplicate:
+                self.metrics.duplicate(msg.transport)
+                return msg
+            self._run('session', self.check_session, msg)
+            self._run('aggregate', self.aggregate, msg)
+            self._run('evaluate', self.evaluate, msg)
+            # Storage and cache refresh failures are logged; the reading was still accepted
+            self._run('persist', self.persist, msg, fatal=False)
+            self._run('update_caches', self.update_caches, msg, fatal=False)
+        except IngestError:
+            self.metrics.message(msg.transport, False)
+            raise
+        self.metrics.message(msg.transport, True)
+        return msg
+
+    def decode(self, msg: IngestMessage) -> IngestMessage:
+        """Run only the decode stage; process() then continues from authenticate.
+
+        The MQTT dispatcher (mqtt_ingest.py) decodes on the network thread to
+        learn the device_id that selects a worker. The plaintext-seq duplicate
+        check is skipped there: it reads the sensor registry, whose refresh
+        queries the database under the registry lock. The worker's dedup
+        stage still catches the duplicate after authenticate.
+
+        Raises:
+            IngestError: The payload could not be decoded
+        """
+        msg.envelope_dedup = False
+        try:
+            self._run('decode', self.decode_http if msg.transport == 'http' else self.decode_mqtt, msg)
+        except IngestError:
+            self.metrics.message(msg.transport, False)
+            raise
+        msg.decoded = True
+        return msg
+
+    def _run(self, stage: str, fn, msg: IngestMessage, fatal: bool = True):
+        started = time.perf_counter()
+        try:
+            fn(msg)
+        except IngestError as e:
+            self.metrics.observe(stage, (time.perf_counter() - started) * 1000, error=True)
+            e.stage = stage
+            raise
+        except Exception as e:
+            self.metrics.observe(stage, (time.perf_counter() - started) * 1000, error=True)
+            ingest_log.exception("%s: %s stage failed for device_id: %s: %s", msg.label, stage, msg.sensor_id, e)
+            if fatal:
+                message = f"Decryption error: {e}" if stage == 'decode' else f"Ingest error ({stage}): {e}"
+                error = IngestError(message)
+                error.stage = stage
+                raise error from e
+            return
+        self.metrics.observe(stage, (time.perf_counter() - started) * 1000)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Record a stage timing for code outside process() (e.g. batch ingest)."""
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.observe(stage, (time.perf_counter() - started) * 1000, error=error)
+
+    # ------------------------------------------------------------------ decode
+
+    def decode_http(self, msg: IngestMessage):
+        envelope = msg.raw
+        if self.envelope_duplicate(msg, envelope.get("sensor_id"), envelope.get("seq")):
+            return
+        # Extract and remove SHA-256 hash from payload
+        sha256_hash = envelope.pop("sha256", None)
+        if envelope.get("session_token") and "session_key" not in envelope:
+            data = self.decrypt_with_session_key(envelope)
+            msg.session_keyed = True
+        else:
+            # Server key is loaded once (and reloaded on file change) by encryption_utils;
+            # with CRYPTO_EXECUTOR=process the unwrap runs in the crypto pool
+            data = get_crypto_executor().decrypt_envelope(envelope, self.private_key_path)
+        if not isinstance(data, dict) or not data:
+            raise IngestError("Decryption error: empty payload")
+        data_json = json.dumps(data, sort_keys=True).encode()
+        computed_hash = hashlib.sha256(data_json).hexdigest()
+        ingest_log.debug("Server JSON string: %s, computed SHA-256 hash: %s", data_json, computed_hash)
+        if sha256_hash and computed_hash != sha256_hash:
+            raise IngestError("SHA-256 hash mismatch! Data integrity compromised.")
+        self.check_envelope_seq(envelope.get("seq"), data)
+        msg.data = data
+        msg.signed_bytes = data_json
+        msg.sensor_id = envelope.get("sensor_id")
+        msg.signature = envelope.get("signature")
+
+    def envelope_duplicate(self, msg: IngestMessage, device_id, seq) -> bool:
+        """Skip decryption when the envelope's plaintext seq is already stored for the device.
+
+        Only when a single sensor is registered under device_id: otherwise the
+        owner is not known until the reading is authenticated.
+        """
+        if not msg.envelope_dedup:
+            return False
+        sequence = reading_sequence({'seq': seq})
+        if sequence is None or not device_id or not self.sequences.enabled:
+            return False
+        sensors = get_sensor_registry().get_sensors(device_id)
+        if len(sensors) != 1 or not self.sequences.is_duplicate(sensors[0].get('id'), sequence, before_decrypt=True):
+            return False
+        msg.sensor_id = device_id
+        msg.sequence = sequence
+        msg.duplicate = True
+        return True
+
+    @staticmethod
+    def check_envelope_seq(seq, data: dict):
+        """A plaintext seq must repeat the one inside the encrypted reading."""
+        if seq is not None and reading_sequence({'seq': seq}) != reading_sequence({'seq': data.get('seq')}):
+            raise IngestError("seq in envelope does not match the encrypted payload.")
+
+    def decrypt_with_session_key(self, envelope: dict) -> dict:
+        """Decrypt a symmetric envelope with the key negotiated for its session token."""
+        session_token = envelope["session_token"]
+        entry, reason = get_session_key_store().get(session_token)
+        if entry is None:
+            raise IngestError(f"Device session error: {reason}", 401)
+        key_device_id, key = entry
+        if str(key_device_id or '').lower() != str(envelope.get("sensor_id") or '').lower():
+            raise IngestError("Device session error: session_token does not belong to sensor_id", 401)
+        data = decrypt_session_data(envelope, key)
+        # The token selects the key, so it must also be the one the device signed
+        if isinstance(data, dict) and data.get("session_token") != session_token:
+            raise IngestError("Device session error: session_token mismatch", 401)
+        return data
+
+    def decode_mqtt(self, msg: IngestMessage):
+        version = envelope_version(msg.raw)
+        if version == BINARY_ENVELOPE_VERSION:
+            self.metrics.envelope('binary')
+            self.decode_mqtt_binary(msg)
+            return
+        if version != LEGACY_ENVELOPE_VERSION:
+            raise IngestError(f"Unsupported MQTT payload version {version}")
+        self.metrics.envelope('json')
+        raw = msg.raw.decode('utf-8', errors='replace') if isinstance(msg.raw, (bytes, bytearray)) else msg.raw
+        payload = json.loads(raw) if isinstance(raw, str) else raw
+        if not isinstance(payload, dict):
+            raise IngestError("Invalid JSON payload.")
+        encrypted_data = payload.get('data')
+        received_hash = payload.get('hash')
+        sha256_hash = payload.get('sha256')
+        if not encrypted_data:
+            raise IngestError("Missing 'data' field in payload")
+        if self.envelope_duplicate(msg, payload.get('device_id'), payload.get('seq')):
+            return
+        # aes_decrypt expects the JSON string produced by aes_encrypt
+        if isinstance(encrypted_data, dict):
+            encrypted_data = json.dumps(encrypted_data)
+        elif not isinstance(encrypted_data, str):
+            raise IngestError(f"Invalid encrypted_data type: {type(encrypted_data)}")
+        try:
+            data = aes_decrypt(encrypted_data, MQTT_AES_KEY)
+        except Exception as e:
+            raise IngestError(f"Decryption error: {e}") from e
+        if received_hash and hash_data(data) != received_hash:
+            raise IngestError("Hash mismatch - possible tampering")
+        if sha256_hash:
+            computed_sha256 = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+            if computed_sha256 != sha256_hash:
+                raise IngestError("SHA256 hash mismatch")
+        if not isinstance(data, dict) or not data.get('device_id'):
+            raise IngestError("Missing device_id in decrypted data")
+        self.check_envelope_seq(payload.get('seq'), data)
+        if payload.get('device_id') and str(payload.get('device_id')).lower() != str(data.get('device_id')).lower():
+            raise IngestError("device_id in envelope does not match the encrypted payload.")
+        msg.data = data
+        msg.sensor_id = data.get('device_id')
+
+    def decode_mqtt_binary(self, msg: IngestMessage):
+        # Version 2 frame (mqtt_envelope.py): one AES-GCM pass authenticates
+        # header and reading, so there are no separate hashes to recompute
+        try:
+            device_id, seq, _ = read_header(msg.raw)
+        except ValueError as e:
+            raise IngestError(f"Invalid binary payload: {e}") from e
+        if self.envelope_duplicate(msg, device_id, seq):
+            return
+        try:
+            data = unpack_reading(msg.raw, MQTT_AES_KEY)
+        except ValueError as e:
+            raise IngestError(f"Decryption error: {e}") from e
+        msg.data = data
+        msg.sensor_id = device_id
+
+    # ------------------------------------------------------------------ dedup
+
+    def check_duplicate(self, msg: IngestMessage):
+        msg.sequence = reading_sequence(msg.data)
+        msg.duplicate = self.sequences.is_duplicate(msg.sensor_row.get('id'), msg.sequence)
+        if msg.duplicate:
+            ingest_log.debug("%s: duplicate reading for %s (%s:%s) acknowledged", msg.label, msg.sensor_id, *msg.sequence)
+
+    # ------------------------------------------------------------------ authenticate
+
+    def authenticate_http(self, msg: IngestMessage):
+        # Enforce: only registered ACTIVE sensors may submit, with valid signature
+        sensor_id = msg.sensor_id
+        if not sensor_id or not msg.signature:
+            raise IngestError("sensor_id and signature are required.")
+        # Multiple users can have the same device_id; the signature picks the owner
+        if not get_sensor_registry().get_sensors(sensor_id):
+            raise IngestError(f"Unregistered sensor_id '{sensor_id}'.", 403)
+        payload_device_id = msg.data.get("device_id")
+        if payload_device_id and str(payload_device_id).lower() != str(sensor_id).lower():
+            raise IngestError("device_id in payload does not match sensor_id.")
+        sensor_row = self._verify_signature(sensor_id, msg.signature, msg.signed_bytes)
+        if not sensor_row:
+            raise IngestError("Invalid sensor signature or no matching active sensor found.")
+        self.check_device_type(sensor_row, msg.data.get("device_type"))
+        msg.sensor_row = sensor_row
+
+    def authenticate_mqtt(self, msg: IngestMessage):
+        # MQTT payloads are not signed; the sensor must still be registered and active
+        matching_sensors = get_sensor_registry().get_sensors(msg.sensor_id, active_only=True)
+        if not matching_sensors:
+            raise IngestError(f"Unregistered or inactive sensor '{msg.sensor_id}'", 403)
+        msg.sensor_row = matching_sensors[0]
+
+    def check_device_type(self, sensor_row: dict, payload_device_type):
+        """Cross-check device_type (case-insensitive, None/empty passes)."""
+        sensor_device_type = (sensor_row.get('device_type') or '').strip()
+        if payload_device_type and sensor_device_type:
+            if str(payload_device_type).lower().strip() != sensor_device_type.lower():
+                ingest_log.warning("device_type mismatch for %s: payload='%s' vs db='%s'",
+                                   sensor_row.get('device_id'), payload_device_type, sensor_device_type)
+                raise IngestError(f"device_type mismatch for sensor. Expected '{sensor_device_type}', got '{payload_device_type}'")
+
+    # ------------------------------------------------------------------ session
+
+    def check_session(self, msg: IngestMessage, data: Optional[dict] = None):
+        """Validate and advance the device session (required, or optional if provided)."""
+        data = msg.data if data is None else data
+        session_token = data.get('session_token')
+        # Session-key envelopes always enforce the counter (replay protection)
+        required = self.require_session or msg.session_keyed
+        if not (required or session_token):
+            return
+        ok, reason = self._validate_session(session_token, msg.sensor_id, data.get('counter'))
+        if ok:
+            ingest_log.debug("%s: Session validated for %s, counter=%s", msg.label, msg.sensor_id, data.get('counter'))
+        elif required:
+            raise IngestError(f"Device session error: {reason}", 401)
+        else:
+            ingest_log.warning("%s: Device session warning for %s: %s (continuing anyway)", msg.label, msg.sensor_id, reason)
+
+    # ------------------------------------------------------------------ aggregate / evaluate
+
+    def aggregate(self, msg: IngestMessage):
+        msg.updated_values = self.apply_reading(msg.sensor_row.get('user_id'), msg.sensor_id, msg.data)
+        device_type = msg.sensor_row.get('device_type')
+        msg.value_for_type = self.value_for_device_type(device_type, msg.updated_values)
+        if msg.updated_values and device_type not in msg.updated_values and \
+                str(device_type or '').lower().strip() not in msg.updated_values:
+            ingest_log.info("Using fallback value for device_id: %s, device_type: %s, available_keys: %s",
+                            msg.sensor_id, device_type, list(msg.updated_values.keys()))
+
+    def evaluate(self, msg: IngestMessage):
+        msg.safe, msg.reasons, msg.agg_values = self.evaluate_safety(msg.sensor_row.get('user_id'))
+
+    def apply_reading(self, sensor_user_id, sensor_id, reading: dict) -> dict:
+        """Update the per-metric latest caches from one reading; returns {metric: value}."""
+        if sensor_user_id:
+            self.user_latest_by_metric.setdefault(sensor_user_id, {})
+            self.user_latest_by_sensor.setdefault(sensor_user_id, {})
+            self.user_latest_data.setdefault(sensor_user_id, {})
+        updated_values = {}
+        for k in SUPPORTED_METRICS:
+            if k in reading and reading[k] not in (None, ""):
+                try:
+                    val = float(reading[k])
+                except Exception:
+                    continue
+                updated_values[k] = val
+                if sensor_user_id:
+                    self.user_latest_by_metric[sensor_user_id][k] = {"value": val, "sensor_id": sensor_id}
+                self.latest_by_metric[k] = {"value": val, "sensor_id": sensor_id}
+        return updated_values
+
+    def evaluate_safety(self, sensor_user_id):
+        """Run compute_safety over the user's aggregate metric snapshot.
+
+        Returns (safe, reasons, agg_values).
+        """
+        if sensor_user_id and sensor_user_id in self.user_latest_by_metric:
+            _lbm_snapshot = list(self.user_latest_by_metric[sensor_user_id].items())
+        else:
+            _lbm_snapshot = list(self.latest_by_metric.items())
+        agg_values = {k: v.get("value") for k, v in _lbm_snapshot if v and v.get("value") is not None}
+        agg_thresholds = {}
+        for metric, entry in _lbm_snapshot:
+            sid = (entry or {}).get("sensor_id")
+            tmap = self._build_thresholds(sid)
+            if tmap and metric in tmap:
+                agg_thresholds[metric] = tmap[metric]
+        missing = [m for m in agg_values.keys() if m not in agg_thresholds]
+        if missing:
+            defaults = self._type_defaults()
+            for metric in missing:
+                if metric in defaults:
+                    agg_thresholds[metric] = defaults[metric]
+        safe, reasons = self._compute_safety(agg_values, agg_thresholds)
+        return safe, reasons, agg_values
+
+    @staticmethod
+    def primary_metric(device_type, updated_values: dict):
+        """Return the metric key matching the sensor's device_type (first metric as fallback)."""
+        if device_type:
+            device_type_lower = str(device_type).lower().strip()
+            for key in updated_values:
+                if key and str(key).lower().strip() == device_type_lower:
+                    return key
+            if device_type in updated_values:
+                return device_type
+        if updated_values:
+            return next(iter(updated_values))
+        return None
+
+    @classmethod
+    def value_for_device_type(cls, device_type, updated_values: dict):
+        """Pick the reading value matching the sensor's device_type (first metric as fallback)."""
+        key = cls.primary_metric(device_type, updated_values)
+        return updated_values.get(key) if key is not None else None
+
+    @classmethod
+    def extra_metric_values(cls, device_type, updated_values: dict) -> dict:
+        """Metrics other than the sensor's own value (stored only with STORE_ALL_METRICS)."""
+        if not STORE_ALL_METRICS:
+            return {}
+        primary = cls.primary_metric(device_type, updated_values)
+        return {k: v for k, v in updated_values.items() if k != primary}
+
+    # ------------------------------------------------------------------ persist / caches
+
+    def persist(self, msg: IngestMessage):
+        sensor_db_id = msg.sensor_row.get('id')
+        if sensor_db_id is None:
+            ingest_log.error("sensor_row.get('id') is None for device_id: %s. Cannot insert sensor data.", msg.sensor_id)
+            return
+        if msg.value_for_type is None:
+            ingest_log.error("value_for_type is None for device_id: %s, device_type: %s, updated_values: %s",
+                             msg.sensor_id, msg.sensor_row.get('device_type'), msg.updated_values)
+            return
+        msg.stored = self._insert_sensor_data(
+            sensor_db_id=sensor_db_id,
+            value=msg.value_for_type,
+            status='normal' if msg.safe else 'warning',
+            user_id=msg.sensor_row.get('user_id'),
+            device_id=msg.sensor_id,
+            extra_values=self.extra_metric_values(msg.sensor_row.get('device_type'), msg.updated_values),
+            ingest_key=ingest_key(msg.sequence),
+        )
+        if not msg.stored:
+            ingest_log.error("%s: insert_sensor_data returned False for device_id: %s, sensor_db_id: %s",
+                             msg.label, msg.sensor_id, sensor_db_id)
+            return
+        self.sequences.mark(sensor_db_id, msg.sequence)
+        ingest_log.debug("%s: Stored reading for %s (sensor_db_id: %s, value: %s)",
+                         msg.label, msg.sensor_id, sensor_db_id, msg.value_for_type)
+        # Coalesced into one bulk UPDATE of sensors.last_seen every few seconds
+        get_heartbeat_tracker().touch(msg.sensor_row.get('device_id') or msg.sensor_id, msg.sensor_row.get('user_id'))
+
+    def update_caches(self, msg: IngestMessage):
+        sensor_user_id = msg.sensor_row.get('user_id')
+        latest_entry = {
+            'device_id': msg.sensor_id,
+            'device_type': msg.sensor_row.get('device_type'),
+            'location': msg.sensor_row.get('location'),
+            'value': msg.value_for_type,
+        }
+        if sensor_user_id:
+            self.user_latest_by_sensor.setdefault(sensor_user_id, {})[msg.sensor_id] = latest_entry
+        self.latest_by_sensor[msg.sensor_id] = latest_entry
+        self._set_latest_data(sensor_user_id, {m: msg.agg_values.get(m) for m in SUPPORTED_METRICS})
@@ -0,0 +1,374 @@
+"""
+Versioned schema migrations.
+
+db._ensure_schema creates the baseline tables and patches older databases by
+probing (SHOW COLUMNS / SHOW INDEX, then a conditional ALTER) on every start.
+Schema changes from here on are numbered migrations instead: each runs once
+per database, in order, and is recorded in the schema_version table, so a
+database at the latest version only needs one SELECT to know that.
+
+A migration is a function taking a buffered cursor. It must still cope with
+a database that already has some of its changes (databases created before
+schema_version existed, or a migration that failed half-way: MySQL DDL
+commits implicitly, so a failed step cannot be rolled back). Append new
+migrations to MIGRATIONS; never renumber or edit one that has shipped.
+
+The baseline (db._ensure_schema: dozens of CREATE TABLE IF NOT EXISTS, SHOW
+COLUMNS / SHOW INDEX probes and information_schema FK lookups) is recorded
+as version 0 under BASELINE_REVISION, not a checksum of its source, so
+editing _ensure_schema does not mark every deployed database out of date;
+new changes to existing tables belong in MIGRATIONS. Migrations are recorded
+with a checksum of their code. is_current() answers "is this database up to
+date with this code?" with a single SELECT.
+
+migrate() holds a MySQL advisory lock (GET_LOCK) while it works, so
+processes starting together never run DDL concurrently: the others wait,
+then find the schema current. Workers only check and log unless
+DB_AUTO_MIGRATE is set, so run it explicitly before starting them:
+
+    python migrations.py migrate
+    python migrations.py status
+"""
+
+import hashlib
+import inspect
+import os
+import sys
+from typing import Optional
+
+from app_logging import get_logger
+
+
+migrations_log = get_logger('db')
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+BASELINE_VERSION = 0
+# Recorded for version 0; bump only if db._ensure_schema must re-run everywhere
+BASELINE_REVISION = 1
+# Seconds migrate() waits for another process's migration to finish
+SCHEMA_LOCK_TIMEOUT = int(os.environ.get('DB_SCHEMA_LOCK_TIMEOUT', '300'))
+
+
+def _index_columns(cur, table: str) -> dict:
+    """Secondary and primary indexes of table: {index name: [columns in order]}."""
+    cur.execute(
+        """
+        SELECT INDEX_NAME, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+        """,
+        (table,),
+    )
+    indexes = {}
+    for index_name, column_name in cur.fetchall():
+        indexes.setdefault(index_name, []).append(column_name)
+    return indexes
+
+
+# ---------------------------------------------------------------------- migrations
+
+# Every hot reading query filters by user (or by sensor, through the sensors
+# join) and orders by recorded_at DESC, id DESC with a LIMIT; with only
+# single-column indexes MySQL read the whole user's range and filesorted it.
+SENSOR_DATA_TIME_INDEXES = (
+    ('idx_sensor_data_user_time', ('user_id', 'recorded_at', 'id')),
+    ('idx_sensor_data_sensor_time', ('sensor_id', 'recorded_at', 'id')),
+    ('idx_sensor_data_time', ('recorded_at', 'id')),
+)
+# Prefixes of the new indexes: only extra write cost per insert. The
+# sensor_time index takes over the sensor_id foreign key.
+SENSOR_DATA_REDUNDANT_INDEXES = ('idx_sensor_data_user_id', 'idx_sensor_data_sensor_id')
+
+
+def _column_exists(cur, table: str, column: str) -> bool:
+    cur.execute(f"SHOW COLUMNS FROM `{table}` WHERE Field = %s", (column,))
+    return bool(cur.fetchall())
+
+
+def _sensor_data_ingest_columns(cur):
+    # metric: NULL = the sensor's device_type, set for extra metrics stored
+    # from multi-parameter payloads. ingest_key: device seq / session counter,
+    # unique per sensor so redelivered readings are not stored twice (NULL
+    # keys never collide)
+    clauses = []
+    if not _column_exists(cur, 'sensor_data', 'metric'):
+        clauses.append("ADD COLUMN metric VARCHAR(50) NULL AFTER device_id")
+    if not _column_exists(cur, 'sensor_data', 'ingest_key'):
+        clauses.append("ADD COLUMN ingest_key VARCHAR(100) NULL AFTER metric")
+    if 'uq_sensor_data_ingest_key' not in _index_columns(cur, 'sensor_data'):
+        clauses.append("ADD UNIQUE KEY uq_sensor_data_ingest_key (sensor_id, ingest_key)")
+    if clauses:
+        cur.execute(f"ALTER TABLE `sensor_data` {', '.join(clauses)}")
+
+
+def _sensor_data_time_indexes(cur):
+    existing = _index_columns(cur, 'sensor_data')
+    clauses = [f"ADD INDEX {name} ({', '.join(columns)})"
+               for name, columns in SENSOR_DATA_TIME_INDEXES if name not in existing]
+    clauses += [f"DROP INDEX {name}" for name in SENSOR_DATA_REDUNDANT_INDEXES if name in existing]
+    if clauses:
+        # One online ALTER: a single table rebuild pass, inserts keep running
+        cur.execute(f"ALTER TABLE `sensor_data` {', '.join(clauses)}, ALGORITHM=INPLACE, LOCK=NONE")
+
+
+def _sensor_latest_table(cur):
+    # Newest reading per (sensor, metric), upserted with every sensor_data
+    # INSERT (db._upsert_sensor_latest); metric '' is the sensor's own value
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `sensor_latest` (
+            sensor_id INT NOT NULL,
+            metric VARCHAR(50) NOT NULL DEFAULT '',
+            user_id INT NULL,
+            device_id VARCHAR(100) NULL,
+            value TEXT NOT NULL,
+            status ENUM('normal','warning','critical') DEFAULT 'normal',
+            recorded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sensor_id, metric),
+            INDEX idx_sensor_latest_user (user_id),
+            CONSTRAINT fk_sensor_latest_sensor FOREIGN KEY (sensor_id)
+                REFERENCES `sensors`(id) ON UPDATE CASCADE ON DELETE CASCADE
+        )
+        """
+    )
+    # Backfill from history (one pass over sensor_data); rows the running
+    # application already upserted are newer and kept
+    cur.execute(
+        """
+        INSERT INTO `sensor_latest` (sensor_id, metric, user_id, device_id, value, status, recorded_at)
+        SELECT sd.sensor_id, COALESCE(sd.metric, ''), sd.user_id, sd.device_id, sd.value, sd.status, sd.recorded_at
+        FROM `sensor_data` sd
+        JOIN (
+            SELECT MAX(id) AS id FROM `sensor_data` GROUP BY sensor_id, COALESCE(metric, '')
+        ) newest ON newest.id = sd.id
+        ON DUPLICATE KEY UPDATE sensor_id = sensor_latest.sensor_id
+        """
+    )
+
+
+# (version, name, function); versions are consecutive from 1
+MIGRATIONS = (
+    (1, 'sensor_data metric and ingest_key columns', _sensor_data_ingest_columns),
+    (2, 'sensor_data time-series indexes', _sensor_data_time_indexes),
+    (3, 'sensor_latest table', _sensor_latest_table),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+# ---------------------------------------------------------------------- state
+
+def baseline_checksum() -> str:
+    """Value recorded for version 0 (the baseline) at BASELINE_REVISION."""
+    return hashlib.sha256(f"baseline:{BASELINE_REVISION}".encode('utf-8')).hexdigest()
+
+
+def checksum(func) -> str:
+    """SHA-256 of a schema function's source (its bytecode if the source is unavailable)."""
+    try:
+        material = inspect.getsource(func).encode('utf-8')
+    except (OSError, TypeError):
+        material = func.__code__.co_code
+    return hashlib.sha256(material).hexdigest()
+
+
+def expected_state(baseline=None) -> dict:
+    """{version: checksum} a database current with this code has recorded."""
+    state = {version: checksum(apply) for version, _, apply in MIGRATIONS}
+    if baseline is not None:
+        state[BASELINE_VERSION] = baseline_checksum()
+    return state
+
+
+def recorded_state(conn) -> Optional[dict]:
+    """{version: checksum} from schema_version, or None if it cannot be read (no table yet)."""
+    cur = conn.cursor(buffered=True)
+    try:
+        cur.execute(f"SELECT version, checksum FROM `{SCHEMA_VERSION_TABLE}`")
+        return {int(version): value for version, value in cur.fetchall()}
+    except Exception:
+        return None
+    finally:
+        cur.close()
+
+
+def is_current(conn, baseline=None) -> bool:
+    """True if the baseline and every migration are recorded with this code's checksums.
+
+    This is the single SELECT a worker runs at startup when the schema is current.
+    """
+    recorded = recorded_state(conn)
+    if recorded is not None and baseline is None:
+        recorded.pop(BASELINE_VERSION, None)
+    return recorded == expected_state(baseline)
+
+
+def current_version(conn) -> Optional[int]:
+    """Highest applied migration (0 for none), or None if schema_version does not exist yet."""
+    state = recorded_state(conn)
+    if state is None:
+        return None
+    return max(state, default=0)
+
+
+# ---------------------------------------------------------------------- runner
+
+def ensure_version_table(cur):
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS `{SCHEMA_VERSION_TABLE}` (
+            version INT PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            checksum CHAR(64) NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    cur.execute(f"SHOW COLUMNS FROM `{SCHEMA_VERSION_TABLE}` WHERE Field = 'checksum'")
+    if not cur.fetchone():
+        cur.execute(f"ALTER TABLE `{SCHEMA_VERSION_TABLE}` ADD COLUMN checksum CHAR(64) NULL AFTER name")
+
+
+def _record(cur, version: int, name: str, value: str):
+    cur.execute(
+        f"""
+        INSERT INTO `{SCHEMA_VERSION_TABLE}` (version, name, checksum) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE name = VALUES(name), checksum = VALUES(checksum), applied_at = CURRENT_TIMESTAMP
+        """,
+        (version, name, value),
+    )
+
+
+# GET_LOCK names are server-wide; scope the lock to the application database
+_LOCK_NAME_SQL = "LEFT(CONCAT('schema_migrate:', DATABASE()), 64)"
+
+
+def migrate(conn, baseline=None, lock_timeout: int = SCHEMA_LOCK_TIMEOUT) -> list:
+    """Bring the database up to date with this code, under an advisory lock.
+
+    Runs baseline(conn) if its recorded checksum differs (or it was never
+    recorded), then every migration not recorded yet, in order. Stops at
+    the first failure (later migrations may depend on it) and raises its
+    error; the steps done before it stay recorded.
+
+    Args:
+        conn: Connection to the application database
+        baseline: The baseline schema function (db._ensure_schema), or None
+            to only run numbered migrations
+        lock_timeout: Seconds to wait for a concurrent migration
+
+    Returns:
+        Versions applied by this call (0 = baseline)
+
+    Raises:
+        TimeoutError: Another process held the migration lock for lock_timeout
+    """
+    cur = conn.cursor(buffered=True)
+    try:
+        cur.execute(f"SELECT GET_LOCK({_LOCK_NAME_SQL}, %s)", (int(lock_timeout),))
+        row = cur.fetchone()
+        if not row or row[0] != 1:
+            raise TimeoutError(f"schema migration lock not acquired in {lock_timeout}s")
+        try:
+            # Whoever held the lock may just have done the work
+            if is_current(conn, baseline):
+                return []
+            return _migrate_locked(conn, cur, baseline)
+        finally:
+            try:
+                cur.execute(f"SELECT RELEASE_LOCK({_LOCK_NAME_SQL})")
+                cur.fetchall()
+            except Exception:
+                pass
+    finally:
+        cur.close()
+
+
+def _migrate_locked(conn, cur, baseline) -> list:
+    ensure_version_table(cur)
+    conn.commit()
+    recorded = recorded_state(conn) or {}
+    applied = []
+
+    if baseline is not None:
+        expected = baseline_checksum()
+        if recorded.get(BASELINE_VERSION) != expected:
+            baseline(conn)
+            _record(cur, BASELINE_VERSION, 'baseline', expected)
+            conn.commit()
+            migrations_log.info("Schema baseline checked and recorded")
+            applied.append(BASELINE_VERSION)
+
+    for version, name, apply in MIGRATIONS:
+        expected = checksum(apply)
+        if version in recorded:
+            if recorded[version] != expected:
+                # Shipped migrations are not re-run; just note that the code changed
+                migrations_log.warning("Schema migration %s (%s) changed since it was applied", version, name)
+                _record(cur, version, name, expected)
+                conn.commit()
+            continue
+        try:
+            apply(cur)
+            _record(cur, version, name, expected)
+            conn.commit()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            migrations_log.error("Schema migration %s (%s) failed: %s", version, name, e)
+            raise
+        migrations_log.info("Applied schema migration %s: %s", version, name)
+        applied.append(version)
+    return applied
+
+
+# ---------------------------------------------------------------------- CLI
+
+def _connect():
+    import db
+    db._create_database_if_missing()
+    if db.CONNECT_AVAILABLE:
+        return db.connect.get_connection()
+    import mysql.connector
+    return mysql.connector.connect(host=db.DB_HOST, port=db.DB_PORT, user=db.DB_USER,
+                                   password=db.DB_PASSWORD, database=db.DB_NAME)
+
+
+def main(argv=None):
+    import argparse
+    import db
+
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument('command', choices=('migrate', 'status'))
+    parser.add_argument('--lock-timeout', type=int, default=SCHEMA_LOCK_TIMEOUT,
+                        help="seconds to wait for a concurrent migration (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    try:
+        conn = _connect()
+    except Exception as e:
+        print(f"No database connection (check DB_HOST, DB_USER, DB_PASSWORD, DB_NAME): {e}", file=sys.stderr)
+        return 2
+    try:
+        if args.command == 'status':
+            recorded = recorded_state(conn)
+            expected = expected_state(db._ensure_schema)
+            if recorded is None:
+                print("No schema_version table: database never migrated")
+            for version in sorted(set(expected) | set(recorded or {})):
+                have = (recorded or {}).get(version)
+                state = 'missing' if have is None else ('ok' if have == expected.get(version) else 'changed')
+                print(f"{version:>4}  {state:<8} {(have or '-')[:12]}")
+            return 0 if recorded == expected else 1
+        applied = migrate(conn, baseline=db._ensure_schema, lock_timeout=args.lock_timeout)
+        print(f"Applied: {', '.join(map(str, applied))}" if applied else "Schema already current")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
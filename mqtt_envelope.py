@@ -0,0 +1,275 @@
+"""
+Compact binary envelope for MQTT secure/sensor readings.
+
+The legacy payload is JSON whose 'data' field is another JSON string holding
+base64 AES-CBC output, plus two hex SHA-256 digests the server recomputes
+(hash_data over str(dict) and a hash of the sorted JSON). A typical reading
+went out as roughly 400 bytes and cost three JSON parses, two base64 decodes
+and two hashes to check.
+
+Version 2 is a single binary frame, authenticated in one AES-GCM pass:
+
+    offset  size  field
+    0       1     version (0x02)
+    1       1     flags (bit 0: seq present)
+    2       1     n = length of device_id
+    3       n     device_id (UTF-8)
+    3+n     8     seq, unsigned big-endian (only when flags bit 0 is set)
+    ...     12    GCM nonce
+    ...     m     ciphertext of the CBOR-encoded reading (RFC 8949 map)
+    end-16  16    GCM tag
+
+The whole header is GCM associated data, so device_id and seq are readable
+before decryption (dedup, worker routing) yet covered by the tag; they are
+removed from the CBOR body and put back on decode.
+
+The subscriber tells the formats apart by the first byte: '{' (or leading
+whitespace) is a legacy JSON payload, anything else is a version byte.
+Devices that only speak the legacy format keep working unchanged.
+"""
+
+import math
+import os
+import struct
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+LEGACY_ENVELOPE_VERSION = 1
+BINARY_ENVELOPE_VERSION = 2
+
+FLAG_SEQ = 0x01
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+_HEADER = struct.Struct('>BBB')
+_SEQ = struct.Struct('>Q')
+_JSON_START = frozenset(b'{ \t\r\n')
+
+
+# ---------------------------------------------------------------------- CBOR
+# Just the subset a reading needs: maps, arrays, text, bytes, integers,
+# floats, booleans and null, definite lengths only.
+
+def _cbor_head(out: bytearray, major: int, value: int):
+    if value < 24:
+        out.append((major << 5) | value)
+    elif value <= 0xFF:
+        out.append((major << 5) | 24)
+        out.append(value)
+    elif value <= 0xFFFF:
+        out.append((major << 5) | 25)
+        out += struct.pack('>H', value)
+    elif value <= 0xFFFFFFFF:
+        out.append((major << 5) | 26)
+        out += struct.pack('>I', value)
+    elif value <= 0xFFFFFFFFFFFFFFFF:
+        out.append((major << 5) | 27)
+        out += struct.pack('>Q', value)
+    else:
+        raise ValueError("integer too large for CBOR")
+
+
+def _cbor_encode(out: bytearray, value):
+    if value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            _cbor_head(out, 0, value)
+        else:
+            _cbor_head(out, 1, -1 - value)
+    elif isinstance(value, float):
+        # Shortest exact form: most sensor values do not fit float32 exactly
+        single = struct.pack('>f', value) if math.isfinite(value) and abs(value) < 3.4e38 else None
+        if single is not None and struct.unpack('>f', single)[0] == value:
+            out.append(0xFA)
+            out += single
+        else:
+            out.append(0xFB)
+            out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        _cbor_head(out, 3, len(encoded))
+        out += encoded
+    elif isinstance(value, (bytes, bytearray)):
+        _cbor_head(out, 2, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _cbor_head(out, 4, len(value))
+        for item in value:
+            _cbor_encode(out, item)
+    elif isinstance(value, dict):
+        _cbor_head(out, 5, len(value))
+        for key, item in value.items():
+            _cbor_encode(out, key)
+            _cbor_encode(out, item)
+    else:
+        raise ValueError(f"cannot CBOR-encode {type(value).__name__}")
+
+
+def cbor_dumps(value) -> bytes:
+    out = bytearray()
+    _cbor_encode(out, value)
+    return bytes(out)
+
+
+def _cbor_decode(data: bytes, pos: int):
+    if pos >= len(data):
+        raise ValueError("truncated CBOR")
+    initial = data[pos]
+    major, info = initial >> 5, initial & 0x1F
+    pos += 1
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info in (22, 23):
+            return None, pos
+        for code, fmt in ((25, '>e'), (26, '>f'), (27, '>d')):
+            if info == code:
+                size = struct.calcsize(fmt)
+                if pos + size > len(data):
+                    raise ValueError("truncated CBOR")
+                return struct.unpack_from(fmt, data, pos)[0], pos + size
+        raise ValueError(f"unsupported CBOR simple value {info}")
+
+    if info < 24:
+        value = info
+    elif 24 <= info <= 27:
+        size = 1 << (info - 24)
+        if pos + size > len(data):
+            raise ValueError("truncated CBOR")
+        value = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    else:
+        raise ValueError("indefinite-length CBOR is not supported")
+
+    if major == 0:
+        return value, pos
+    if major == 1:
+        return -1 - value, pos
+    if major in (2, 3):
+        if pos + value > len(data):
+            raise ValueError("truncated CBOR")
+        chunk = data[pos:pos + value]
+        return (bytes(chunk) if major == 2 else chunk.decode('utf-8')), pos + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, pos = _cbor_decode(data, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        result = {}
+        for _ in range(value):
+            key, pos = _cbor_decode(data, pos)
+            item, pos = _cbor_decode(data, pos)
+            result[key] = item
+        return result, pos
+    raise ValueError("CBOR tags are not supported")
+
+
+def cbor_loads(data: bytes):
+    value, pos = _cbor_decode(data, 0)
+    if pos != len(data):
+        raise ValueError("trailing bytes after CBOR value")
+    return value
+
+
+# ---------------------------------------------------------------------- envelope
+
+def envelope_version(payload) -> int:
+    """Format of a secure/sensor payload: LEGACY_ENVELOPE_VERSION for JSON, else its version byte (0 if empty)."""
+    if isinstance(payload, str):
+        return LEGACY_ENVELOPE_VERSION
+    if not payload:
+        return 0
+    return LEGACY_ENVELOPE_VERSION if payload[0] in _JSON_START else payload[0]
+
+
+def _sequence_number(seq) -> Optional[int]:
+    if isinstance(seq, bool) or not isinstance(seq, int) or not 0 <= seq <= 0xFFFFFFFFFFFFFFFF:
+        return None
+    return seq
+
+
+@lru_cache(maxsize=16)
+def _aesgcm(key: bytes) -> AESGCM:
+    # OpenSSL-backed; building the GHASH key schedule per message would cost
+    # more than the decryption itself
+    return AESGCM(key)
+
+
+def pack_reading(data: dict, key: bytes) -> bytes:
+    """Seal a reading dict (must carry device_id) into a version 2 frame."""
+    device_id = str(data.get('device_id') or '').encode('utf-8')
+    if not device_id or len(device_id) > 0xFF:
+        raise ValueError("device_id must be 1-255 bytes")
+    body = {k: v for k, v in data.items() if k != 'device_id'}
+    seq = _sequence_number(body.get('seq'))
+    header = bytearray(_HEADER.pack(BINARY_ENVELOPE_VERSION, FLAG_SEQ if seq is not None else 0, len(device_id)))
+    header += device_id
+    if seq is not None:
+        header += _SEQ.pack(seq)
+        del body['seq']
+    header = bytes(header)
+    nonce = os.urandom(NONCE_SIZE)
+    # AESGCM returns ciphertext with the tag appended
+    return header + nonce + _aesgcm(key).encrypt(nonce, cbor_dumps(body), header)
+
+
+def read_header(payload: bytes) -> Tuple[str, Optional[int], int]:
+    """Plaintext header of a version 2 frame, without decrypting.
+
+    Returns:
+        (device_id, seq or None, header length)
+
+    Raises:
+        ValueError: Not a well-formed version 2 frame
+    """
+    if len(payload) < _HEADER.size:
+        raise ValueError("payload too short")
+    version, flags, id_length = _HEADER.unpack_from(payload, 0)
+    if version != BINARY_ENVELOPE_VERSION:
+        raise ValueError(f"unsupported envelope version {version}")
+    offset = _HEADER.size + id_length
+    seq = None
+    if flags & FLAG_SEQ:
+        if len(payload) < offset + _SEQ.size:
+            raise ValueError("payload too short")
+        seq = _SEQ.unpack_from(payload, offset)[0]
+        offset += _SEQ.size
+    if len(payload) < offset + NONCE_SIZE + TAG_SIZE:
+        raise ValueError("payload too short")
+    device_id = bytes(payload[_HEADER.size:_HEADER.size + id_length]).decode('utf-8')
+    return device_id, seq, offset
+
+
+def unpack_reading(payload: bytes, key: bytes) -> dict:
+    """Verify and decrypt a version 2 frame back into the reading dict.
+
+    Raises:
+        ValueError: Malformed frame, or the GCM tag does not verify
+    """
+    device_id, seq, offset = read_header(payload)
+    payload = bytes(payload)
+    try:
+        body = _aesgcm(key).decrypt(payload[offset:offset + NONCE_SIZE], payload[offset + NONCE_SIZE:],
+                                    payload[:offset])
+    except InvalidTag:
+        raise ValueError("MAC check failed") from None
+    data = cbor_loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("reading is not a CBOR map")
+    data['device_id'] = device_id
+    if seq is not None:
+        data['seq'] = seq
+    return data
@@ -0,0 +1,235 @@
+"""
+Worker pool between the MQTT secure/sensor subscriber and the ingest pipeline.
+
+paho runs every on_message callback on its single network-loop thread. When
+the whole pipeline (session checks, threshold lookups, the sensor_data INSERT)
+ran there, one slow MySQL commit stalled reads, PINGREQs and the QoS 1 acks
+of every other device. The subscriber now only decodes the payload on the
+network thread (AES, well under a millisecond, needed to learn device_id; no
+registry or database lookups) and hands the message to a worker:
+
+- MQTT_INGEST_WORKERS threads, each with its own bounded FIFO queue
+  (MQTT_INGEST_QUEUE_SIZE messages); a device is always hashed (crc32 of the
+  normalized device_id) to the same worker, so its readings and session
+  counters are processed in arrival order
+- backpressure comes from MQTT flow control, not from blocking paho: the
+  subscriber connects with MQTT v5 Receive Maximum = MQTT_INGEST_RECEIVE_MAXIMUM
+  and QoS 1 messages are acknowledged only after the worker has processed
+  them (paho manual_ack), so the broker stops sending once that many
+  readings are unacknowledged. Every worker queue holds at least the whole
+  window, so a put does not wait while the broker keeps to it
+- if a queue is full anyway (QoS 0 floods, a broker ignoring the window),
+  the network thread waits at most MQTT_INGEST_PUT_TIMEOUT seconds, well
+  inside the keepalive, then drops the reading (counted as dropped) and
+  acks it so the window slot is freed; it never blocks indefinitely, which
+  would stop PINGREQ/PUBACK handling and get the client disconnected
+
+Queue depth, enqueue-to-start lag and processing time are exposed under
+"mqtt_ingest" in /api/test/stats. MQTT_INGEST_WORKERS=0 keeps the old
+behaviour of processing on the network thread.
+"""
+
+import os
+import queue
+import threading
+import time
+import zlib
+from typing import Optional
+
+from app_logging import get_logger
+from db import connection_scope
+from ingest_pipeline import IngestError, IngestMessage
+from sensor_registry import normalize_device_id
+
+
+mqtt_log = get_logger('mqtt')
+
+MQTT_INGEST_WORKERS = int(os.environ.get('MQTT_INGEST_WORKERS', '4'))
+MQTT_INGEST_QUEUE_SIZE = int(os.environ.get('MQTT_INGEST_QUEUE_SIZE', '256'))
+# Unacknowledged QoS 1 readings the broker may have in flight to this client
+MQTT_INGEST_RECEIVE_MAXIMUM = int(os.environ.get('MQTT_INGEST_RECEIVE_MAXIMUM', '64'))
+# Longest the network thread waits for room in a full worker queue
+MQTT_INGEST_PUT_TIMEOUT = float(os.environ.get('MQTT_INGEST_PUT_TIMEOUT', '5'))
+
+
+class MqttIngestDispatcher:
+    """Per-device ordered worker queues feeding an IngestPipeline."""
+
+    def __init__(self, ingest_pipeline, workers: int = MQTT_INGEST_WORKERS,
+                 queue_size: int = MQTT_INGEST_QUEUE_SIZE, receive_maximum: int = MQTT_INGEST_RECEIVE_MAXIMUM,
+                 put_timeout: float = MQTT_INGEST_PUT_TIMEOUT):
+        self._pipeline = ingest_pipeline
+        self.workers = max(0, int(workers))
+        # MQTT v5 Receive Maximum is 1..65535
+        self.receive_maximum = min(65535, max(1, int(receive_maximum)))
+        # One device's readings all go to one worker, so each queue must take the whole window
+        self._queue_size = max(1, int(queue_size), self.receive_maximum)
+        self._put_timeout = max(0.0, float(put_timeout))
+        self._queues = [queue.Queue(maxsize=self._queue_size) for _ in range(self.workers)]
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'processed': 0,
+            'rejected': 0,
+            'errors': 0,
+            'blocked_puts': 0,
+            'blocked_ms': 0.0,
+            'dropped': 0,
+            'max_depth': 0,
+            'last_lag_ms': None,
+            'max_lag_ms': 0.0,
+            'total_lag_ms': 0.0,
+            'total_process_ms': 0.0,
+        }
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(index,), name=f'mqtt-ingest-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # ------------------------------------------------------------------ producer side (network thread)
+
+    def submit(self, payload, ack=None):
+        """Decode one secure/sensor payload and queue it for its device's worker.
+
+        Args:
+            payload: Raw MQTT message payload
+            ack: Callable run once the message is done with (sends the QoS 1
+                PUBACK when the client uses manual acks), or None
+        """
+        msg = IngestMessage('mqtt', payload)
+        if not self.workers:
+            self._process(msg, ack)
+            return
+        try:
+            self._pipeline.decode(msg)
+        except IngestError as e:
+            self._count('rejected')
+            mqtt_log.warning("MQTT Sensor: %s", e.message)
+            self._ack(ack)
+            return
+        worker = self.worker_for(msg.sensor_id)
+        item = (msg, ack, time.monotonic())
+        target = self._queues[worker]
+        try:
+            target.put_nowait(item)
+        except queue.Full:
+            # Only when the broker sends beyond the Receive Maximum window (or
+            # QoS 0): wait briefly, never long enough to miss keepalives
+            blocked_since = time.monotonic()
+            try:
+                target.put(item, timeout=self._put_timeout)
+            except queue.Full:
+                self._count('dropped')
+                mqtt_log.error("MQTT Sensor: ingest worker %s queue full (%s) for %.1fs; dropping reading from %s",
+                               worker, self._queue_size, self._put_timeout, msg.sensor_id)
+                self._ack(ack)
+                return
+            finally:
+                with self._stats_lock:
+                    self._stats['blocked_puts'] += 1
+                    self._stats['blocked_ms'] += (time.monotonic() - blocked_since) * 1000
+        depth = target.qsize()
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], depth)
+
+    def worker_for(self, device_id) -> int:
+        """Stable worker index for a device (same device, same queue)."""
+        key = normalize_device_id(device_id) or ''
+        return zlib.crc32(key.encode('utf-8')) % self.workers
+
+    # ------------------------------------------------------------------ consumer side
+
+    def _run(self, index: int):
+        work = self._queues[index]
+        while True:
+            msg, ack, enqueued_at = work.get()
+            lag_ms = (time.monotonic() - enqueued_at) * 1000
+            with self._stats_lock:
+                self._stats['last_lag_ms'] = round(lag_ms, 3)
+                self._stats['max_lag_ms'] = max(self._stats['max_lag_ms'], lag_ms)
+                self._stats['total_lag_ms'] += lag_ms
+            self._process(msg, ack)
+
+    def _process(self, msg: IngestMessage, ack):
+        started = time.perf_counter()
+        try:
+            # Session lookup, thresholds and the INSERT share one connection
+            with connection_scope():
+                self._pipeline.process(msg)
+        except IngestError as e:
+            self._count('rejected')
+            mqtt_log.warning("MQTT Sensor: %s", e.message)
+        except Exception as e:
+            self._count('errors')
+            mqtt_log.exception("MQTT Sensor: Error processing message: %s", e)
+        finally:
+            with self._stats_lock:
+                self._stats['processed'] += 1
+                self._stats['total_process_ms'] += (time.perf_counter() - started) * 1000
+            self._ack(ack)
+
+    @staticmethod
+    def _ack(ack):
+        if ack is None:
+            return
+        try:
+            ack()
+        except Exception as e:
+            mqtt_log.warning("MQTT Sensor: ack failed: %s", e)
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def stats(self) -> dict:
+        depths = [q.qsize() for q in self._queues]
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lagged = stats['processed'] if self.workers else 0
+        stats['avg_lag_ms'] = round(stats.pop('total_lag_ms') / lagged, 3) if lagged else None
+        processed = stats['processed']
+        stats['avg_process_ms'] = round(stats.pop('total_process_ms') / processed, 3) if processed else None
+        stats['max_lag_ms'] = round(stats['max_lag_ms'], 3)
+        stats['blocked_ms'] = round(stats['blocked_ms'], 3)
+        return dict(stats, workers=self.workers, queue_size=self._queue_size,
+                    receive_maximum=self.receive_maximum, depth=sum(depths), depth_per_worker=depths)
+
+
+# Global instance for use across the application
+_mqtt_ingest_dispatcher: Optional[MqttIngestDispatcher] = None
+_mqtt_ingest_dispatcher_lock = threading.Lock()
+
+
+def start_mqtt_ingest_dispatcher(ingest_pipeline) -> MqttIngestDispatcher:
+    """
+    Create (once) and start the global dispatcher for the MQTT subscriber.
+
+    Returns:
+        MqttIngestDispatcher: Singleton instance
+    """
+    global _mqtt_ingest_dispatcher
+    with _mqtt_ingest_dispatcher_lock:
+        if _mqtt_ingest_dispatcher is None:
+            _mqtt_ingest_dispatcher = MqttIngestDispatcher(ingest_pipeline)
+        _mqtt_ingest_dispatcher.start()
+    return _mqtt_ingest_dispatcher
+
+
+def get_mqtt_ingest_dispatcher() -> Optional[MqttIngestDispatcher]:
+    """
+    Get the global dispatcher.
+
+    Returns:
+        MqttIngestDispatcher, or None when the MQTT subscriber is not running
+    """
+    return _mqtt_ingest_dispatcher
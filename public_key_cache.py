@@ -0,0 +1,161 @@
+"""
+Cache of parsed device public keys for signature verification.
+
+Parsing a PEM on every reading (and probing up to three PEM files under
+user_keys/ and sensor_keys/ when the key is not stored in the database) is a
+measurable part of ingest CPU on Pi-class hosts. This module keeps a bounded
+LRU of parsed key objects (RSA or Ed25519, see encryption_utils.import_key) keyed by
+(user_id, normalized device_id, key fingerprint), plus the PEM resolved from
+the filesystem fallbacks so those files are only read once per device.
+
+Entries are invalidated when a key is rotated (MQTT key subscriber,
+add_user_key, update_sensor_by_device_id). Because the fingerprint is part of
+the key, a rotated key stored in the database never hits a stale entry even
+before invalidation runs.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from encryption_utils import import_key
+
+
+PUBLIC_KEY_CACHE_SIZE = int(os.environ.get('PUBLIC_KEY_CACHE_SIZE', '1024'))
+
+
+def compute_public_key_fingerprint(public_key_pem: str | None) -> str | None:
+    """Compute a short fingerprint from a public key PEM string."""
+    if not public_key_pem:
+        return None
+    try:
+        # Compute SHA-256 hash of the key
+        key_bytes = public_key_pem.encode('utf-8') if isinstance(public_key_pem, str) else public_key_pem
+        key_hash = hashlib.sha256(key_bytes).hexdigest()
+        # Return first 16 characters as fingerprint
+        return key_hash[:16].upper()
+    except Exception:
+        return None
+
+
+def _norm(device_id) -> str:
+    return str(device_id or '').strip().lower()
+
+
+class PublicKeyCache:
+    """Thread-safe bounded LRU of parsed public keys."""
+
+    def __init__(self, max_size: int = PUBLIC_KEY_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._max_size = max(1, int(max_size))
+        self._keys = OrderedDict()   # (user_id, device_id, fingerprint) -> RsaKey or EccKey
+        self._pems = {}              # (user_id, device_id) -> (pem, source) from filesystem
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_key(self, user_id, device_id: str, public_key_pem: str):
+        """Return the parsed key for a PEM, importing it on a cache miss.
+
+        Args:
+            user_id: Owner of the sensor
+            device_id: Device ID (case-insensitive)
+            public_key_pem: PEM text of the public key
+
+        Returns:
+            Parsed key object (raises ValueError if the PEM cannot be parsed)
+        """
+        fingerprint = compute_public_key_fingerprint(public_key_pem)
+        cache_key = (user_id, _norm(device_id), fingerprint)
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return key
+            self.misses += 1
+        pem_bytes = public_key_pem.encode('utf-8') if isinstance(public_key_pem, str) else public_key_pem
+        key = import_key(pem_bytes)
+        with self._lock:
+            self._keys[cache_key] = key
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self._max_size:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def get_pem(self, user_id, device_id: str):
+        """Return a previously resolved filesystem (pem, source) tuple, or None."""
+        with self._lock:
+            return self._pems.get((user_id, _norm(device_id)))
+
+    def set_pem(self, user_id, device_id: str, pem: str, source: str):
+        """Remember the PEM resolved from the filesystem fallbacks."""
+        with self._lock:
+            self._pems[(user_id, _norm(device_id))] = (pem, source)
+
+    def invalidate(self, user_id=None, device_id: Optional[str] = None):
+        """Drop cached keys for a device (optionally scoped to one user).
+
+        Args:
+            user_id: Owner to invalidate; None matches every user
+            device_id: Device to invalidate; None clears the whole cache
+        """
+        with self._lock:
+            self.invalidations += 1
+            if device_id is None and user_id is None:
+                self._keys.clear()
+                self._pems.clear()
+                return
+            dev = _norm(device_id) if device_id is not None else None
+
+            def _match(uid, did):
+                return (user_id is None or uid == user_id) and (dev is None or did == dev)
+
+            for k in [k for k in self._keys if _match(k[0], k[1])]:
+                del self._keys[k]
+            for k in [k for k in self._pems if _match(k[0], k[1])]:
+                del self._pems[k]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._keys),
+                'max_size': self._max_size,
+                'file_keys': len(self._pems),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+# Global instance for use across the application
+_public_key_cache: Optional[PublicKeyCache] = None
+_public_key_cache_lock = threading.Lock()
+
+
+def get_public_key_cache() -> PublicKeyCache:
+    """
+    Get or create the global public key cache.
+
+    Returns:
+        PublicKeyCache: Singleton instance
+    """
+    global _public_key_cache
+    if _public_key_cache is None:
+        with _public_key_cache_lock:
+            if _public_key_cache is None:
+                _public_key_cache = PublicKeyCache()
+    return _public_key_cache
+
+
+def invalidate_public_key(user_id=None, device_id: Optional[str] = None):
+    """Invalidate cached keys in the global cache (no-op before first use)."""
+    if _public_key_cache is not None:
+        _public_key_cache.invalidate(user_id, device_id)
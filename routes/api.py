@@ -196,6 +196,36 @@ def register_api_routes(app, get_user_key, add_user_key, user_pending_keys, pend
             traceback.print_exc()
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/api/sensors/online')
+    @login_required
+    def api_sensors_online():
+        """Online/offline status of the current user's sensors."""
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({"error": "User session not found"}), 401
+
+        from heartbeat import get_heartbeat_tracker
+        from sensor_registry import get_sensor_registry
+        heartbeats = get_heartbeat_tracker()
+        rows = get_sensor_registry().get_user_sensors(user_id)
+        statuses = heartbeats.statuses(user_id, [row.get('device_id') for row in rows])
+        sensors = []
+        for row in rows:
+            entry = {
+                'device_id': row.get('device_id'),
+                'device_type': row.get('device_type'),
+                'location': row.get('location') or 'Unassigned',
+                'status': row.get('status'),
+            }
+            entry.update(statuses[row.get('device_id')])
+            sensors.append(entry)
+        sensors.sort(key=lambda entry: (entry['location'], str(entry['device_id'])))
+        return jsonify({
+            'sensors': sensors,
+            'online': sum(1 for entry in sensors if entry['online']),
+            'online_seconds': heartbeats.online_seconds,
+        })
+
     @app.route('/api/test/env', methods=['GET'])
     @login_required
     def test_env_vars():
@@ -229,3 +259,43 @@ def register_api_routes(app, get_user_key, add_user_key, user_pending_keys, pend
         
         return jsonify(config)
 
+
+    @app.route('/api/test/stats', methods=['GET'])
+    @login_required
+    def test_runtime_stats():
+        """Test endpoint to inspect ingest cache and writer counters."""
+        from sensor_registry import get_sensor_registry
+        from public_key_cache import get_public_key_cache
+        from sensor_writer import SENSOR_WRITE_BEHIND, get_sensor_writer
+        from threshold_cache import get_threshold_cache
+        from utils.session_store import DEVICE_SESSION_STORE, get_session_store
+        import app_logging
+        from ingest_pipeline import get_ingest_metrics
+        from session_keys import get_session_key_store
+        from crypto_executor import get_crypto_executor
+        from admission import get_admission_controller
+        from mqtt_ingest import get_mqtt_ingest_dispatcher
+        from utils.mqtt_utils import get_mqtt_publisher
+        from ingest_dedup import get_sequence_window
+        from heartbeat import get_heartbeat_tracker
+        import db
+        session_store = get_session_store()
+        mqtt_ingest = get_mqtt_ingest_dispatcher()
+        return jsonify({
+            "sensor_registry": {"size": get_sensor_registry().size()},
+            "public_key_cache": get_public_key_cache().stats(),
+            "sensor_writer": dict(get_sensor_writer().stats(), enabled=SENSOR_WRITE_BEHIND),
+            "threshold_cache": get_threshold_cache().stats(),
+            "device_sessions": dict(session_store.stats() if session_store else {}, store=DEVICE_SESSION_STORE),
+            "session_keys": get_session_key_store().stats(),
+            "crypto_executor": get_crypto_executor().stats(),
+            "admission": get_admission_controller().stats(),
+            "mqtt_ingest": mqtt_ingest.stats() if mqtt_ingest else {"running": False},
+            "mqtt_publisher": get_mqtt_publisher().stats(),
+            "logging": app_logging.stats(),
+            "ingest_pipeline": get_ingest_metrics().stats(),
+            "ingest_dedup": get_sequence_window().stats(),
+            "heartbeat": get_heartbeat_tracker().stats(),
+            "db_pool": db.connect.pool_stats() if db.CONNECT_AVAILABLE else {"size": db.DB_POOL_SIZE},
+            "db_scope": db.connection_scope_stats(),
+        })
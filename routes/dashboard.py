@@ -1,6 +1,6 @@
 """Dashboard routes: landing, dashboard, readings, history, profile."""
 from flask import render_template, redirect, url_for, session, flash, request
-from db import get_user_by_username, get_locations_with_status, list_recent_sensor_data, get_pool, _get_connection, _get_cursor, _return_connection
+from db import get_user_by_username, get_locations_with_status, list_recent_sensor_data, get_pool, read_snapshot, _get_connection, _get_cursor, _return_connection
 from utils.auth import login_required
 
 
@@ -54,7 +54,9 @@ def register_dashboard_routes(app, user_latest_by_metric):
         if user_id and user_id in user_latest_by_metric:
             realtime_metrics_data = user_latest_by_metric[user_id]
         
-        locations_data = get_locations_with_status(user_id=user_id, realtime_metrics_data=realtime_metrics_data)
+        # Locations, sensors and their latest readings from one consistent snapshot
+        with read_snapshot():
+            locations_data = get_locations_with_status(user_id=user_id, realtime_metrics_data=realtime_metrics_data)
         
         print(f"DEBUG: dashboard - Found {len(locations_data)} locations for user_id {user_id} (username: {username})", file=sys.stderr)
         for loc in locations_data:
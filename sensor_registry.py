@@ -0,0 +1,201 @@
+"""
+In-memory sensor registry for the ingest hot path.
+
+Ingest (HTTP /submit-data, MQTT secure/sensor) and the device session endpoints
+need to resolve a device_id to its registered sensor row(s) on every message.
+Scanning the full sensors table for each reading does not scale, so this module
+keeps an index of the columns ingest needs, keyed by normalized device_id and
+by (user_id, device_id).
+
+Freshness:
+- The registry is filled on first use (or explicitly at startup)
+- db.create_sensor / update_sensor_by_device_id / delete_sensor_by_device_id
+  invalidate the affected device_id, which is reloaded on the next lookup
+- Changes made by other processes are picked up by a cheap periodic check of
+  COUNT(*) and MAX(updated_at) (SENSOR_REGISTRY_REFRESH_SECONDS, default 5)
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+
+SENSOR_REGISTRY_REFRESH_SECONDS = float(os.environ.get('SENSOR_REGISTRY_REFRESH_SECONDS', '5'))
+
+
+def normalize_device_id(device_id) -> str:
+    """Normalize a device_id for registry lookups (case-insensitive, trimmed)."""
+    return str(device_id or '').strip().lower()
+
+
+class SensorRegistry:
+    """Thread-safe index of registered sensors used by ingest lookups."""
+
+    def __init__(self, refresh_seconds: float = SENSOR_REGISTRY_REFRESH_SECONDS):
+        self._lock = threading.RLock()
+        self._refresh_seconds = refresh_seconds
+        self._by_device = {}        # normalized device_id -> [sensor rows]
+        self._by_user_device = {}   # (user_id, normalized device_id) -> sensor row
+        self._loaded = False
+        self._stamp = None          # (row count, max updated_at) at last sync
+        self._last_check = 0.0
+        self._pending = set()       # normalized device_ids to reload
+
+    def _index_rows(self, rows):
+        by_device = {}
+        by_user_device = {}
+        for row in rows:
+            key = normalize_device_id(row.get('device_id'))
+            if not key:
+                continue
+            by_device.setdefault(key, []).append(row)
+            by_user_device[(row.get('user_id'), key)] = row
+        return by_device, by_user_device
+
+    def _replace_device(self, key, rows):
+        """Replace all rows for one normalized device_id (caller holds the lock)."""
+        for row in self._by_device.pop(key, []):
+            self._by_user_device.pop((row.get('user_id'), key), None)
+        rows = [r for r in rows if normalize_device_id(r.get('device_id')) == key]
+        if rows:
+            self._by_device[key] = rows
+            for row in rows:
+                self._by_user_device[(row.get('user_id'), key)] = row
+
+    def _full_load(self) -> bool:
+        from db import list_registry_sensors, get_sensor_registry_stamp
+        stamp = get_sensor_registry_stamp()
+        rows = list_registry_sensors()
+        if rows is None:
+            return False
+        self._by_device, self._by_user_device = self._index_rows(rows)
+        self._stamp = stamp
+        self._loaded = True
+        self._pending.clear()
+        print(f"Sensor registry: loaded {len(rows)} sensors", file=sys.stderr)
+        return True
+
+    def _reload_pending(self):
+        from db import list_registry_sensors
+        for key in list(self._pending):
+            rows = list_registry_sensors(device_id=key)
+            if rows is None:
+                continue
+            self._replace_device(key, rows)
+            self._pending.discard(key)
+
+    def _incremental_refresh(self):
+        """Pick up changes made outside this process using updated_at."""
+        from db import list_registry_sensors, get_sensor_registry_stamp
+        stamp = get_sensor_registry_stamp()
+        if stamp is None or stamp == self._stamp:
+            return
+        old_max = self._stamp[1] if self._stamp else None
+        if old_max is None:
+            self._full_load()
+            return
+        rows = list_registry_sensors(updated_since=old_max)
+        if rows is None:
+            return
+        by_device, _ = self._index_rows(rows)
+        for key in by_device:
+            # Reload whole device so sibling rows (other users) stay consistent
+            self._pending.add(key)
+        self._reload_pending()
+        self._stamp = stamp
+        if stamp[0] != self.size():
+            # Rows were deleted elsewhere (deletes don't touch updated_at)
+            self._full_load()
+
+    def refresh(self, force: bool = False):
+        """Bring the registry up to date.
+
+        Args:
+            force: Reload every sensor instead of the incremental check
+        """
+        with self._lock:
+            try:
+                if force or not self._loaded:
+                    self._full_load()
+                else:
+                    if self._pending:
+                        self._reload_pending()
+                    now = time.monotonic()
+                    if now - self._last_check >= self._refresh_seconds:
+                        self._last_check = now
+                        self._incremental_refresh()
+            except Exception as e:
+                print(f"Sensor registry: refresh error: {e}", file=sys.stderr)
+
+    def invalidate(self, device_id: Optional[str] = None):
+        """Mark a device_id (or the whole registry) as stale.
+
+        Args:
+            device_id: Device to reload on next lookup; None reloads everything
+        """
+        with self._lock:
+            if device_id is None:
+                self._loaded = False
+            else:
+                self._pending.add(normalize_device_id(device_id))
+
+    def get_sensors(self, device_id: str, active_only: bool = False) -> list:
+        """Return all registered sensors for a device_id (any user).
+
+        Args:
+            device_id: Device ID (case-insensitive)
+            active_only: Only return sensors with status 'active'
+
+        Returns:
+            List of sensor dicts (ingest columns only)
+        """
+        self.refresh()
+        with self._lock:
+            rows = list(self._by_device.get(normalize_device_id(device_id), []))
+        if active_only:
+            rows = [r for r in rows if r.get('status') == 'active']
+        return rows
+
+    def get_sensor(self, user_id, device_id: str):
+        """Return the sensor registered by user_id under device_id, or None."""
+        self.refresh()
+        with self._lock:
+            return self._by_user_device.get((user_id, normalize_device_id(device_id)))
+
+    def get_user_sensors(self, user_id) -> list:
+        """Return every sensor registered by user_id."""
+        self.refresh()
+        with self._lock:
+            return [row for (owner, _), row in self._by_user_device.items() if owner == user_id]
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(len(rows) for rows in self._by_device.values())
+
+
+# Global instance for use across the application
+_sensor_registry: Optional[SensorRegistry] = None
+_sensor_registry_lock = threading.Lock()
+
+
+def get_sensor_registry() -> SensorRegistry:
+    """
+    Get or create the global sensor registry.
+
+    Returns:
+        SensorRegistry: Singleton instance
+    """
+    global _sensor_registry
+    if _sensor_registry is None:
+        with _sensor_registry_lock:
+            if _sensor_registry is None:
+                _sensor_registry = SensorRegistry()
+    return _sensor_registry
+
+
+def invalidate_sensor(device_id: Optional[str] = None):
+    """Invalidate a device_id in the global registry (no-op before first use)."""
+    if _sensor_registry is not None:
+        _sensor_registry.invalidate(device_id)
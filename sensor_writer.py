@@ -0,0 +1,360 @@
+"""
+Optional write-behind writer for sensor_data rows.
+
+With SENSOR_WRITE_BEHIND=true, db.insert_sensor_data enqueues readings instead
+of opening a connection, encrypting, inserting and committing per reading. A
+background thread flushes the queue in one transaction (multi-row INSERT via
+db.insert_sensor_data_batch) whenever SENSOR_WRITE_BATCH_SIZE rows are waiting
+or SENSOR_WRITE_FLUSH_MS milliseconds have passed, so ingest latency no longer
+depends on MySQL commit latency.
+
+Guarantees:
+- Backpressure: when the queue (SENSOR_WRITE_QUEUE_SIZE readings) is full, callers block
+  for up to SENSOR_WRITE_PUT_TIMEOUT seconds and then get False back
+- Failed flushes are retried; rows are never dropped while the process runs
+- Rows carry the time they were submitted (recorded_at), so a reading keeps
+  its own timestamp however late it is flushed or replayed
+- On shutdown (atexit) the queue is drained and flushed; anything the database
+  still refuses is spooled (values Fernet-encrypted) to a per-process file
+  next to SENSOR_WRITE_SPOOL (sensor_data_spool.<pid>.jsonl), and the next
+  writer to start in any process replays every leftover spool file. Claiming
+  and appending happen under a lock file; a claimed file is only deleted
+  once its rows are committed, so a crash or a second outage during replay
+  leaves it to be replayed again
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process spool lock (single-process dev server)
+    fcntl = None
+
+
+SENSOR_WRITE_BEHIND = (os.environ.get('SENSOR_WRITE_BEHIND', 'false') or 'false').strip().lower() in ('1', 'true', 'yes')
+SENSOR_WRITE_QUEUE_SIZE = int(os.environ.get('SENSOR_WRITE_QUEUE_SIZE', '10000'))
+SENSOR_WRITE_BATCH_SIZE = int(os.environ.get('SENSOR_WRITE_BATCH_SIZE', '200'))
+SENSOR_WRITE_FLUSH_MS = int(os.environ.get('SENSOR_WRITE_FLUSH_MS', '250'))
+SENSOR_WRITE_PUT_TIMEOUT = float(os.environ.get('SENSOR_WRITE_PUT_TIMEOUT', '2'))
+SENSOR_WRITE_SPOOL = os.environ.get(
+    'SENSOR_WRITE_SPOOL',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensor_data_spool.jsonl'),
+)
+
+
+class SensorDataWriter:
+    """Bounded queue plus a background thread that bulk-inserts sensor_data rows."""
+
+    def __init__(self, batch_size: int = SENSOR_WRITE_BATCH_SIZE, flush_ms: int = SENSOR_WRITE_FLUSH_MS,
+                 queue_size: int = SENSOR_WRITE_QUEUE_SIZE, put_timeout: float = SENSOR_WRITE_PUT_TIMEOUT,
+                 spool_path: str = SENSOR_WRITE_SPOOL):
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = max(1, flush_ms) / 1000.0
+        self._put_timeout = put_timeout
+        self._spool_path = spool_path
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._retry = []  # rows from a failed flush, written before new ones
+        self._stats = {
+            'enqueued': 0,
+            'rejected': 0,
+            'flushed_rows': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'spooled_rows': 0,
+            'replayed_rows': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_flush_ms': None,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sensor-data-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the worker and flush everything still queued (durable shutdown)."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        # Drain whatever the worker didn't get to (or everything if it never started)
+        rows = self._retry + self._drain(None)
+        self._retry = []
+        if rows and not self._flush(rows):
+            # One more attempt, then spool so nothing is lost across restarts
+            time.sleep(0.5)
+            if not self._flush(rows):
+                self._spool(rows)
+
+    # ------------------------------------------------------------------ producer side
+
+    def submit(self, rows) -> bool:
+        """Queue one reading: a row (sensor_db_id, value, status, user_id,
+        device_id) or the list of rows of a multi-metric reading.
+
+        The rows of a reading are one queue item, so they are queued (and
+        later flushed) all together or not at all. Blocks while the queue is
+        full (backpressure) and returns False if it stays full for
+        put_timeout seconds.
+        """
+        if isinstance(rows, dict):
+            rows = [rows]
+        if not rows:
+            return True
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        submitted_at = datetime.now().replace(microsecond=0)
+        for row in rows:
+            row.setdefault('recorded_at', submitted_at)
+        try:
+            self._queue.put(rows, timeout=self._put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            print(f"Sensor writer: queue full ({self._queue.maxsize}); rejecting reading for {rows[0].get('device_id')}", file=sys.stderr)
+            return False
+        with self._stats_lock:
+            self._stats['enqueued'] += len(rows)
+        return True
+
+    # ------------------------------------------------------------------ consumer side
+
+    def _drain(self, limit):
+        # Whole readings only: a batch may end up slightly over limit rows
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.extend(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        self._replay_spool()
+        backoff = self._flush_interval
+        while not self._stop.is_set():
+            rows = self._retry
+            self._retry = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(rows) < self._batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.extend(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                rows.extend(self._drain(self._batch_size - len(rows)))
+            if not rows:
+                continue
+            if self._flush(rows):
+                backoff = self._flush_interval
+            else:
+                # Keep rows for the next attempt; back off while the database is unhappy
+                self._retry = rows
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _flush(self, rows) -> bool:
+        from db import insert_sensor_data_batch
+        started = time.perf_counter()
+        inserted = insert_sensor_data_batch(rows)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            if inserted:
+                self._stats['flushes'] += 1
+                self._stats['flushed_rows'] += len(rows)
+                self._stats['last_batch_size'] = len(rows)
+                self._stats['max_batch_size'] = max(self._stats['max_batch_size'], len(rows))
+                self._stats['last_flush_ms'] = round(elapsed_ms, 2)
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], round(elapsed_ms, 2))
+                self._stats['total_flush_ms'] += elapsed_ms
+            else:
+                self._stats['failed_flushes'] += 1
+        if not inserted:
+            print(f"Sensor writer: flush of {len(rows)} rows failed; will retry", file=sys.stderr)
+        return bool(inserted)
+
+    # ------------------------------------------------------------------ spool
+
+    def _spool_parts(self):
+        root, ext = os.path.splitext(self._spool_path)
+        return root, ext or '.jsonl'
+
+    def _own_spool_path(self) -> str:
+        root, ext = self._spool_parts()
+        return f"{root}.{os.getpid()}{ext}"
+
+    def _locked(self):
+        """Open and exclusively lock the spool lock file (close it to unlock)."""
+        root, _ = self._spool_parts()
+        handle = open(root + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _spool(self, rows):
+        path = self._own_spool_path()
+        try:
+            from db_encryption import get_db_encryption
+            encryption = get_db_encryption()
+            with self._locked():
+                with open(path, 'a', encoding='utf-8') as f:
+                    for row in rows:
+                        record = dict(row)
+                        record['value'] = encryption.encrypt_value(row.get('value'))
+                        if isinstance(record.get('recorded_at'), datetime):
+                            record['recorded_at'] = record['recorded_at'].isoformat()
+                        f.write(json.dumps(record) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            with self._stats_lock:
+                self._stats['spooled_rows'] += len(rows)
+            print(f"Sensor writer: database unavailable at shutdown; spooled {len(rows)} rows to {path}", file=sys.stderr)
+        except Exception as e:
+            print(f"Sensor writer: failed to spool {len(rows)} rows: {e}", file=sys.stderr)
+
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        if os.name == 'nt':
+            # os.kill would terminate it; the Windows dev server is one process
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    def _claim_spool_files(self) -> list:
+        """Rename every leftover spool file to <file>.replay.<our pid> and return them.
+
+        Includes files of processes that are gone, files another writer
+        claimed but did not finish replaying (its process is gone too) and
+        the single shared spool file of older versions.
+        """
+        root, ext = self._spool_parts()
+        me = os.getpid()
+        claimed = []
+        with self._locked():
+            candidates = glob.glob(f"{glob.escape(root)}.*{ext}") + [self._spool_path]
+            for path in candidates:
+                if os.path.exists(path):
+                    target = f"{path}.replay.{me}"
+                    os.replace(path, target)
+                    claimed.append(target)
+            for path in glob.glob(f"{glob.escape(root)}*{ext}.replay*"):
+                if path in claimed:
+                    continue
+                owner = path.rsplit('.replay', 1)[1].lstrip('.')
+                if owner == str(me):
+                    # Left by this process's previous writer thread (stopped mid-replay)
+                    claimed.append(path)
+                    continue
+                if owner.isdigit() and self._pid_alive(int(owner)):
+                    continue
+                target = f"{path.rsplit('.replay', 1)[0]}.replay.{me}"
+                os.replace(path, target)
+                claimed.append(target)
+        return sorted(claimed)
+
+    def _read_spool(self, path) -> list:
+        from db_encryption import get_db_encryption
+        encryption = get_db_encryption()
+        rows = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                record['value'] = encryption.decrypt_value(record.get('value'))
+                if record.get('recorded_at'):
+                    record['recorded_at'] = datetime.fromisoformat(record['recorded_at'])
+                if record['value'] is not None:
+                    rows.append(record)
+        return rows
+
+    def _replay_spool(self):
+        """Flush leftover spool files (writer thread, before new rows); delete each once committed."""
+        if not self._spool_path:
+            return
+        try:
+            claimed = self._claim_spool_files()
+        except Exception as e:
+            print(f"Sensor writer: failed to claim spool files for {self._spool_path}: {e}", file=sys.stderr)
+            return
+        backoff = self._flush_interval
+        for path in claimed:
+            try:
+                rows = self._read_spool(path)
+            except Exception as e:
+                print(f"Sensor writer: failed to read spool {path}: {e}", file=sys.stderr)
+                continue
+            print(f"Sensor writer: replaying {len(rows)} spooled rows from {path}", file=sys.stderr)
+            # One transaction per file: the file goes only when all of it is stored
+            while rows and not self._flush(rows):
+                if self._stop.wait(backoff):
+                    # Shutting down: the claimed file stays for the next start
+                    return
+                backoff = min(backoff * 2, 30.0)
+            os.remove(path)
+            with self._stats_lock:
+                self._stats['replayed_rows'] += len(rows)
+
+    # ------------------------------------------------------------------ stats
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            result = dict(self._stats)
+        flushes = result.pop('total_flush_ms')
+        result['avg_flush_ms'] = round(flushes / result['flushes'], 2) if result['flushes'] else None
+        result['avg_batch_size'] = round(result['flushed_rows'] / result['flushes'], 2) if result['flushes'] else None
+        result['queue_depth'] = self._queue.qsize()
+        result['queue_capacity'] = self._queue.maxsize
+        result['pending_retry'] = len(self._retry)
+        result['running'] = bool(self._thread is not None and self._thread.is_alive())
+        return result
+
+
+# Global instance for use across the application
+_sensor_writer: Optional[SensorDataWriter] = None
+_sensor_writer_lock = threading.Lock()
+
+
+def get_sensor_writer() -> SensorDataWriter:
+    """
+    Get or create the global write-behind writer.
+
+    Returns:
+        SensorDataWriter: Singleton instance
+    """
+    global _sensor_writer
+    if _sensor_writer is None:
+        with _sensor_writer_lock:
+            if _sensor_writer is None:
+                _sensor_writer = SensorDataWriter()
+    return _sensor_writer
@@ -0,0 +1,165 @@
+"""
+Negotiated AES-GCM session keys for the symmetric /submit-data envelope.
+
+The hybrid envelope costs one RSA-2048 OAEP decrypt with the server private
+key per reading, which dominates ingest CPU (see CPU_USAGE_ANALYSIS.md). A
+device that asks for a key when its session is created (negotiate_key=true on
+/api/device/session/request or /api/device/session/establish) receives a
+random AES-256 key wrapped once with its own RSA public key (sensors with
+Ed25519 signing keys keep the hybrid envelope). Later readings
+are sent as {session_token, nonce, ciphertext, tag, sensor_id, signature,
+sha256} and decrypted with AES-GCM only.
+
+Keys live for DEVICE_SESSION_TTL_SECONDS from issue (they are not extended
+by use like the session itself); after that the server answers 401 and the
+device negotiates a new session. Keys are stored Fernet-encrypted in
+device_sessions so every worker process can resolve them, and kept in a
+bounded in-process LRU so steady-state lookups do not touch the database.
+"""
+
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+
+
+SESSION_KEY_ALG = 'AES-256-GCM'
+SESSION_KEY_BYTES = 32
+SESSION_KEY_CACHE_SIZE = int(os.environ.get('SESSION_KEY_CACHE_SIZE', '4096'))
+
+
+class SessionKeyStore:
+    """Thread-safe LRU of negotiated session keys backed by device_sessions."""
+
+    def __init__(self, max_size: int = SESSION_KEY_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._max_size = max(1, int(max_size))
+        self._keys = OrderedDict()  # session_token -> (device_id, key bytes, monotonic deadline)
+        self.issued = 0
+        self.hits = 0
+        self.loads = 0
+        self.expired = 0
+        self.unknown = 0
+
+    def issue(self, session_token: str, device_id: str, public_key, ttl_seconds: int) -> Optional[str]:
+        """Create, persist and wrap a key for a freshly created session.
+
+        Args:
+            session_token: Session the key is bound to
+            device_id: Device that owns the session
+            public_key: Device RSA public key (the key is wrapped with OAEP)
+            ttl_seconds: Key lifetime in seconds
+
+        Returns:
+            Base64 RSA-OAEP wrapped key for the device, or None if it could not be stored
+        """
+        from db import set_device_session_key
+        from db_encryption import get_db_encryption
+
+        key = get_random_bytes(SESSION_KEY_BYTES)
+        stored = get_db_encryption().encrypt_text(base64.b64encode(key).decode())
+        if not set_device_session_key(session_token, stored, ttl_seconds):
+            return None
+        wrapped = PKCS1_OAEP.new(public_key).encrypt(key)
+        self._put(session_token, device_id, key, ttl_seconds)
+        with self._lock:
+            self.issued += 1
+        return base64.b64encode(wrapped).decode()
+
+    def get(self, session_token: str):
+        """Resolve the key for a session token.
+
+        Returns:
+            ((device_id, key bytes), None) on success, or (None, reason) where
+            reason is 'unknown_session_key' or 'session_key_expired'
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(session_token)
+            if entry is not None:
+                if entry[2] > now:
+                    self._keys.move_to_end(session_token)
+                    self.hits += 1
+                    return (entry[0], entry[1]), None
+                del self._keys[session_token]
+                self.expired += 1
+                return None, 'session_key_expired'
+
+        from db import get_device_session_key
+        from db_encryption import get_db_encryption
+
+        row = get_device_session_key(session_token)
+        with self._lock:
+            self.loads += 1
+        if not row:
+            with self._lock:
+                self.unknown += 1
+            return None, 'unknown_session_key'
+        ttl = row.get('key_ttl_seconds')
+        if ttl is None or int(ttl) <= 0:
+            with self._lock:
+                self.expired += 1
+            return None, 'session_key_expired'
+        key_b64 = get_db_encryption().decrypt_text(row.get('session_key'))
+        if not key_b64:
+            with self._lock:
+                self.unknown += 1
+            return None, 'unknown_session_key'
+        key = base64.b64decode(key_b64)
+        self._put(session_token, row.get('device_id'), key, int(ttl))
+        return (row.get('device_id'), key), None
+
+    def _put(self, session_token: str, device_id: str, key: bytes, ttl_seconds: int):
+        with self._lock:
+            self._keys[session_token] = (device_id, key, time.monotonic() + int(ttl_seconds))
+            self._keys.move_to_end(session_token)
+            while len(self._keys) > self._max_size:
+                self._keys.popitem(last=False)
+
+    def forget(self, session_token: str):
+        """Drop a cached key (e.g. when its session is deleted)."""
+        with self._lock:
+            self._keys.pop(session_token, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self._max_size,
+                'issued': self.issued,
+                'hits': self.hits,
+                'loads': self.loads,
+                'expired': self.expired,
+                'unknown': self.unknown,
+            }
+
+
+# Global instance for use across the application
+_session_key_store: Optional[SessionKeyStore] = None
+_session_key_store_lock = threading.Lock()
+
+
+def get_session_key_store() -> SessionKeyStore:
+    """
+    Get or create the global session key store.
+
+    Returns:
+        SessionKeyStore: Singleton instance
+    """
+    global _session_key_store
+    if _session_key_store is None:
+        with _session_key_store_lock:
+            if _session_key_store is None:
+                _session_key_store = SessionKeyStore()
+    return _session_key_store
+
+
+def forget_session_key(session_token: str):
+    """Drop a cached key from the global store (no-op before first use)."""
+    if _session_key_store is not None:
+        _session_key_store.forget(session_token)
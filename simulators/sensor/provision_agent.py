@@ -7,7 +7,6 @@ import re
 import stat
 import paho.mqtt.client as mqtt
 from typing import Optional
-from Crypto.PublicKey import RSA
 
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
@@ -15,7 +14,12 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 # Import encryption utilities for E2EE
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
-from encryption_utils import decrypt_data
+from encryption_utils import decrypt_data, export_key_pair, generate_device_key
+
+# Key type for newly generated sensor keys: 'rsa' (default) or 'ed25519'.
+# Ed25519 keys sign readings much faster on low-end ARM but cannot decrypt,
+# so provisioning messages to such devices are sent without E2EE.
+SENSOR_KEY_ALGORITHM = (os.environ.get('SENSOR_KEY_ALGORITHM', 'rsa') or 'rsa').strip().lower()
 
 # --- REPLAY ATTACK PROTECTION ---
 # Store recent nonces and timestamps for each device_id (in-memory, resets on restart)
@@ -62,13 +66,15 @@ def _delete_sensor_directory(sensor_dir: str, device_id: str, user_id: Optional[
     return False
 
 
-def ensure_keys(device_id: str, user_id: Optional[str] = None, force_regenerate: bool = False) -> str:
+def ensure_keys(device_id: str, user_id: Optional[str] = None, force_regenerate: bool = False,
+                algorithm: Optional[str] = None) -> str:
     """Generate or retrieve sensor keys, optionally organized by user folder.
     
     Args:
         device_id: Device/sensor ID
         user_id: Optional user ID to organize keys in user-specific folder
         force_regenerate: If True, delete existing keys and generate new ones
+        algorithm: 'rsa' or 'ed25519' for new keys (default: SENSOR_KEY_ALGORITHM)
     
     Returns:
         Path to public key file
@@ -97,11 +103,12 @@ def ensure_keys(device_id: str, user_id: Optional[str] = None, force_regenerate:
             print(f"⚠️  Could not delete keys: {e}")
     
     if not (os.path.exists(priv) and os.path.exists(pub)):
-        key = RSA.generate(2048)
+        key = generate_device_key(algorithm or SENSOR_KEY_ALGORITHM)
+        private_pem, public_pem = export_key_pair(key)
         with open(priv, 'wb') as f:
-            f.write(key.export_key())
+            f.write(private_pem)
         with open(pub, 'wb') as f:
-            f.write(key.publickey().export_key())
+            f.write(public_pem)
         
         # Automatically set secure file permissions
         # Private key: 600 (read/write owner only)
@@ -2,24 +2,34 @@ import os
 import sys
 import stat
 from typing import Tuple, Optional
-from Crypto.PublicKey import RSA
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 SENSOR_KEYS_DIR = os.path.join(PROJECT_ROOT, "sensor_keys")
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
 
+from encryption_utils import KEY_ALGORITHMS, export_key_pair, generate_device_key  # noqa: E402
 
-def generate_sensor_keys(sensor_id: str, user_id: Optional[str] = None) -> Tuple[str, str]:
+# 'rsa' (RSA-2048, default) or 'ed25519' (much faster signing on low-end ARM;
+# signing only, so no E2EE provisioning messages or negotiated session keys)
+SENSOR_KEY_ALGORITHM = (os.environ.get('SENSOR_KEY_ALGORITHM', 'rsa') or 'rsa').strip().lower()
+
+
+def generate_sensor_keys(sensor_id: str, user_id: Optional[str] = None,
+                         algorithm: Optional[str] = None) -> Tuple[str, str]:
     """Generate sensor keys, optionally organized by user folder.
     
     Args:
         sensor_id: Device/sensor ID
         user_id: Optional user ID to organize keys in user-specific folder
+        algorithm: 'rsa' or 'ed25519' (default: SENSOR_KEY_ALGORITHM)
     
     Returns:
         Tuple of (private_key_path, public_key_path)
     """
     os.makedirs(SENSOR_KEYS_DIR, exist_ok=True)
-    key = RSA.generate(2048)
+    key = generate_device_key(algorithm or SENSOR_KEY_ALGORITHM)
+    private_pem, public_pem = export_key_pair(key)
 
     # Create folder structure: sensor_keys/{user_id}/{sensor_id}/ or sensor_keys/{sensor_id}/
     if user_id:
@@ -35,10 +45,10 @@ def generate_sensor_keys(sensor_id: str, user_id: Optional[str] = None) -> Tuple
     public_path = os.path.join(sensor_dir, "sensor_public.pem")
 
     with open(private_path, "wb") as f:
-        f.write(key.export_key())
+        f.write(private_pem)
 
     with open(public_path, "wb") as f:
-        f.write(key.publickey().export_key())
+        f.write(public_pem)
 
     # Automatically set secure file permissions
     # Private key: 600 (read/write owner only)
@@ -58,15 +68,22 @@ def generate_sensor_keys(sensor_id: str, user_id: Optional[str] = None) -> Tuple
 
 
 if __name__ == "__main__":
-    # CLI: python simulators/sensor/sensor_keygen.py SENSOR_ID [USER_ID]
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print("Usage: python simulators/sensor/sensor_keygen.py <sensor_id> [user_id]")
+    # CLI: python simulators/sensor/sensor_keygen.py SENSOR_ID [USER_ID] [--algorithm rsa|ed25519]
+    args = sys.argv[1:]
+    algorithm = None
+    if '--algorithm' in args:
+        idx = args.index('--algorithm')
+        algorithm = args[idx + 1].lower() if idx + 1 < len(args) else ''
+        del args[idx:idx + 2]
+    if len(args) < 1 or len(args) > 2 or (algorithm is not None and algorithm not in KEY_ALGORITHMS):
+        print("Usage: python simulators/sensor/sensor_keygen.py <sensor_id> [user_id] [--algorithm rsa|ed25519]")
         print("  sensor_id: Device/sensor ID (required)")
         print("  user_id: User ID for organizing keys in user folder (optional)")
+        print("  --algorithm: Key type (default: SENSOR_KEY_ALGORITHM env var, or rsa)")
         sys.exit(1)
     
-    sensor_id = sys.argv[1]
-    user_id = sys.argv[2] if len(sys.argv) == 3 else None
-    generate_sensor_keys(sensor_id, user_id)
+    sensor_id = args[0]
+    user_id = args[1] if len(args) == 2 else None
+    generate_sensor_keys(sensor_id, user_id, algorithm)
 
 
@@ -7,7 +7,6 @@ import hashlib
 import time
 import argparse
 import requests
-import paho.mqtt.publish as publish
 import paho.mqtt.client as mqtt
 import urllib3
 import re
@@ -21,11 +20,12 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from encryption_utils import encrypt_data, aes_encrypt, hash_data  # noqa: E402
-from Crypto.Signature import pkcs1_15  # noqa: E402
-from Crypto.Hash import SHA256  # noqa: E402
+from encryption_utils import encrypt_data, encrypt_session_data, aes_encrypt, hash_data, import_key, sign_message  # noqa: E402
+from Crypto.Cipher import PKCS1_OAEP  # noqa: E402
 from Crypto.PublicKey import RSA  # noqa: E402
 from db import list_sensors, list_sensor_types  # noqa: E402
+from mqtt_envelope import pack_reading  # noqa: E402
+from utils.mqtt_utils import MqttPublisherPool  # noqa: E402
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -33,6 +33,10 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # 16-byte AES key for MQTT payload simulation
 AES_KEY = b'my16bytepassword'
 
+# secure/sensor payload format: 'binary' (version 2 AES-GCM frame, see
+# mqtt_envelope.py) or 'json' (legacy AES-CBC envelope for old firmware)
+MQTT_PAYLOAD_FORMAT = os.environ.get("MQTT_PAYLOAD_FORMAT", "binary").strip().lower()
+
 
 def _build_type_defaults_map() -> dict:
     """Return {'ph': {'min': x, 'max': y}, ...} from sensor_type table.
@@ -296,22 +300,57 @@ def generate_safe_payload_all_metrics(prefer_type: Optional[str] = None) -> dict
     return payload
 
 
+# Connected publisher pools, one per broker configuration (reused across readings)
+_publishers = {}
+
+# Last reading sequence number per device (see ingest_dedup on the server)
+_last_seq = {}
+
+
+def _next_seq(device_id: str) -> int:
+    """Per-device reading sequence: millisecond timestamp, strictly increasing.
+
+    Retries and MQTT redeliveries repeat the same seq, so the server stores the
+    reading once; timestamps keep seq unique across simulator restarts.
+    """
+    seq = max(int(time.time() * 1000), _last_seq.get(device_id, 0) + 1)
+    _last_seq[device_id] = seq
+    return seq
+
+
+def _get_publisher(publish_kwargs: dict) -> MqttPublisherPool:
+    key = json.dumps(publish_kwargs, sort_keys=True, default=str)
+    publisher = _publishers.get(key)
+    if publisher is None:
+        publisher = _publishers.setdefault(key, MqttPublisherPool(publish_kwargs))
+    return publisher
+
+
 def publish_mqtt_payload(data: dict, mqtt_host: str = "localhost", mqtt_port: int = 1883, 
                          mqtt_user: Optional[str] = None, mqtt_password: Optional[str] = None,
                          mqtt_use_tls: bool = False, mqtt_ca_certs: Optional[str] = None,
                          mqtt_tls_insecure: bool = False) -> None:
     """Publish sensor data to MQTT topic 'secure/sensor'."""
-    data_json = json.dumps(data, sort_keys=True).encode()
-    sha256_hash = hashlib.sha256(data_json).hexdigest()
-
-    hashed = hash_data(data)
-    encrypted = aes_encrypt(data, AES_KEY)
-
-    payload = {
-        "data": encrypted,
-        "hash": hashed,
-        "sha256": sha256_hash,
-    }
+    if MQTT_PAYLOAD_FORMAT == "json":
+        data_json = json.dumps(data, sort_keys=True).encode()
+        sha256_hash = hashlib.sha256(data_json).hexdigest()
+
+        hashed = hash_data(data)
+        encrypted = aes_encrypt(data, AES_KEY)
+
+        payload = {
+            "data": encrypted,
+            "hash": hashed,
+            "sha256": sha256_hash,
+        }
+        # Plaintext copies let the server acknowledge a redelivery without decrypting
+        if data.get("seq") is not None:
+            payload["device_id"] = data.get("device_id")
+            payload["seq"] = data["seq"]
+        payload = json.dumps(payload)
+    else:
+        # device_id and seq travel in the authenticated plaintext header
+        payload = pack_reading(data, AES_KEY)
 
     # Build publish kwargs
     publish_kwargs = {
@@ -331,7 +370,7 @@ def publish_mqtt_payload(data: dict, mqtt_host: str = "localhost", mqtt_port: in
         if tls_config:
             publish_kwargs["tls"] = tls_config
 
-    publish.single("secure/sensor", json.dumps(payload), **publish_kwargs)
+    _get_publisher(publish_kwargs).publish("secure/sensor", payload, qos=0)
     
     # Compact output: [timestamp] device_id | metric=value
     device_id = data.get('device_id', 'unknown')
@@ -384,16 +423,40 @@ def find_private_key(sensor_id: str, user_id: Optional[int] = None) -> Optional[
 def sign_payload(sensor_id: str, private_key_path: Optional[str], payload_bytes: bytes) -> Optional[str]:
     if not private_key_path or not os.path.exists(private_key_path):
         return None
-    private_key = RSA.import_key(open(private_key_path, "rb").read())
-    h = SHA256.new(payload_bytes)
-    signature = pkcs1_15.new(private_key).sign(h)
+    # RSA (PKCS#1 v1.5) or Ed25519, following the key type in the PEM
+    private_key = import_key(open(private_key_path, "rb").read())
+    signature = sign_message(private_key, payload_bytes)
     return base64.b64encode(signature).decode()
 
 
-def post_to_server(data: dict, sensor_id: str, server_url: str, user_id: Optional[int] = None) -> None:
-    # Hybrid RSA+AES envelope using server's public key
-    public_key_path = os.path.join(PROJECT_ROOT, "keys", "public.pem")
-    encrypted = encrypt_data(data, public_key_path)
+def unwrap_session_key(private_key_path: Optional[str], wrapped_b64: str) -> Optional[bytes]:
+    # Session key negotiated at session creation, RSA-OAEP wrapped with our public key
+    if not private_key_path or not os.path.exists(private_key_path):
+        return None
+    try:
+        private_key = RSA.import_key(open(private_key_path, "rb").read())
+        return PKCS1_OAEP.new(private_key).decrypt(base64.b64decode(wrapped_b64))
+    except Exception:
+        return None
+
+
+def post_to_server(data: dict, sensor_id: str, server_url: str, user_id: Optional[int] = None,
+                   use_session_key: bool = True) -> None:
+    # Prefer the symmetric session-key envelope (no RSA per reading); fall back
+    # to the hybrid RSA+AES envelope using server's public key
+    data = dict(data)
+    data.setdefault('seq', _next_seq(sensor_id))
+    session = _get_device_session(sensor_id, server_url, user_id=user_id, negotiate_key=True) if use_session_key else None
+    if session and session.get('key') and datetime.now() < session.get('key_expires_at', datetime.min):
+        if 'session_token' not in data:
+            session['counter'] += 1
+            data['session_token'] = session['token']
+            data['counter'] = session['counter']
+        encrypted = encrypt_session_data(data, session['key'], session['token'])
+    else:
+        session = None
+        public_key_path = os.path.join(PROJECT_ROOT, "keys", "public.pem")
+        encrypted = encrypt_data(data, public_key_path)
 
     # encryption_utils already returns base64 strings, but keep guard for bytes
     encrypted_b64 = {
@@ -419,14 +482,17 @@ def post_to_server(data: dict, sensor_id: str, server_url: str, user_id: Optiona
         return
     encrypted_b64["sensor_id"] = sensor_id
     encrypted_b64["signature"] = signature_b64
+    encrypted_b64["seq"] = data["seq"]
 
     endpoint = f"{(server_url or '').rstrip('/')}/submit-data"
     response = requests.post(
         endpoint,
         json=encrypted_b64,
     )
+    if session and response.status_code == 401:
+        # Key or session expired: negotiate a new one on the next reading
+        _sensor_sessions.pop(sensor_id, None)
     # Show sensor value in server response with timestamp
-    from datetime import datetime
     timestamp = datetime.now().strftime("%H:%M:%S")
     metric_keys = ['ph', 'tds', 'turbidity', 'temperature', 'dissolved_oxygen', 'conductivity', 'ammonia', 'pressure', 'nitrate', 'nitrite', 'orp', 'chlorine', 'salinity', 'flow']
     reading_value = next((f"{k}={v}" for k, v in data.items() if k in metric_keys), None)
@@ -492,21 +558,29 @@ def pick_active_sensor():
 # Per-sensor session token cache
 _sensor_sessions = {}  # device_id -> {'token': str, 'counter': int, 'expires_at': datetime}
 
-def _get_device_session(device_id: str, server_url: str) -> Optional[dict]:
-    """Get or refresh device session token for a sensor."""
+def _get_device_session(device_id: str, server_url: str, user_id: Optional[int] = None,
+                        negotiate_key: bool = False) -> Optional[dict]:
+    """Get or refresh device session token for a sensor.
+
+    With negotiate_key=True the session also carries an AES-GCM key ('key',
+    'key_expires_at') for the symmetric /submit-data envelope.
+    """
     global _sensor_sessions
     
     # Check if we have a valid cached session
     if device_id in _sensor_sessions:
         session = _sensor_sessions[device_id]
         expires_at = session.get('expires_at')
-        if expires_at and datetime.now() < expires_at:
+        key_ok = not negotiate_key or (session.get('key') and datetime.now() < session.get('key_expires_at', datetime.min))
+        if expires_at and datetime.now() < expires_at and key_ok:
             return session
     
     # Request new session from server (use skip_challenge=true for simulators)
     try:
         endpoint = f"{(server_url or '').rstrip('/')}/api/device/session/request"
         params = {'device_id': device_id, 'skip_challenge': 'true'}
+        if negotiate_key:
+            params['negotiate_key'] = 'true'
         response = requests.get(endpoint, params=params, timeout=5)
         if response.status_code == 200:
             session_data = response.json()
@@ -519,6 +593,14 @@ def _get_device_session(device_id: str, server_url: str) -> Optional[dict]:
                     'counter': 0,
                     'expires_at': expires_at
                 }
+                wrapped_key = session_data.get('session_key')
+                if wrapped_key:
+                    key = unwrap_session_key(find_private_key(device_id, user_id), wrapped_key)
+                    if key:
+                        # Renew a little early so readings never race the server-side expiry
+                        key_ttl = session_data.get('session_key_expires_in_seconds', expires_in)
+                        session['key'] = key
+                        session['key_expires_at'] = datetime.now() + timedelta(seconds=max(0, key_ttl - 5))
                 _sensor_sessions[device_id] = session
                 return session
     except Exception:
@@ -544,6 +626,7 @@ def simulate_one(sensor: dict, generator_func, server_url: str, mqtt_host: str,
         "device_id": sensor_id,
         "device_type": device_type,
         "location": sensor.get("location"),
+        "seq": _next_seq(sensor_id),
     })
     
     # Get device session token if available
@@ -731,6 +814,7 @@ def run_reading_request_listener(mqtt_host: str = "localhost", mqtt_port: int =
 
 
 def main() -> None:
+    global MQTT_PAYLOAD_FORMAT
     parser = argparse.ArgumentParser(description="Multi-sensor simulator for water monitoring")
     parser.add_argument("--all", action="store_true", help="Simulate all active sensors")
     parser.add_argument("--ids", type=str, default="", help="Comma-separated device_ids to simulate (must be active)")
@@ -746,8 +830,10 @@ def main() -> None:
     parser.add_argument("--mqtt-use-tls", action="store_true", default=os.environ.get("MQTT_USE_TLS", "false").lower() in ("true", "1", "yes"), help="Enable TLS/SSL for MQTT")
     parser.add_argument("--mqtt-ca-certs", type=str, default=os.environ.get("MQTT_CA_CERTS"), help="Path to CA certificate file for TLS")
     parser.add_argument("--mqtt-tls-insecure", action="store_true", default=os.environ.get("MQTT_TLS_INSECURE", "false").lower() in ("true", "1", "yes"), help="Disable certificate verification (insecure)")
+    parser.add_argument("--mqtt-format", type=str, choices=["binary", "json"], default=MQTT_PAYLOAD_FORMAT, help="secure/sensor payload format: binary (AES-GCM frame) or json (legacy envelope)")
     parser.add_argument("--listen", action="store_true", help="Run in listener mode: subscribe to reading requests and respond automatically")
     args = parser.parse_args()
+    MQTT_PAYLOAD_FORMAT = args.mqtt_format
     
     # If --listen flag is set, run in listener mode
     if args.listen:
@@ -0,0 +1,155 @@
+"""
+Effective-threshold table for safety evaluation.
+
+Safety checks need, for every metric in a user's snapshot, the thresholds of
+the sensor that produced it: the sensor's min/max override, falling back to
+its sensor_type default. Resolving that with list_sensor_types() and
+get_sensor_by_device_id() on each call costs ~2 queries per metric per
+reading, so this module keeps:
+
+- the sensor_type defaults map, reloaded when sensor types change (or every
+  THRESHOLD_DEFAULTS_TTL_SECONDS to pick up edits made elsewhere)
+- a per-device_id table of effective thresholds built from the sensor
+  registry, rebuilt when the sensor's row or the defaults change
+
+Callers must treat returned dicts as read-only.
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+
+THRESHOLD_DEFAULTS_TTL_SECONDS = float(os.environ.get('THRESHOLD_DEFAULTS_TTL_SECONDS', '60'))
+
+
+class ThresholdCache:
+    """Thread-safe cache of type defaults and per-device effective thresholds."""
+
+    def __init__(self, defaults_ttl: float = THRESHOLD_DEFAULTS_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._defaults_ttl = defaults_ttl
+        self._defaults = None
+        self._defaults_loaded_at = 0.0
+        self._defaults_version = 0
+        self._by_device = {}  # normalized device_id -> (sensor row, defaults version, thresholds)
+        self.hits = 0
+        self.misses = 0
+
+    def type_defaults(self) -> dict:
+        """Return {'ph': {'min': x, 'max': y}, ...} from the sensor_type table."""
+        now = time.monotonic()
+        with self._lock:
+            if self._defaults is not None and now - self._defaults_loaded_at < self._defaults_ttl:
+                return self._defaults
+        from db import list_sensor_types
+        result = {}
+        try:
+            for t in list_sensor_types() or []:
+                type_name = (t.get('type_name') or '').lower()
+                result[type_name] = {
+                    'min': t.get('default_min'),
+                    'max': t.get('default_max'),
+                }
+        except Exception as e:
+            print(f"Threshold cache: could not load sensor types: {e}", file=sys.stderr)
+        with self._lock:
+            if result or self._defaults is None:
+                if result != self._defaults:
+                    self._defaults_version += 1
+                self._defaults = result
+            self._defaults_loaded_at = now
+            return self._defaults
+
+    def for_device(self, device_id: Optional[str]) -> dict:
+        """Resolve thresholds using sensor override if available, else type default.
+
+        Returns a mapping suitable for compute_safety. If the sensor is known and
+        has device_type 'ph', returns {'ph': {'min': ..., 'max': ...}}. If the
+        sensor is unknown, falls back to all type defaults.
+        """
+        type_defaults = self.type_defaults()
+        if not device_id:
+            return type_defaults
+        from sensor_registry import get_sensor_registry, normalize_device_id
+        rows = get_sensor_registry().get_sensors(device_id)
+        sensor = rows[0] if rows else None
+        if not sensor or not sensor.get('device_type'):
+            return type_defaults
+        key = normalize_device_id(device_id)
+        with self._lock:
+            cached = self._by_device.get(key)
+            if cached is not None and cached[0] is sensor and cached[1] == self._defaults_version:
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+            version = self._defaults_version
+        device_type_key = (sensor.get('device_type') or '').lower()
+        default_for_type = (type_defaults.get(device_type_key) or {})
+        min_eff = sensor.get('min_threshold')
+        max_eff = sensor.get('max_threshold')
+        if min_eff is None:
+            min_eff = default_for_type.get('min')
+        if max_eff is None:
+            max_eff = default_for_type.get('max')
+        thresholds = {device_type_key: {'min': min_eff, 'max': max_eff}}
+        with self._lock:
+            self._by_device[key] = (sensor, version, thresholds)
+        return thresholds
+
+    def invalidate_device(self, device_id: Optional[str] = None):
+        """Drop the entry for one device_id (or every device)."""
+        from sensor_registry import normalize_device_id
+        with self._lock:
+            if device_id is None:
+                self._by_device.clear()
+            else:
+                self._by_device.pop(normalize_device_id(device_id), None)
+
+    def invalidate_types(self):
+        """Reload sensor_type defaults (and every derived entry) on next use."""
+        with self._lock:
+            self._defaults = None
+            self._defaults_version += 1
+            self._by_device.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'devices': len(self._by_device),
+                'types': len(self._defaults or {}),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Global instance for use across the application
+_threshold_cache: Optional[ThresholdCache] = None
+_threshold_cache_lock = threading.Lock()
+
+
+def get_threshold_cache() -> ThresholdCache:
+    """
+    Get or create the global threshold cache.
+
+    Returns:
+        ThresholdCache: Singleton instance
+    """
+    global _threshold_cache
+    if _threshold_cache is None:
+        with _threshold_cache_lock:
+            if _threshold_cache is None:
+                _threshold_cache = ThresholdCache()
+    return _threshold_cache
+
+
+def invalidate_thresholds(device_id: Optional[str] = None, types: bool = False):
+    """Invalidate the global cache (no-op before first use)."""
+    if _threshold_cache is None:
+        return
+    if types:
+        _threshold_cache.invalidate_types()
+    else:
+        _threshold_cache.invalidate_device(device_id)
@@ -1,12 +1,20 @@
-"""MQTT utilities for key and sensor data subscribers."""
+"""MQTT utilities for key and sensor data subscribers and the shared publisher pool."""
+import atexit
 import os
 import sys
 import json
 import re
 import threading
 import time
+import socket
 import ssl
+import tempfile
 from datetime import datetime, timezone
+from typing import Optional
+
+from app_logging import get_logger
+
+mqtt_log = get_logger('mqtt')
 
 
 def _get_mqtt_publish_kwargs():
@@ -66,6 +74,289 @@ def _get_mqtt_publish_kwargs():
     
     return kwargs
 
+# Shared subscriptions (MQTT v5): with MQTT_SHARED_GROUP set, every server
+# process (gunicorn/mod_wsgi workers and other nodes) subscribes to
+# $share/<group>/<topic> and the broker delivers each message to exactly one
+# member of the group. Each process gets a stable client_id
+# (<MQTT_CLIENT_ID_PREFIX>-<role>-<slot>) and a persistent session, so a
+# restarted worker reclaims the QoS 1 messages that were in flight to it.
+MQTT_SHARED_GROUP = (os.environ.get('MQTT_SHARED_GROUP') or '').strip()
+MQTT_CLIENT_ID_PREFIX = (os.environ.get('MQTT_CLIENT_ID_PREFIX') or f"iot-water-{socket.gethostname()}").strip()
+MQTT_SESSION_EXPIRY_SECONDS = int(os.environ.get('MQTT_SESSION_EXPIRY_SECONDS', '3600'))
+
+_worker_slot = None  # (pid, slot, open lock file)
+_worker_slot_lock = threading.Lock()
+
+
+def mqtt_worker_slot() -> str:
+    """Stable per-process slot used in MQTT client ids.
+
+    MQTT_WORKER_ID wins if set. Otherwise the process claims the lowest free
+    slot with an exclusive lock file, so a restarted gunicorn worker gets the
+    slot (and broker session) of the worker it replaces. Falls back to the
+    pid where file locks are unavailable.
+    """
+    global _worker_slot
+    explicit = (os.environ.get('MQTT_WORKER_ID') or '').strip()
+    if explicit:
+        return explicit
+    with _worker_slot_lock:
+        if _worker_slot is not None and _worker_slot[0] == os.getpid():
+            return _worker_slot[1]
+        try:
+            import fcntl
+        except ImportError:
+            return str(os.getpid())
+        lock_dir = os.environ.get('MQTT_WORKER_LOCK_DIR') or tempfile.gettempdir()
+        safe_prefix = re.sub(r'[^A-Za-z0-9_.-]', '_', MQTT_CLIENT_ID_PREFIX)
+        for slot in range(1024):
+            try:
+                lock_file = open(os.path.join(lock_dir, f"{safe_prefix}-mqtt-slot-{slot}.lock"), 'a')
+            except OSError:
+                break
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            # The lock is held (file kept open) for the life of the process
+            _worker_slot = (os.getpid(), str(slot), lock_file)
+            return _worker_slot[1]
+        return str(os.getpid())
+
+
+def mqtt_subscription_topic(topic: str) -> str:
+    """Topic filter to subscribe to ($share/<group>/<topic> when a group is configured)."""
+    if MQTT_SHARED_GROUP:
+        return f"$share/{MQTT_SHARED_GROUP}/{topic}"
+    return topic
+
+
+def _create_subscriber_client(mqtt, role: str, manual_ack: bool = False, receive_maximum: Optional[int] = None,
+                              shared: bool = True):
+    """Build a subscriber client.
+
+    Shared groups (shared=True and MQTT_SHARED_GROUP set) use MQTT v5 with a
+    stable client_id. receive_maximum also switches to MQTT v5 and caps the
+    unacknowledged QoS 1 messages the broker sends (flow control).
+
+    Returns:
+        Tuple of (client, extra connect_async kwargs)
+    """
+    shared = shared and bool(MQTT_SHARED_GROUP)
+    if not shared and not receive_maximum:
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, manual_ack=manual_ack), {}
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.properties import Properties
+
+    properties = Properties(PacketTypes.CONNECT)
+    connect_kwargs = {'properties': properties}
+    if receive_maximum:
+        properties.ReceiveMaximum = int(receive_maximum)
+    if not shared:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5, manual_ack=manual_ack)
+        return client, connect_kwargs
+
+    client_id = f"{MQTT_CLIENT_ID_PREFIX}-{role}-{mqtt_worker_slot()}"
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                         protocol=mqtt.MQTTv5, manual_ack=manual_ack)
+    properties.SessionExpiryInterval = MQTT_SESSION_EXPIRY_SECONDS
+    connect_kwargs['clean_start'] = False
+    print(f"MQTT: {role} subscriber joins shared group '{MQTT_SHARED_GROUP}' as client_id '{client_id}'", file=sys.stderr)
+    return client, connect_kwargs
+
+
+# Persistent publishers: publish.single() opened a TCP+TLS connection,
+# authenticated and disconnected for every message (once per sensor in
+# /api/reading_request). MqttPublisherPool keeps MQTT_PUBLISHER_POOL_SIZE
+# connected clients per process; paho reconnects them in the background and
+# batches are pipelined (every QoS 1 publish is sent before waiting for the
+# PUBACKs).
+MQTT_PUBLISHER_POOL_SIZE = int(os.environ.get('MQTT_PUBLISHER_POOL_SIZE', '2'))
+MQTT_PUBLISH_TIMEOUT_SECONDS = float(os.environ.get('MQTT_PUBLISH_TIMEOUT_SECONDS', '10'))
+MQTT_PUBLISH_MAX_INFLIGHT = int(os.environ.get('MQTT_PUBLISH_MAX_INFLIGHT', '100'))
+
+
+class _PooledPublisher:
+    """One long-lived client of the pool; paho runs its network loop on a thread."""
+
+    def __init__(self, publish_kwargs: dict, client_id: str):
+        import paho.mqtt.client as mqtt
+
+        self.hostname = publish_kwargs.get('hostname') or 'localhost'
+        self.port = int(publish_kwargs.get('port') or 1883)
+        self.keepalive = int(publish_kwargs.get('keepalive') or 60)
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        auth = publish_kwargs.get('auth')
+        if auth and auth.get('username'):
+            self.client.username_pw_set(auth.get('username'), auth.get('password'))
+        tls = publish_kwargs.get('tls')
+        if tls:
+            tls = dict(tls)
+            insecure = tls.pop('insecure', False)
+            self.client.tls_set(**tls)
+            if insecure:
+                self.client.tls_insecure_set(True)
+        self.client.max_inflight_messages_set(MQTT_PUBLISH_MAX_INFLIGHT)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.connected = threading.Event()
+        self.connects = 0
+        self.last_error = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            self.connects += 1
+            self.last_error = None
+            self.connected.set()
+        else:
+            self.last_error = str(reason_code)
+            self.connected.clear()
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        self.connected.clear()
+        if reason_code != 0:
+            self.last_error = str(reason_code)
+
+    def ensure_connected(self, timeout: float):
+        with self._lock:
+            if not self._started:
+                self.client.connect_async(self.hostname, self.port, keepalive=self.keepalive)
+                self.client.loop_start()
+                self._started = True
+        if not self.connected.wait(timeout):
+            detail = f": {self.last_error}" if self.last_error else ""
+            raise ConnectionError(f"MQTT publisher not connected to {self.hostname}:{self.port}{detail}")
+
+    def close(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        try:
+            self.client.disconnect()
+            self.client.loop_stop()
+        except Exception:
+            pass
+        self.connected.clear()
+
+
+class MqttPublisherPool:
+    """Thread-safe pool of connected MQTT clients used instead of publish.single()."""
+
+    def __init__(self, publish_kwargs: Optional[dict] = None, size: int = MQTT_PUBLISHER_POOL_SIZE,
+                 timeout: float = MQTT_PUBLISH_TIMEOUT_SECONDS):
+        self._publish_kwargs = publish_kwargs
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self._publishers = []
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stats = {'published': 0, 'failed': 0, 'batches': 0}
+
+    def _publisher(self) -> _PooledPublisher:
+        with self._lock:
+            if not self._publishers:
+                kwargs = self._publish_kwargs if self._publish_kwargs is not None else _get_mqtt_publish_kwargs()
+                base_id = kwargs.get('client_id') or f"{MQTT_CLIENT_ID_PREFIX}-pub-{os.getpid()}"
+                self._publishers = [_PooledPublisher(kwargs, f"{base_id}-{i}") for i in range(self.size)]
+                atexit.register(self.close)
+            publisher = self._publishers[self._next % len(self._publishers)]
+            self._next += 1
+            return publisher
+
+    def publish(self, topic: str, payload, qos: int = 1, retain: bool = False):
+        """Publish one message and wait until the broker has it (PUBACK for QoS 1).
+
+        Raises:
+            ConnectionError: No connection to the broker within the timeout
+            RuntimeError: The message was not published
+        """
+        error = self.publish_many([(topic, payload)], qos=qos, retain=retain)[0]
+        if error:
+            raise RuntimeError(f"MQTT publish to '{topic}' failed: {error}")
+
+    def publish_many(self, messages: list, qos: int = 1, retain: bool = False) -> list:
+        """Pipeline several (topic, payload) messages on one pooled connection.
+
+        Returns:
+            List with None (published) or an error string for each message, in order
+
+        Raises:
+            ConnectionError: No connection to the broker within the timeout
+        """
+        if not messages:
+            return []
+        publisher = self._publisher()
+        try:
+            publisher.ensure_connected(self.timeout)
+        except ConnectionError:
+            self._count(failed=len(messages), batches=1)
+            raise
+        pending = []
+        for topic, payload in messages:
+            try:
+                pending.append(publisher.client.publish(topic, payload, qos=qos, retain=retain))
+            except Exception as e:
+                pending.append(e)
+        deadline = time.monotonic() + self.timeout
+        errors = []
+        for info in pending:
+            if isinstance(info, Exception):
+                errors.append(str(info))
+                continue
+            try:
+                info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+            except (RuntimeError, ValueError) as e:
+                errors.append(str(e))
+                continue
+            errors.append(None if info.is_published() else "timed out waiting for broker acknowledgement")
+        failed = sum(1 for error in errors if error)
+        self._count(published=len(errors) - failed, failed=failed, batches=1)
+        return errors
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+
+    def close(self):
+        with self._lock:
+            publishers, self._publishers = self._publishers, []
+        for publisher in publishers:
+            publisher.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            publishers = list(self._publishers)
+            stats = dict(self._stats)
+        return dict(stats, size=self.size, started=len(publishers),
+                    connected=sum(1 for p in publishers if p.connected.is_set()),
+                    connects=sum(p.connects for p in publishers))
+
+
+# Global instance for use across the application
+_mqtt_publisher: Optional[MqttPublisherPool] = None
+_mqtt_publisher_lock = threading.Lock()
+
+
+def get_mqtt_publisher() -> MqttPublisherPool:
+    """
+    Get or create the global MQTT publisher pool (configured from _get_mqtt_publish_kwargs).
+
+    Returns:
+        MqttPublisherPool: Singleton instance; clients connect on first publish
+    """
+    global _mqtt_publisher
+    if _mqtt_publisher is None:
+        with _mqtt_publisher_lock:
+            if _mqtt_publisher is None:
+                _mqtt_publisher = MqttPublisherPool()
+    return _mqtt_publisher
+
 
 def start_mqtt_key_subscriber(
     pending_keys,
@@ -101,10 +392,13 @@ def start_mqtt_key_subscriber(
     except Exception:
         print("MQTT: paho-mqtt not installed; skipping key subscriber.")
         return
+    from public_key_cache import invalidate_public_key
 
     mqtt_port = int(os.environ.get('MQTT_PORT', '1883'))
     mqtt_user = os.environ.get('MQTT_USER')
     mqtt_password = os.environ.get('MQTT_PASSWORD')
+    # Not a shared subscription: pending keys, the replay window and the
+    # public key cache are per process, so every worker needs every announcement
     mqtt_topic = os.environ.get('MQTT_KEYS_TOPIC', 'keys/+/public')
     
     # TLS/SSL configuration
@@ -213,6 +507,8 @@ def start_mqtt_key_subscriber(
                 return
             # Store as pending and update DB if sensor already exists
             pending_keys[device_id] = pem
+            # Key rotation: drop any parsed key / resolved PEM cached for this device
+            invalidate_public_key(user_id_from_msg, device_id)
             try:
                 # Use user_id if provided to get the correct sensor (important when multiple users have same device_id)
                 srow = get_sensor_by_device_id(device_id, user_id_from_msg)
@@ -277,7 +573,7 @@ def start_mqtt_key_subscriber(
         while retry_count < max_retries:
             try:
                 # Create MQTT client with API v2 (fixes deprecation warning)
-                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+                client, connect_kwargs = _create_subscriber_client(mqtt, 'keys', shared=False)
                 
                 # Configure authentication
                 if mqtt_user and mqtt_password:
@@ -335,7 +631,7 @@ def start_mqtt_key_subscriber(
                 
                 # Use async connection
                 try:
-                    client.connect_async(mqtt_host, mqtt_port, keepalive=60)
+                    client.connect_async(mqtt_host, mqtt_port, keepalive=60, **connect_kwargs)
                     client.loop_start()
                     
                     # Wait up to 5 seconds to see if connection succeeds
@@ -389,37 +685,12 @@ def start_mqtt_key_subscriber(
     mqtt_thread_started_ref[0] = True
 
 
-def start_mqtt_sensor_subscriber(
-    list_sensors,
-    insert_sensor_data,
-    _validate_device_session,
-    build_effective_thresholds_for_sensor,
-    _build_type_defaults_map,
-    compute_safety,
-    latest_by_metric,
-    latest_by_sensor,
-    user_latest_by_metric,
-    user_latest_by_sensor,
-    user_latest_data,
-    mqtt_sensor_thread_started_ref,
-    REQUIRE_DEVICE_SESSION=True
-):
+def start_mqtt_sensor_subscriber(ingest_pipeline, mqtt_sensor_thread_started_ref):
     """Start MQTT subscriber for secure/sensor topic to process sensor readings.
     
     Args:
-        list_sensors: Function to list sensors
-        insert_sensor_data: Function to insert sensor data
-        _validate_device_session: Function to validate device session
-        build_effective_thresholds_for_sensor: Function to build thresholds
-        _build_type_defaults_map: Function to get default thresholds
-        compute_safety: Function to compute safety status
-        latest_by_metric: Dict for latest metric values
-        latest_by_sensor: Dict for latest sensor values
-        user_latest_by_metric: Dict for user-specific latest metric values
-        user_latest_by_sensor: Dict for user-specific latest sensor values
-        user_latest_data: Dict for user-specific latest data
+        ingest_pipeline: IngestPipeline shared with the HTTP /submit-data route
         mqtt_sensor_thread_started_ref: List with single boolean to track if thread started
-        REQUIRE_DEVICE_SESSION: Whether device sessions are required
     """
     if mqtt_sensor_thread_started_ref[0]:
         return
@@ -428,16 +699,17 @@ def start_mqtt_sensor_subscriber(
         return
     try:
         import paho.mqtt.client as mqtt
-        from encryption_utils import aes_decrypt, hash_data
-        import hashlib
+        from mqtt_ingest import start_mqtt_ingest_dispatcher
     except Exception:
         print("MQTT: paho-mqtt not installed; skipping sensor subscriber.", file=sys.stderr)
         return
+    # Readings are processed on worker threads, not paho's network loop
+    dispatcher = start_mqtt_ingest_dispatcher(ingest_pipeline)
 
     mqtt_port = int(os.environ.get('MQTT_PORT', '1883'))
     mqtt_user = os.environ.get('MQTT_USER')
     mqtt_password = os.environ.get('MQTT_PASSWORD')
-    mqtt_topic = 'secure/sensor'
+    mqtt_topic = mqtt_subscription_topic('secure/sensor')
     
     # TLS/SSL configuration
     mqtt_use_tls = os.environ.get('MQTT_USE_TLS', 'false').lower() in ('true', '1', 'yes')
@@ -446,16 +718,16 @@ def start_mqtt_sensor_subscriber(
     mqtt_keyfile = os.environ.get('MQTT_KEYFILE')
     mqtt_tls_insecure = os.environ.get('MQTT_TLS_INSECURE', 'false').lower() in ('true', '1', 'yes')
     
-    # AES key for MQTT decryption (must match simulator)
-    AES_KEY = b'my16bytepassword'
-    
     mqtt_sensor_connected = False
+    # Bumped on every connect so acks for deliveries of a previous connection are skipped
+    connection_generation = 0
     
     def _on_connect(client, userdata, flags, reason_code, properties):
         """Callback when MQTT client connects (API v2)."""
-        nonlocal mqtt_sensor_connected
+        nonlocal mqtt_sensor_connected, connection_generation
         try:
             if reason_code == 0:
+                connection_generation += 1
                 result = client.subscribe(mqtt_topic, qos=1)
                 mqtt_sensor_connected = True
                 print(f"MQTT Sensor: connected rc={reason_code}; subscribed to '{mqtt_topic}' (result: {result})", file=sys.stderr)
@@ -475,238 +747,17 @@ def start_mqtt_sensor_subscriber(
             sys.stderr.flush()
 
     def _on_message(client, userdata, msg):
-        """Process sensor reading from MQTT."""
+        """Hand a sensor reading to the ingest workers; it is acked once processed."""
+        generation, mid, qos = connection_generation, msg.mid, msg.qos
+
+        def _ack():
+            if generation == connection_generation:
+                client.ack(mid, qos)
+
         try:
-            # Parse JSON payload
-            payload_str = msg.payload.decode('utf-8', errors='replace')
-            payload = json.loads(payload_str)
-            
-            # Extract encrypted data and hash
-            encrypted_data = payload.get('data')
-            received_hash = payload.get('hash')
-            sha256_hash = payload.get('sha256')
-            
-            if not encrypted_data:
-                print("MQTT Sensor: Missing 'data' field in payload", file=sys.stderr)
-                return
-            
-            # Decrypt using AES
-            # encrypted_data from payload should be a JSON string (from aes_encrypt)
-            # But json.loads might have already parsed it, so check
-            if isinstance(encrypted_data, dict):
-                # If it's already a dict, convert back to JSON string for aes_decrypt
-                encrypted_data_str = json.dumps(encrypted_data)
-            elif isinstance(encrypted_data, str):
-                encrypted_data_str = encrypted_data
-            else:
-                print(f"MQTT Sensor: Invalid encrypted_data type: {type(encrypted_data)}", file=sys.stderr)
-                return
-            
-            try:
-                # aes_decrypt expects a JSON string and returns a dict (it does json.loads internally)
-                decrypted_data = aes_decrypt(encrypted_data_str, AES_KEY)
-            except Exception as decrypt_err:
-                print(f"MQTT Sensor: Decryption error: {decrypt_err}", file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                return
-            
-            # Verify hash
-            if received_hash:
-                # hash_data expects a dict, not a JSON string
-                calculated_hash = hash_data(decrypted_data)
-                if calculated_hash != received_hash:
-                    print(f"MQTT Sensor: Hash mismatch - possible tampering", file=sys.stderr)
-                    return
-            
-            # Verify SHA256 if provided
-            if sha256_hash:
-                data_json = json.dumps(decrypted_data, sort_keys=True).encode()
-                computed_sha256 = hashlib.sha256(data_json).hexdigest()
-                if computed_sha256 != sha256_hash:
-                    print(f"MQTT Sensor: SHA256 hash mismatch", file=sys.stderr)
-                    return
-            
-            # Extract sensor info
-            device_id = decrypted_data.get('device_id')
-            if not device_id:
-                print("MQTT Sensor: Missing device_id in decrypted data", file=sys.stderr)
-                return
-            
-            # Process the sensor reading (reuse logic from submit_data)
-            # Note: MQTT format doesn't use RSA signatures, so we skip signature verification
-            # but still validate the sensor exists and is active
-            all_sensors = list_sensors()
-            matching_sensors = [s for s in all_sensors if s.get('device_id', '').lower() == device_id.lower() and s.get('status') == 'active']
-            
-            if not matching_sensors:
-                print(f"MQTT Sensor: Unregistered or inactive sensor '{device_id}'", file=sys.stderr)
-                return
-            
-            # Use first matching active sensor (in production, you might want more sophisticated matching)
-            sensor_row = matching_sensors[0]
-            sensor_user_id = sensor_row.get('user_id')
-            
-            # Device session validation - validate and update session every time before storing
-            session_token = decrypted_data.get('session_token')
-            session_counter = decrypted_data.get('counter')
-            
-            # Debug: Log session token presence
-            if session_token:
-                print(f"MQTT Sensor: Session token found for {device_id}, counter={session_counter}", file=sys.stderr)
-            else:
-                print(f"MQTT Sensor: No session token in payload for {device_id}", file=sys.stderr)
-            
-            if REQUIRE_DEVICE_SESSION:
-                # Sessions are required - reject if invalid
-                ok, reason = _validate_device_session(session_token, device_id, session_counter)
-                if not ok:
-                    print(f"MQTT Sensor: Device session error for {device_id}: {reason}", file=sys.stderr)
-                    return
-                else:
-                    print(f"MQTT Sensor: Session validated and updated for {device_id}, counter={session_counter}", file=sys.stderr)
-            elif session_token:
-                # Sessions are optional but provided - validate and update it
-                ok, reason = _validate_device_session(session_token, device_id, session_counter)
-                if not ok:
-                    # Log warning but don't reject (sessions optional)
-                    print(f"MQTT Sensor: Device session warning for {device_id}: {reason} (continuing anyway)", file=sys.stderr)
-                else:
-                    print(f"MQTT Sensor: Session validated and updated for {device_id}, counter={session_counter}", file=sys.stderr)
-            
-            # Initialize user-specific dictionaries if needed
-            if sensor_user_id:
-                if sensor_user_id not in user_latest_by_metric:
-                    user_latest_by_metric[sensor_user_id] = {}
-                if sensor_user_id not in user_latest_by_sensor:
-                    user_latest_by_sensor[sensor_user_id] = {}
-                if sensor_user_id not in user_latest_data:
-                    user_latest_data[sensor_user_id] = {}
-            
-            # Extract metric values
-            updated_values = {}
-            supported_metrics = [
-                "tds", "ph", "turbidity", "temperature", "dissolved_oxygen", "conductivity",
-                "ammonia", "pressure", "nitrate", "nitrite", "orp", "chlorine", "salinity", "flow"
-            ]
-            for k in supported_metrics:
-                if k in decrypted_data and decrypted_data[k] not in (None, ""):
-                    try:
-                        val = float(decrypted_data[k])
-                        updated_values[k] = val
-                        if sensor_user_id:
-                            user_latest_by_metric[sensor_user_id][k] = {
-                                "value": val,
-                                "sensor_id": device_id,
-                            }
-                        latest_by_metric[k] = {
-                            "value": val,
-                            "sensor_id": device_id,
-                        }
-                    except Exception:
-                        pass
-            
-            # Build aggregate values and thresholds
-            if sensor_user_id and sensor_user_id in user_latest_by_metric:
-                _lbm_snapshot = list(user_latest_by_metric[sensor_user_id].items())
-            else:
-                _lbm_snapshot = list(latest_by_metric.items())
-            agg_values = {k: v.get("value") for k, v in _lbm_snapshot if v and v.get("value") is not None}
-            
-            agg_thresholds = {}
-            for metric, entry in _lbm_snapshot:
-                sid = (entry or {}).get("sensor_id")
-                tmap = build_effective_thresholds_for_sensor(sid)
-                if tmap and metric in tmap:
-                    agg_thresholds[metric] = tmap[metric]
-            for metric in agg_values.keys():
-                if metric not in agg_thresholds:
-                    defaults = _build_type_defaults_map()
-                    if metric in defaults:
-                        agg_thresholds[metric] = defaults[metric]
-            
-            # Evaluate safety
-            safe, reasons = compute_safety(agg_values, agg_thresholds)
-            
-            # Store in database
-            device_type = sensor_row.get('device_type')
-            value_for_type = None
-            
-            if device_type:
-                device_type_lower = str(device_type).lower().strip()
-                for key, val in updated_values.items():
-                    if key and str(key).lower().strip() == device_type_lower:
-                        value_for_type = val
-                        break
-                if value_for_type is None and device_type in updated_values:
-                    value_for_type = updated_values.get(device_type)
-            
-            if value_for_type is None and len(updated_values) > 0:
-                value_for_type = next(iter(updated_values.values()))
-            
-            status_label = 'normal' if safe else 'warning'
-            
-            sensor_db_id = sensor_row.get('id')
-            if sensor_db_id and value_for_type is not None:
-                try:
-                    result = insert_sensor_data(
-                        sensor_db_id=sensor_db_id,
-                        value=value_for_type,
-                        status=status_label,
-                        user_id=sensor_user_id,
-                        device_id=device_id
-                    )
-                    if result:
-                        print(f"MQTT Sensor: Stored reading for {device_id} ({device_type})", file=sys.stderr)
-                        # Update sensor last_seen timestamp
-                        try:
-                            from db import _get_connection, _return_connection, _get_cursor, get_pool
-                            pool = get_pool()
-                            if pool:
-                                conn = _get_connection(pool)
-                                cur = _get_cursor(conn)
-                                if sensor_user_id:
-                                    cur.execute(
-                                        "UPDATE sensors SET last_seen = NOW() WHERE device_id = %s AND user_id = %s",
-                                        (device_id, sensor_user_id)
-                                    )
-                                else:
-                                    cur.execute(
-                                        "UPDATE sensors SET last_seen = NOW() WHERE device_id = %s",
-                                        (device_id,)
-                                    )
-                                conn.commit()
-                                cur.close()
-                                _return_connection(pool, conn)
-                        except Exception as update_err:
-                            # Non-critical, just log
-                            pass
-                    else:
-                        print(f"MQTT Sensor: Failed to store reading for {device_id}", file=sys.stderr)
-                except Exception as db_err:
-                    print(f"MQTT Sensor: Database error for {device_id}: {db_err}", file=sys.stderr)
-            
-            # Update caches
-            if sensor_user_id:
-                if sensor_user_id not in user_latest_by_sensor:
-                    user_latest_by_sensor[sensor_user_id] = {}
-                user_latest_by_sensor[sensor_user_id][device_id] = {
-                    'device_id': device_id,
-                    'device_type': device_type,
-                    'location': sensor_row.get('location'),
-                    'value': value_for_type,
-                }
-            latest_by_sensor[device_id] = {
-                'device_id': device_id,
-                'device_type': device_type,
-                'location': sensor_row.get('location'),
-                'value': value_for_type,
-            }
-            
+            dispatcher.submit(msg.payload, ack=_ack)
         except Exception as e:
-            print(f"MQTT Sensor: Error processing message: {e}", file=sys.stderr)
-            import traceback
-            traceback.print_exc()
+            mqtt_log.exception("MQTT Sensor: Error dispatching message: %s", e)
 
     def _run():
         retry_count = 0
@@ -715,7 +766,11 @@ def start_mqtt_sensor_subscriber(
         
         while retry_count < max_retries:
             try:
-                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+                # manual_ack: PUBACK is sent by the ingest worker after processing;
+                # Receive Maximum makes the broker hold back beyond that window
+                client, connect_kwargs = _create_subscriber_client(
+                    mqtt, 'sensor', manual_ack=dispatcher.workers > 0,
+                    receive_maximum=dispatcher.receive_maximum if dispatcher.workers else None)
                 
                 if mqtt_user and mqtt_password:
                     client.username_pw_set(mqtt_user, mqtt_password)
@@ -758,7 +813,7 @@ def start_mqtt_sensor_subscriber(
                 print(f"MQTT Sensor: Attempting to connect to {mqtt_host}:{mqtt_port} ({'TLS' if mqtt_use_tls else 'plain'}) (attempt {retry_count + 1}/{max_retries})", file=sys.stderr)
                 
                 try:
-                    client.connect_async(mqtt_host, mqtt_port, keepalive=60)
+                    client.connect_async(mqtt_host, mqtt_port, keepalive=60, **connect_kwargs)
                     client.loop_start()
                     
                     for _ in range(10):
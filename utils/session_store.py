@@ -0,0 +1,243 @@
+"""In-memory device session store with write-behind counter persistence.
+
+Validating a session token against MySQL costs a SELECT plus an UPDATE/commit
+per reading. With DEVICE_SESSION_STORE=memory, active sessions (counter and
+sliding expiration) are kept in process memory and dirty counters are flushed
+to device_sessions in one batch every DEVICE_SESSION_FLUSH_SECONDS and on
+shutdown.
+
+Replay protection across restarts:
+- The first accepted counter of a session, and any counter that gets
+  DEVICE_SESSION_COUNTER_MARGIN or more ahead of the persisted value, is
+  written synchronously, so the database never lags by more than the margin
+- When a session is (re)loaded from the database, the margin is added to the
+  persisted counter, so counters that may have been accepted but not flushed
+  before a restart are still rejected
+
+The store is per process. Keep the default (database) when several worker
+processes serve the same devices (e.g. gunicorn --workers > 1).
+"""
+import atexit
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+from db import (
+    get_device_session,
+    update_device_session,
+    update_device_sessions_batch,
+    delete_device_session,
+)
+
+DEVICE_SESSION_STORE = (os.environ.get('DEVICE_SESSION_STORE', 'database') or 'database').strip().lower()
+DEVICE_SESSION_FLUSH_SECONDS = float(os.environ.get('DEVICE_SESSION_FLUSH_SECONDS', '2'))
+DEVICE_SESSION_COUNTER_MARGIN = int(os.environ.get('DEVICE_SESSION_COUNTER_MARGIN', '16'))
+
+
+def _parse_expires_at(expires_at):
+    """Normalize expires_at from the database (datetime or string) to a datetime."""
+    if isinstance(expires_at, datetime):
+        return expires_at
+    if isinstance(expires_at, str):
+        for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
+            try:
+                return datetime.strptime(expires_at, fmt)
+            except ValueError:
+                continue
+    return datetime.utcnow()
+
+
+class DeviceSessionStore:
+    """Thread-safe in-memory session table backed by device_sessions."""
+
+    def __init__(self, flush_seconds: float = DEVICE_SESSION_FLUSH_SECONDS,
+                 counter_margin: int = DEVICE_SESSION_COUNTER_MARGIN):
+        self._lock = threading.Lock()
+        self._sessions = {}  # session_token -> entry dict
+        self._flush_seconds = flush_seconds
+        self._margin = max(0, int(counter_margin))
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'hits': 0, 'loads': 0, 'sync_writes': 0, 'flushes': 0, 'flushed_sessions': 0, 'failed_flushes': 0}
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='device-session-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_seconds):
+            self.flush()
+
+    # ------------------------------------------------------------------ sessions
+
+    def remember(self, session_token: str, device_id: str, ttl_seconds: int):
+        """Register a session just created in the database (counter 0, no margin)."""
+        self.start()
+        with self._lock:
+            self._sessions[session_token] = {
+                'device_id': device_id,
+                'counter': 0,
+                'persisted_counter': 0,
+                'expires_at': datetime.utcnow() + timedelta(seconds=ttl_seconds),
+                'dirty': False,
+            }
+
+    def forget(self, session_token: str):
+        with self._lock:
+            self._sessions.pop(session_token, None)
+
+    def _load(self, session_token: str):
+        sess = get_device_session(session_token)
+        if not sess:
+            return None
+        persisted = int(sess.get('counter') or 0)
+        entry = {
+            'device_id': sess.get('device_id'),
+            # Counters accepted but not flushed before a restart are at most margin ahead
+            'counter': persisted + self._margin if persisted > 0 else persisted,
+            'persisted_counter': persisted,
+            'expires_at': _parse_expires_at(sess.get('expires_at')),
+            'dirty': False,
+        }
+        with self._lock:
+            self._stats['loads'] += 1
+            # Another thread may have loaded it meanwhile; keep the first entry
+            return self._sessions.setdefault(session_token, entry)
+
+    def validate(self, session_token: Optional[str], device_id: Optional[str], counter_value, ttl_seconds: int):
+        """Validate and advance a session. Returns (is_valid, reason)."""
+        if not session_token:
+            return False, "missing_session"
+        self.start()
+        with self._lock:
+            entry = self._sessions.get(session_token)
+            if entry is not None:
+                self._stats['hits'] += 1
+        if entry is None:
+            entry = self._load(session_token)
+            if entry is None:
+                return False, "invalid_session"
+
+        if not device_id or entry.get('device_id') != device_id:
+            return False, "device_mismatch"
+
+        now = datetime.utcnow()
+        sync_write = None
+        with self._lock:
+            if now > entry['expires_at']:
+                self._sessions.pop(session_token, None)
+                expired = True
+            else:
+                expired = False
+                if counter_value is not None:
+                    try:
+                        cval = int(counter_value)
+                    except Exception:
+                        return False, "counter_invalid"
+                    if cval <= entry['counter']:
+                        return False, "counter_reused"
+                    entry['counter'] = cval
+                # Sliding expiration
+                entry['expires_at'] = now + timedelta(seconds=ttl_seconds)
+                entry['dirty'] = True
+                if entry['persisted_counter'] == 0 and entry['counter'] > 0 or \
+                        entry['counter'] - entry['persisted_counter'] >= max(1, self._margin):
+                    sync_write = entry['counter']
+                    entry['persisted_counter'] = entry['counter']
+                    entry['dirty'] = False
+        if expired:
+            try:
+                delete_device_session(session_token)
+            except Exception:
+                pass
+            return False, "session_expired"
+        if sync_write is not None:
+            # Keep the database within the margin so a restart can't reopen replays
+            update_device_session(session_token, sync_write, ttl_seconds)
+            with self._lock:
+                self._stats['sync_writes'] += 1
+        return True, "ok"
+
+    # ------------------------------------------------------------------ persistence
+
+    def flush(self) -> int:
+        """Write dirty counters/expirations to device_sessions in one batch."""
+        now = datetime.utcnow()
+        updates = []
+        with self._lock:
+            for token, entry in list(self._sessions.items()):
+                if now > entry['expires_at']:
+                    # Expired sessions are dropped; the DB row expires on its own
+                    self._sessions.pop(token, None)
+                    continue
+                if entry['dirty']:
+                    remaining = max(1, int((entry['expires_at'] - now).total_seconds()))
+                    updates.append((token, entry['counter'], remaining))
+                    entry['dirty'] = False
+        if not updates:
+            return 0
+        written = update_device_sessions_batch(updates)
+        with self._lock:
+            if written:
+                self._stats['flushes'] += 1
+                self._stats['flushed_sessions'] += written
+                for token, counter, _ in updates:
+                    entry = self._sessions.get(token)
+                    if entry is not None:
+                        entry['persisted_counter'] = max(entry['persisted_counter'], counter)
+            else:
+                self._stats['failed_flushes'] += 1
+                for token, _, _ in updates:
+                    entry = self._sessions.get(token)
+                    if entry is not None:
+                        entry['dirty'] = True
+        if not written:
+            print(f"Session store: failed to flush {len(updates)} sessions; will retry", file=sys.stderr)
+        return written
+
+    def stats(self) -> dict:
+        with self._lock:
+            result = dict(self._stats)
+            result['sessions'] = len(self._sessions)
+            result['dirty'] = sum(1 for e in self._sessions.values() if e['dirty'])
+        result['counter_margin'] = self._margin
+        return result
+
+
+# Global instance for use across the application
+_session_store: Optional[DeviceSessionStore] = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store() -> Optional[DeviceSessionStore]:
+    """Return the in-memory session store, or None when DEVICE_SESSION_STORE != 'memory'."""
+    global _session_store
+    if DEVICE_SESSION_STORE != 'memory':
+        return None
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                _session_store = DeviceSessionStore()
+    return _session_store
+
+
+def remember_device_session(session_token: str, device_id: str, ttl_seconds: int):
+    """Tell the in-memory store about a newly created session (no-op in database mode)."""
+    store = get_session_store()
+    if store is not None:
+        store.remember(session_token, device_id, ttl_seconds)
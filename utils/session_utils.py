@@ -7,6 +7,7 @@ from db import (
     delete_device_session,
     update_device_session,
 )
+from utils.session_store import get_session_store
 
 # Device session configuration (imported from app.py or set here)
 DEVICE_SESSION_TTL_SECONDS = 900  # 15 minutes
@@ -35,6 +36,11 @@ def _issue_device_challenge(device_id: str, device_challenges_dict: dict):
 
 def _validate_device_session(session_token: Optional[str], device_id: Optional[str], counter_value):
     """Validate device session from database. Returns (is_valid, reason)."""
+    store = get_session_store()
+    if store is not None:
+        # DEVICE_SESSION_STORE=memory: counters are kept in memory and flushed in batches
+        return store.validate(session_token, device_id, counter_value, DEVICE_SESSION_TTL_SECONDS)
+
     if not session_token:
         return False, "missing_session"
     
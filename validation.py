@@ -5,6 +5,8 @@ Provides functions to validate user inputs and sanitize data.
 import re
 from typing import Optional, Tuple
 
+from encryption_utils import KEY_ALGORITHMS, key_algorithm_for_pem
+
 
 # Email validation regex (RFC 5322 compliant, simplified)
 EMAIL_REGEX = re.compile(
@@ -253,6 +255,10 @@ def validate_public_key(public_key: Optional[str], required: bool = False) -> Tu
     if not PEM_PUBLIC_KEY_REGEX.match(public_key):
         return False, "Public key format is invalid. Please ensure it's a valid PEM-formatted public key."
     
+    # Device keys may be RSA or Ed25519 (signature algorithm follows the key type)
+    if key_algorithm_for_pem(public_key) not in KEY_ALGORITHMS:
+        return False, "Public key must be a valid RSA or Ed25519 public key."
+    
     return True, None
 
 